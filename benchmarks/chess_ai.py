@@ -0,0 +1,78 @@
+"""
+Chess engine of the bot: nodes searched per second, and how closely searches run through the
+process pool keep to their time budget. The tactical positions the engine has to solve are
+checked by tests/test_chess_engine.py.
+
+Exits with status 1 if a search overshoots its budget.
+
+Usage: python -m benchmarks.chess_ai [--time SECONDS] [--searches N]
+"""
+
+import argparse
+import sys
+import time
+
+from games.chess.board import Board, STARTING_FEN
+from games.chess.engine import Searcher, SearchPool, TranspositionTable
+
+NPS_POSITIONS = [
+    ('start', STARTING_FEN),
+    ('kiwipete', 'r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1'),
+    ('middlegame', 'r1bq1rk1/pp2bppp/2n1pn2/3p4/2PP4/2N1PN2/PP1B1PPP/R2QKB1R w KQ - 0 8'),
+    ('endgame', '8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1'),
+]
+
+# Searches through the pool may take this much longer than their budget (to ship the result back)
+BUDGET_GRACE = 0.1
+
+
+def run_nps(time_limit: float) -> None:
+    table = TranspositionTable()
+    total_nodes, total_time = 0, 0.0
+    for name, fen in NPS_POSITIONS:
+        board = Board(fen)
+        result = Searcher(table).search(board, time_limit)
+        total_nodes += result.nodes
+        total_time += result.seconds
+        print(f"{name:>12}: {board.san(result.move):7} depth {result.depth:2} score {result.score:6} "
+              f"{result.nodes:8} nodes in {result.seconds:5.2f} s ({result.nodes / result.seconds:6.0f} nodes/s)")
+
+    print(f"Total: {total_nodes} nodes in {total_time:.2f} s ({total_nodes / total_time:.0f} nodes/s), "
+          f"transposition table {table.memory >> 20} MiB, {table.usage():.1%} used")
+
+
+def run_pool(searches: int, time_limit: float) -> bool:
+    pool = SearchPool()
+    try:
+        # Spawning the processes is not part of the budget of the first search
+        pool.submit(STARTING_FEN, [], 0).result()
+
+        board = Board()
+        overshoot = 0.0
+        for _ in range(searches):
+            start = time.perf_counter()
+            result = pool.submit(STARTING_FEN, board.move_stack, time_limit).result()
+            overshoot = max(overshoot, time.perf_counter() - start - time_limit)
+            board.make_move(result.move)
+    finally:
+        pool.shutdown()
+
+    ok = overshoot <= BUDGET_GRACE
+    print(f"Pool: {searches} searches with a {time_limit:.2f} s budget, at most {overshoot * 1000:+.0f} ms "
+          f"over budget {'ok' if ok else 'FAILED'}")
+    return ok
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--time', type=float, default=2.0, help="search time per position for nodes per second")
+    parser.add_argument('--searches', type=int, default=6, help="searches run through the process pool")
+    args = parser.parse_args()
+
+    run_nps(args.time)
+    ok = run_pool(args.searches, args.time / 4)
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
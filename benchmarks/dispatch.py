@@ -0,0 +1,81 @@
+"""
+Compares PTBHandlerGame's dispatch tables with a linear scan over every handler.
+
+Usage: python -m benchmarks.dispatch [--handlers N] [--updates N]
+"""
+
+import argparse
+import timeit
+from datetime import datetime
+from functools import partial
+from types import SimpleNamespace
+
+from telegram import Update, Message, Chat, User, CallbackQuery
+from telegram.ext import CommandHandler, CallbackQueryHandler
+
+from core.api import PTBHandlerGame, Party, Player, TelegramUpdate
+
+
+class BenchmarkGame(PTBHandlerGame):
+    def __init__(self, handler_count: int):
+        super().__init__(None, Party([]))
+
+        for i in range(handler_count):
+            self.add_handler(CommandHandler(f'command{i}', self._noop), group=i % 3)
+            self.add_handler(CallbackQueryHandler(self._noop, pattern=f'^callback{i}_'), group=i % 3)
+
+    def handle_linear(self, action: TelegramUpdate) -> list:
+        # The dispatch algorithm used before the tables were introduced
+        callables = []
+        for _, handlers in sorted(self.groups.items()):
+            for handler in handlers:
+                check = handler.check_update(action.raw_update)
+                if check is not None and check is not False:
+                    callables.append(partial(
+                        handler.handle_update,
+                        action.raw_update, action.raw_context.dispatcher, check, action.raw_context))
+        return callables
+
+    @staticmethod
+    def _noop(update, context) -> None:
+        pass
+
+
+def make_updates(handler_count: int) -> list[TelegramUpdate]:
+    user = User(1, 'Player', False)
+    chat = Chat(-1, Chat.GROUP)
+    context = SimpleNamespace(dispatcher=None)
+
+    updates = []
+    for i in range(handler_count):
+        message = Message(i, datetime.now(), chat, from_user=user, text=f'/command{i} 1 2 3')
+        updates.append(Update(2 * i, message=message))
+
+        query = CallbackQuery(str(i), user, 'instance', message=message, data=f'callback{i}_data')
+        updates.append(Update(2 * i + 1, callback_query=query))
+
+    return [TelegramUpdate(update, context, Player(user)) for update in updates]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--handlers', type=int, default=20, help="number of command/callback handler pairs")
+    parser.add_argument('--updates', type=int, default=20000, help="number of updates to dispatch per path")
+    args = parser.parse_args()
+
+    game = BenchmarkGame(args.handlers)
+    updates = make_updates(args.handlers)
+
+    # Both paths must agree on which handlers match
+    for update in updates:
+        assert [x.func for x in game.handle(update)] == [x.func for x in game.handle_linear(update)]
+
+    rounds = max(1, args.updates // len(updates))
+    for name, method in (('linear', game.handle_linear), ('table', game.handle)):
+        elapsed = timeit.timeit(lambda: [method(x) for x in updates], number=rounds)
+        count = rounds * len(updates)
+        print(f"{name:>8}: {count / elapsed:12.0f} updates/s, {elapsed / count * 1e6:8.2f} us/update")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,226 @@
+"""
+Pushes synthetic Telegram updates through the dispatcher set up by Bot.__init__.
+
+Every game gets its own group chat with five players. The firehose creates the games with
+/new_game, then interleaves party proposals (/select), party and mission votes (callback queries)
+and unrelated chatter. The Bot API is replaced by a local stub, so nothing leaves the process. Throughput and latency
+percentiles are reported per update kind and can be saved and compared between runs.
+
+Usage: python -m benchmarks.firehose [--games N] [--rounds N] [--async] [--output FILE] [--compare FILE]
+"""
+
+import argparse
+import json
+import logging
+import random
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime
+from itertools import chain, count
+from typing import Optional
+
+from telegram import Update, Message, Chat, User, MessageEntity, CallbackQuery
+
+from core import Bot
+from core.callbacks import encode_callback
+from games import Resistance
+from games.resistance.game import CallbackAction
+from games.resistance.logic import GameState
+
+PLAYERS_PER_GAME = 5
+
+
+class StubRequest:
+    """Answers Bot API requests locally, in place of telegram.utils.request.Request."""
+
+    def __init__(self):
+        self.calls = defaultdict(int)
+        self._message_ids = count(1)
+        self._lock = threading.Lock()
+
+    def post(self, url: str, data: dict, timeout: float = None):
+        method = url.rsplit('/', 1)[-1]
+        with self._lock:
+            self.calls[method] += 1
+            message_id = next(self._message_ids)
+
+        if method in ('sendMessage', 'editMessageText'):
+            return {'message_id': data.get('message_id', message_id), 'date': 0, 'text': data.get('text', ''),
+                    'chat': {'id': data.get('chat_id', 0), 'type': Chat.GROUP}}
+        return True
+
+    def stop(self) -> None:
+        pass
+
+
+class Firehose:
+    def __init__(self, bot: Bot, games: int, seed: int):
+        self.tg_bot = bot.updater.bot
+        self.game_manager = bot.game_manager
+        self.games = games
+        self.rng = random.Random(seed)
+
+        self._update_ids = count(1)
+        self._message_ids = count(1)
+
+    def user(self, game: int, idx: int) -> User:
+        user_id = game * PLAYERS_PER_GAME + idx + 1
+        return User(user_id, f'Player{user_id}', False, username=f'player{user_id}', bot=self.tg_bot)
+
+    def chat(self, game: int) -> Chat:
+        return Chat(-(game + 1), Chat.GROUP, bot=self.tg_bot)
+
+    def message(self, game: int, sender: User, text: str, entities: list[MessageEntity] = ()) -> Update:
+        message = Message(next(self._message_ids), datetime.now(), self.chat(game), from_user=sender, text=text,
+                          entities=list(entities), bot=self.tg_bot)
+        return Update(next(self._update_ids), message=message)
+
+    def command(self, game: int, sender: User, text: str, mentions: list[User] = ()) -> Update:
+        command = text.split()[0]
+        entities = [MessageEntity(MessageEntity.BOT_COMMAND, 0, len(command))]
+
+        # Players are mentioned by name, so that the mentions carry the users
+        for user in mentions:
+            text += f' {user.first_name}'
+            entities.append(MessageEntity(MessageEntity.TEXT_MENTION, len(text) - len(user.first_name),
+                                          len(user.first_name), user=user))
+        return self.message(game, sender, text, entities)
+
+    def callback(self, game: int, sender: User, data: str) -> Update:
+        message = Message(next(self._message_ids), datetime.now(), self.chat(game), bot=self.tg_bot)
+        query = CallbackQuery(str(next(self._update_ids)), sender, str(game), message=message, data=data,
+                              bot=self.tg_bot)
+        return Update(next(self._update_ids), callback_query=query)
+
+    def new_games(self) -> list[tuple[str, Update]]:
+        updates = []
+        for game in range(self.games):
+            players = [self.user(game, i) for i in range(PLAYERS_PER_GAME)]
+            updates.append(('new_game', self.command(game, players[0], '/new_game resistance', players[1:])))
+        return updates
+
+    def turn(self) -> list[tuple[str, Update]]:
+        updates = []
+        for game in range(self.games):
+            players = [self.user(game, i) for i in range(PLAYERS_PER_GAME)]
+            instance = self.game_manager.get_game(game)
+
+            if instance is not None and instance.game.state == GameState.MISSION_VOTE_IN_PROGRESS:
+                for member in instance.game.current_party:
+                    red = not instance.game.is_spy(member) or self.rng.random() < 0.5
+                    sender = players[(member.id - 1) % PLAYERS_PER_GAME]
+                    data = encode_callback(game, CallbackAction.MISSION_VOTE, red)
+                    updates.append(('mission', self.callback(game, sender, data)))
+            else:
+                leader = self.leader(game) or players[0]
+                updates.append(('select', self.command(game, leader, '/select 1 2')))
+                for player in players:
+                    data = encode_callback(game, CallbackAction.PARTY_VOTE, self.rng.random() < 0.5)
+                    updates.append(('vote', self.callback(game, player, data)))
+            for _ in range(3):
+                updates.append(('chatter', self.message(game, self.rng.choice(players), 'hello there')))
+
+        self.rng.shuffle(updates)
+        return updates
+
+    def drain(self) -> None:
+        # Game actions run in the mailboxes of the games, after the dispatcher has returned
+        for game in range(self.games):
+            instance = self.game_manager.get_game(game)
+            if instance is not None:
+                self.game_manager.submit(instance, lambda: None).result()
+
+    def leader(self, game: int) -> Optional[User]:
+        # Games are numbered in the order of creation, so proposals can come from the actual leader
+        instance = self.game_manager.get_game(game)
+        if instance is None or instance.game.leader is None:
+            return None
+        return self.user(game, (instance.game.leader.id - 1) % PLAYERS_PER_GAME)
+
+
+def percentile(values: list[float], fraction: float) -> float:
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def run(games: int, rounds: int, seed: int, async_mode: bool = False) -> dict:
+    bot = Bot(token='123456:STUB', async_mode=async_mode)
+    bot.game_manager.add_game('resistance', Resistance)
+
+    request = StubRequest()
+    bot.updater.bot._request = request
+    bot.updater.bot._bot = User(0, 'Gamebot', True, username='gamebot')
+
+    # Outbound messages are sent from the Scheduler loop
+    threading.Thread(target=bot.scheduler.loop.run_forever, daemon=True).start()
+
+    dispatcher = bot.updater.dispatcher
+    firehose = Firehose(bot, games, seed)
+    latencies = defaultdict(list)
+    elapsed = 0.0
+
+    # Turns are generated after the previous batch is handled, as proposals depend on the game state
+    for updates in chain([firehose.new_games()], (firehose.turn() for _ in range(rounds))):
+        start = time.perf_counter()
+        for kind, update in updates:
+            update_start = time.perf_counter()
+            dispatcher.process_update(update)
+            latencies[kind].append(time.perf_counter() - update_start)
+        firehose.drain()
+        elapsed += time.perf_counter() - start
+
+    total = sum(len(x) for x in latencies.values())
+    result = {'games': games, 'rounds': rounds, 'async_mode': async_mode, 'updates': total, 'elapsed': elapsed,
+              'throughput': total / elapsed, 'api_calls': dict(request.calls), 'kinds': {}}
+    for kind, values in latencies.items():
+        values.sort()
+        result['kinds'][kind] = {
+            'count': len(values),
+            'throughput': len(values) / sum(values),
+            'p50': percentile(values, 0.5),
+            'p99': percentile(values, 0.99),
+        }
+    return result
+
+
+def report(result: dict, baseline: dict = None) -> None:
+    print(f"{result['updates']} updates for {result['games']} games in {result['elapsed']:.2f} s "
+          f"({result['throughput']:.0f} updates/s)")
+
+    for kind, stats in sorted(result['kinds'].items()):
+        line = (f"{kind:>10}: {stats['count']:7} updates, {stats['throughput']:9.0f} updates/s, "
+                f"p50 {stats['p50'] * 1e6:8.1f} us, p99 {stats['p99'] * 1e6:8.1f} us")
+        if baseline is not None and kind in baseline['kinds']:
+            old = baseline['kinds'][kind]
+            line += f" (p50 {stats['p50'] / old['p50'] - 1:+.0%}, p99 {stats['p99'] / old['p99'] - 1:+.0%})"
+        print(line)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--games', type=int, default=1000, help="number of concurrent games")
+    parser.add_argument('--rounds', type=int, default=3, help="proposal and vote rounds per game")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--async', dest='async_mode', action='store_true', help="run game actions on the loop")
+    parser.add_argument('--output', help="save the results as JSON")
+    parser.add_argument('--compare', help="compare with results saved earlier")
+    args = parser.parse_args()
+
+    # Failing updates are part of the load, their tracebacks are not
+    logging.disable(logging.CRITICAL)
+
+    result = run(args.games, args.rounds, args.seed, args.async_mode)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    report(result, baseline)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
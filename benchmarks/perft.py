@@ -0,0 +1,94 @@
+"""
+Perft of the chess engine: counts the leaf nodes of the move tree of well-known positions and
+compares them with the published numbers, which checks move generation (castling, en passant,
+promotions, pins and checks included). Reports nodes per second, and how long validating a
+player's move takes (reading its SAN and making it).
+
+Exits with status 1 if any count differs.
+
+Usage: python -m benchmarks.perft [--depth N] [--moves N]
+"""
+
+import argparse
+import random
+import sys
+import time
+
+from games.chess.board import Board, STARTING_FEN, perft
+
+# Positions from the Chess Programming Wiki, with their node counts by depth
+POSITIONS = [
+    ('start', STARTING_FEN, [20, 400, 8902, 197281, 4865609]),
+    ('kiwipete', 'r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1',
+     [48, 2039, 97862, 4085603]),
+    ('position 3', '8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1', [14, 191, 2812, 43238, 674624]),
+    ('position 4', 'r3k2r/Pppp1ppp/1b3nbN/nP6/BBP1P3/q4N2/Pp1P2PP/R2Q1RK1 w kq - 0 1', [6, 264, 9467, 422333]),
+    ('position 5', 'rnbq1k1r/pp1Pbppp/2p5/8/2B5/8/PPP1NnPP/RNBQK2R w KQ - 1 8', [44, 1486, 62379, 2103487]),
+    ('position 6', 'r4rk1/1pp1qppp/p1np1n2/2b1p1B1/2B1P1b1/P1NP1N2/1PP1QPPP/R4RK1 w - - 0 10',
+     [46, 2079, 89890, 3894594]),
+]
+
+SEED = 0
+
+
+def run_perft(depth: int) -> bool:
+    ok = True
+    total_nodes, total_time = 0, 0.0
+    for name, fen, counts in POSITIONS:
+        for d, expected in enumerate(counts[:depth], 1):
+            board = Board(fen)
+            start = time.perf_counter()
+            nodes = perft(board, d)
+            elapsed = time.perf_counter() - start
+            total_nodes += nodes
+            total_time += elapsed
+
+            status = 'ok' if nodes == expected else f'MISMATCH (expected {expected})'
+            ok &= nodes == expected
+            print(f"{name:>10} depth {d}: {nodes:9} nodes in {elapsed:7.3f} s ({nodes / elapsed:8.0f} nodes/s) {status}")
+
+            # The board must be restored exactly by unmaking the moves
+            if board.fen() != Board(fen).fen():
+                print(f"{name:>10}: position not restored after perft")
+                ok = False
+
+    print(f"Total: {total_nodes} nodes in {total_time:.2f} s ({total_nodes / total_time:.0f} nodes/s)")
+    return ok
+
+
+def run_validation(moves: int) -> None:
+    # Plays random games and times what the bot does with a player's move: reading and making it
+    rng = random.Random(SEED)
+    board = Board()
+    texts = []
+    while len(texts) < moves:
+        legal = board.legal_moves()
+        if not legal or board.halfmove_clock >= 100:
+            board = Board()
+            continue
+        move = rng.choice(legal)
+        texts.append((board.fen(), board.san(move)))
+        board.make_move(move)
+
+    elapsed = 0.0
+    for fen, text in texts:
+        board = Board(fen)
+        start = time.perf_counter()
+        board.make_move(board.parse_san(text))
+        elapsed += time.perf_counter() - start
+    print(f"Move validation: {elapsed / len(texts) * 1e6:.1f} us per move (SAN parsing and making the move)")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--depth', type=int, default=3, help="maximum perft depth per position")
+    parser.add_argument('--moves', type=int, default=10000, help="moves to validate")
+    args = parser.parse_args()
+
+    ok = run_perft(args.depth)
+    run_validation(args.moves)
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+"""
+Plays random Resistance games on GameInstance and measures the cost of state transitions.
+
+Usage: python -m benchmarks.resistance [--games N] [--players N] [--seed N]
+"""
+
+import argparse
+import logging
+import random
+import time
+
+from telegram import User
+
+from core.api import Player
+from games.resistance.logic import GameInstance, GameState
+
+
+def play(players: list[Player], rng: random.Random) -> int:
+    """Plays a game with random moves and returns the number of transitions."""
+    game = GameInstance(players, rng)
+    game.next_state()
+    transitions = 1
+
+    while game.state != GameState.GAME_OVER:
+        if game.state == GameState.PROPOSAL_PENDING:
+            game.propose_party(game.leader, rng.sample(players, game.current_party_size))
+        elif game.state == GameState.PARTY_VOTE_IN_PROGRESS:
+            for player in players:
+                game.vote_party(player, rng.random() < 0.6)
+            game.next_state()
+        elif game.state == GameState.MISSION_VOTE_IN_PROGRESS:
+            for player in game.current_party:
+                game.vote_mission(player, not game.is_spy(player) or rng.random() < 0.5)
+            game.next_state()
+        transitions += 1
+
+    # Outcome queries made by the renderers once the game is over
+    assert game.outcome is not None
+    return transitions
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--games', type=int, default=20000)
+    parser.add_argument('--players', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    # Measure the game logic rather than the logging
+    logging.disable(logging.INFO)
+
+    rng = random.Random(args.seed)
+    players = [Player(User(i, f'Player {i}', False)) for i in range(args.players)]
+
+    start = time.perf_counter()
+    transitions = sum(play(players, rng) for _ in range(args.games))
+    elapsed = time.perf_counter() - start
+
+    print(f"{args.games} games, {transitions} transitions in {elapsed:.2f} s: "
+          f"{args.games / elapsed:.0f} games/s, {elapsed / transitions * 1e6:.2f} us/transition")
+
+
+if __name__ == '__main__':
+    main()
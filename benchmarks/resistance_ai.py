@@ -0,0 +1,109 @@
+"""
+Plays Resistance games on GameInstance with AI players in every seat, and measures how long the
+AI players take to decide (proposals, party and mission votes) and to update their belief about
+the spies. Also reports how often each side wins, against random resistance members as a
+baseline, and fails if the AI spies win less often than --min-spy-wins with any number of
+players, as spies that never win make filling seats with AI players pointless.
+
+Usage: python -m benchmarks.resistance_ai [--games N] [--players 5-10] [--seed N] [--min-spy-wins RATE]
+"""
+
+import argparse
+import logging
+import random
+import sys
+import time
+
+from telegram import User
+
+from core.api import Player
+from games.resistance.ai import AIPlayer, SpyBelief
+from games.resistance.logic import GameInstance, GameState, MIN_PLAYERS, MAX_PLAYERS, VOTE_LIMIT
+
+
+def play(player_count: int, rng: random.Random, timings: dict[str, list[float]], smart: bool = True) -> bool:
+    """Plays a game and returns its outcome (True if the resistance wins)."""
+    players = [Player(User(i, f'Player {i}', False)) for i in range(player_count)]
+    game = GameInstance(players, rng)
+    game.next_state()
+
+    spies = [players.index(x) for x in game.spies]
+    belief = SpyBelief(player_count, len(spies))
+    bots = [AIPlayer(i, belief, rng, spies if i in spies else None) for i in range(player_count)]
+
+    def timed(kind, fn, *args):
+        start = time.perf_counter()
+        result = fn(*args)
+        timings[kind].append(time.perf_counter() - start)
+        return result
+
+    while game.state != GameState.GAME_OVER:
+        winning_count = game.current_winning_count
+        if game.state == GameState.PROPOSAL_PENDING:
+            leader = players.index(game.leader)
+            if smart or bots[leader].is_spy:
+                party = timed('propose', bots[leader].propose, game.current_party_size, winning_count)
+            else:
+                party = rng.sample(range(player_count), game.current_party_size)
+            game.propose_party(game.leader, [players[i] for i in party])
+
+        elif game.state == GameState.PARTY_VOTE_IN_PROGRESS:
+            party = [players.index(x) for x in game.current_party]
+            last_vote = len(game.current_round.votes) == VOTE_LIMIT
+            for bot in bots:
+                if smart or bot.is_spy:
+                    ballot = timed('vote_party', bot.vote_party, party, winning_count, last_vote)
+                else:
+                    ballot = rng.random() < 0.5 or last_vote
+                game.vote_party(players[bot.index], ballot)
+            vote = game.current_vote
+            timed('observe_vote', belief.observe_vote, party, [vote.ballots[x] for x in players])
+            game.next_state()
+
+        elif game.state == GameState.MISSION_VOTE_IN_PROGRESS:
+            party = [players.index(x) for x in game.current_party]
+            for i in party:
+                game.vote_mission(players[i], timed('vote_mission', bots[i].vote_mission, party, winning_count))
+            black_cards = sum(not x for x in game.current_round.ballots.values())
+            timed('observe_mission', belief.observe_mission, party, black_cards)
+            game.next_state()
+
+    return game.outcome
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--games', type=int, default=2000, help="games per player count")
+    parser.add_argument('--players', type=int, nargs='*', default=list(range(MIN_PLAYERS, MAX_PLAYERS + 1)))
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--min-spy-wins', type=float, default=0.15, help="lowest acceptable win rate of the spies")
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+
+    rng = random.Random(args.seed)
+    ok = True
+    timings: dict[str, list[float]] = {kind: [] for kind in
+                                       ('propose', 'vote_party', 'vote_mission', 'observe_vote', 'observe_mission')}
+    for player_count in args.players:
+        start = time.perf_counter()
+        wins = sum(play(player_count, rng, timings) for _ in range(args.games))
+        elapsed = time.perf_counter() - start
+        baseline = sum(play(player_count, rng, {kind: [] for kind in timings}, smart=False)
+                       for _ in range(args.games))
+        print(f"{player_count:2} players: resistance wins {wins / args.games:6.1%} "
+              f"(random resistance {baseline / args.games:6.1%}), {elapsed / args.games * 1000:.2f} ms per game")
+        if 1 - wins / args.games < args.min_spy_wins:
+            print(f"FAIL: spies win less than {args.min_spy_wins:.0%} of the games with {player_count} players")
+            ok = False
+
+    for kind, values in timings.items():
+        values.sort()
+        print(f"{kind:>15}: {len(values):7} calls, mean {sum(values) / len(values) * 1e6:6.1f} us, "
+              f"p99 {values[int(len(values) * 0.99)] * 1e6:6.1f} us, max {values[-1] * 1e6:7.1f} us")
+
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
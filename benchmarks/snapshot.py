@@ -0,0 +1,199 @@
+"""
+Measures the size of game snapshots (see core.snapshot) and how fast they are encoded and decoded,
+against pickling the same state, for Resistance and Chess games at random stages. Then migrates
+the games to a worker process through a pipe and checks that they resume in the same state.
+
+Usage: python -m benchmarks.snapshot [--games N] [--players 5-10] [--seed N]
+"""
+
+import argparse
+import logging
+import multiprocessing
+import pickle
+import random
+import time
+from typing import Callable
+
+from telegram import Chat, User
+
+from core.api import Game, Party, Player
+from core.registry import GameRegistry
+from core.snapshot import GameSnapshot
+from games import MANIFEST
+from games.resistance.logic import GameInstance, GameState
+
+
+def make_party(player_count: int, chat_id: int) -> Party:
+    users = [User(chat_id * 100 + i, f'Player {i}', False, username=f'player{i}') for i in range(player_count)]
+    players = [Player(x) for x in users]
+    party = Party(players, players[0], Chat(-chat_id, 'group', title=f'Group {chat_id}'))
+    party.muted = True
+    return party
+
+
+def make_resistance(registry: GameRegistry, game_id: int, player_count: int, rng: random.Random) -> Game:
+    """Creates a Resistance game and plays random moves for a random part of it."""
+    game = registry.get('resistance')(None, make_party(player_count, game_id), game_id, rng.getrandbits(32))
+    instance = game.game
+    for _ in range(rng.randrange(1, 40)):
+        if instance.state == GameState.PROPOSAL_PENDING:
+            instance.propose_party(instance.leader, rng.sample(instance.players, instance.current_party_size))
+        elif instance.state == GameState.PARTY_VOTE_IN_PROGRESS:
+            for player in instance.players:
+                instance.vote_party(player, rng.random() < 0.6)
+            instance.next_state()
+        elif instance.state == GameState.MISSION_VOTE_IN_PROGRESS:
+            for player in instance.current_party:
+                instance.vote_mission(player, not instance.is_spy(player) or rng.random() < 0.5)
+            instance.next_state()
+        else:
+            break
+    return game
+
+
+def make_chess(registry: GameRegistry, game_id: int, rng: random.Random) -> Game:
+    """Creates a Chess game between two players and plays random moves for up to 120 plies."""
+    game = registry.get('chess')(None, make_party(2, game_id), game_id, rng.getrandbits(32))
+    for _ in range(rng.randrange(1, 120)):
+        moves = game.position.legal_moves()
+        if not moves:
+            break
+        game.position.make_move(rng.choice(moves))
+    return game
+
+
+def pickle_instance(instance: GameInstance) -> bytes:
+    # Snapshots replace the random generator with a seed, so it's left out for a fair comparison
+    rng, instance._random = instance._random, None
+    try:
+        return pickle.dumps(instance, pickle.HIGHEST_PROTOCOL)
+    finally:
+        instance._random = rng
+
+
+def timed(fn: Callable, items: list) -> tuple[list, float]:
+    """Returns the results of fn for every item and the mean time per item."""
+    start = time.perf_counter()
+    results = [fn(x) for x in items]
+    return results, (time.perf_counter() - start) / len(items)
+
+
+def report(name: str, encoded: list[bytes], encode_time: float, decode_time: float) -> None:
+    sizes = sorted(len(x) for x in encoded)
+    print(f"{name:>28}: {sum(sizes) / len(sizes):7.0f} bytes mean, {sizes[-1]:6} max, "
+          f"encode {encode_time * 1e6:7.1f} us, decode {decode_time * 1e6:7.1f} us")
+
+
+def bench_resistance(registry: GameRegistry, games: list[Game]) -> None:
+    instances = [x.game for x in games]
+    players = [{p.id: p for p in x.players} for x in instances]
+
+    packed, encode_time = timed(GameInstance.pack, instances)
+    _, decode_time = timed(lambda x: GameInstance.unpack(*x), list(zip(packed, players)))
+    report('resistance state', packed, encode_time, decode_time)
+
+    pickled, encode_time = timed(pickle_instance, instances)
+    _, decode_time = timed(pickle.loads, pickled)
+    report('resistance state (pickle)', pickled, encode_time, decode_time)
+
+    bench_envelope(registry, 'resistance', games)
+
+
+def bench_chess(registry: GameRegistry, games: list[Game]) -> None:
+    frozen, encode_time = timed(lambda x: x.freeze(), games)
+    _, decode_time = timed(lambda x: x[0].thaw(x[1]), list(zip(games, frozen)))
+    report('chess state', frozen, encode_time, decode_time)
+
+    pickled, encode_time = timed(lambda x: pickle.dumps(x.position, pickle.HIGHEST_PROTOCOL), games)
+    _, decode_time = timed(pickle.loads, pickled)
+    report('chess board (pickle)', pickled, encode_time, decode_time)
+
+    bench_envelope(registry, 'chess', games)
+
+
+def bench_envelope(registry: GameRegistry, name: str, games: list[Game]) -> None:
+    """Whole snapshots, with the users, chat and deadlines, resumed into new games."""
+    encoded, encode_time = timed(lambda x: GameSnapshot.capture(x, name).encode(), games)
+
+    def resume(data: bytes) -> Game:
+        snapshot = GameSnapshot.decode(data)
+        game = registry.get(name)(None, make_muted_party(snapshot), snapshot.game_id, snapshot.seed)
+        snapshot.apply(game)
+        return game
+
+    resumed, decode_time = timed(resume, encoded)
+    report(f'{name} snapshot', encoded, encode_time, decode_time)
+    assert all(x.checksum() == y.checksum() for x, y in zip(games, resumed))
+
+
+def make_muted_party(snapshot: GameSnapshot) -> Party:
+    party = Party([Player(x) for x in snapshot.users], Player(snapshot.leader) if snapshot.leader else None,
+                  snapshot.chat)
+    party.muted = True
+    return party
+
+
+def resume_worker(connection) -> None:
+    """Resumes the snapshots sent through the connection, and sends back the checksums of the games."""
+    logging.disable(logging.INFO)
+    registry = GameRegistry()
+    registry.add_manifest(MANIFEST)
+
+    while True:
+        data = connection.recv_bytes()
+        if not data:
+            return
+        snapshot = GameSnapshot.decode(data)
+        game = registry.get(snapshot.game_name)(None, make_muted_party(snapshot), snapshot.game_id, snapshot.seed)
+        snapshot.apply(game)
+        connection.send(game.checksum())
+
+
+def bench_migration(games: list[tuple[str, Game]]) -> None:
+    context = multiprocessing.get_context('spawn')
+    connection, worker_connection = context.Pipe()
+    worker = context.Process(target=resume_worker, args=(worker_connection,), daemon=True)
+    worker.start()
+
+    # The first round trip waits for the worker to start up, and isn't counted
+    connection.send_bytes(GameSnapshot.capture(games[0][1], games[0][0]).encode())
+    connection.recv()
+
+    start = time.perf_counter()
+    moved = 0
+    for name, game in games:
+        connection.send_bytes(GameSnapshot.capture(game, name).encode())
+        if connection.recv() == game.checksum():
+            moved += 1
+    elapsed = time.perf_counter() - start
+
+    connection.send_bytes(b'')
+    worker.join()
+    print(f"migration: {moved}/{len(games)} games resumed in the same state, "
+          f"{elapsed / len(games) * 1000:.3f} ms per game ({len(games) / elapsed:.0f} games/s)")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--games', type=int, default=2000)
+    parser.add_argument('--players', type=int, default=7)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    # Games log every state transition at the info level
+    logging.disable(logging.INFO)
+
+    registry = GameRegistry()
+    registry.add_manifest(MANIFEST)
+    rng = random.Random(args.seed)
+
+    resistance = [make_resistance(registry, i + 1, args.players, rng) for i in range(args.games)]
+    chess = [make_chess(registry, args.games + i + 1, rng) for i in range(args.games)]
+
+    bench_resistance(registry, resistance)
+    bench_chess(registry, chess)
+    bench_migration([('resistance', x) for x in resistance] + [('chess', x) for x in chess])
+
+
+if __name__ == '__main__':
+    main()
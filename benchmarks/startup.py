@@ -0,0 +1,90 @@
+"""
+Cold start of the bot: how long a fresh process takes until the bot is created and its games
+are registered, with every game imported up front (as run.py used to do) and with games
+registered from the manifest and imported on first use. Also reports what the first game of
+each kind then costs, when its module is imported.
+
+Every measurement runs in a new interpreter, and the median of the runs is reported.
+
+Usage: python -m benchmarks.startup [--runs N]
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+from games import MANIFEST
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Code run by the measured processes; it prints the time spent in it as JSON
+SETUP = '''
+import json, logging, time
+start = time.perf_counter()
+logging.disable(logging.CRITICAL)
+from core import Bot
+'''
+
+EAGER = SETUP + '''
+from games.chess import Chess
+from games.resistance import Resistance
+bot = Bot(token='123456:STUB')
+bot.game_manager.add_game('chess', Chess)
+bot.game_manager.add_game('resistance', Resistance)
+print(json.dumps({'ready': time.perf_counter() - start}))
+'''
+
+LAZY = SETUP + '''
+from games import MANIFEST
+bot = Bot(token='123456:STUB')
+bot.game_manager.games.add_manifest(MANIFEST)
+ready = time.perf_counter() - start
+first = {{}}
+for name in {names!r}:
+    t = time.perf_counter()
+    bot.game_manager.games.get(name)
+    first[name] = time.perf_counter() - t
+print(json.dumps({{'ready': ready, 'first': first}}))
+'''
+
+
+def measure(code: str, runs: int) -> tuple[float, float, list[dict]]:
+    """Median wall time of the processes, median time until the bot is ready in them, and their reports."""
+    walls, reports = [], []
+    for _ in range(runs):
+        start = time.perf_counter()
+        output = subprocess.run([sys.executable, '-c', code], cwd=ROOT, check=True, capture_output=True,
+                                text=True).stdout
+        walls.append(time.perf_counter() - start)
+        reports.append(json.loads(output.splitlines()[-1]))
+    return statistics.median(walls), statistics.median(x['ready'] for x in reports), reports
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=10)
+    args = parser.parse_args()
+
+    with open(MANIFEST) as f:
+        names = sorted(json.load(f))
+
+    # The first run warms up the bytecode and file system caches
+    measure(EAGER, 1)
+
+    eager_wall, eager_ready, _ = measure(EAGER, args.runs)
+    lazy_wall, lazy_ready, reports = measure(LAZY.format(names=names), args.runs)
+
+    print(f"Eager: ready after {eager_ready * 1000:6.1f} ms ({eager_wall * 1000:6.1f} ms process)")
+    print(f" Lazy: ready after {lazy_ready * 1000:6.1f} ms ({lazy_wall * 1000:6.1f} ms process, with the games below), "
+          f"{(eager_ready - lazy_ready) * 1000:.1f} ms saved")
+    for name in names:
+        first = statistics.median(x['first'][name] for x in reports)
+        print(f"       first {name} game imports it in {first * 1000:6.1f} ms")
+
+
+if __name__ == '__main__':
+    main()
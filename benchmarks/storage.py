@@ -0,0 +1,81 @@
+"""
+Measures the write throughput of the game log and the time needed to recover games from it.
+
+Usage: python -m benchmarks.storage [--games N] [--actions N] [--path DIR]
+"""
+
+import argparse
+import shutil
+import tempfile
+import time
+
+from core.storage import Storage, GameState, PlayerState
+
+
+def make_action(game_id: int, seq: int) -> dict:
+    # Roughly the size of a serialized callback query update
+    return {
+        'update_id': game_id * 1000 + seq,
+        'callback_query': {
+            'id': str(seq), 'chat_instance': '-1', 'data': 'resistance_party_vote_affirmative',
+            'from': {'id': seq, 'first_name': 'Player', 'is_bot': False},
+            'message': {'message_id': seq, 'date': 0, 'chat': {'id': -game_id, 'type': 'group'}},
+        },
+    }
+
+
+def bench_writes(path: str, games: int, actions: int) -> None:
+    storage = Storage(path)
+    storage.open()
+
+    players = [PlayerState(i, {'id': i, 'first_name': f'Player {i}', 'is_bot': False}) for i in range(5)]
+    latencies = []
+
+    start = time.perf_counter()
+    for game_id in range(games):
+        storage.add_game(GameState(game_id, 'resistance', game_id, [x.user_id for x in players], 0,
+                                   {'id': -game_id, 'type': 'group'}), players)
+        for seq in range(actions):
+            call_start = time.perf_counter()
+            storage.add_action(game_id, make_action(game_id, seq))
+            latencies.append(time.perf_counter() - call_start)
+    enqueued = time.perf_counter() - start
+    storage.sync()
+    durable = time.perf_counter() - start
+    storage.close()
+
+    records = games * (actions + 1)
+    latencies.sort()
+    print(f"writes: {records} records, {records / durable:.0f} records/s durable, "
+          f"{records / enqueued:.0f} records/s enqueued")
+    print(f"        append latency p50 {latencies[len(latencies) // 2] * 1e6:.1f} us, "
+          f"p99 {latencies[int(len(latencies) * 0.99)] * 1e6:.1f} us")
+
+
+def bench_recovery(path: str, games: int) -> None:
+    start = time.perf_counter()
+    storage = Storage(path)
+    recovered = storage.open()
+    elapsed = time.perf_counter() - start
+    storage.close()
+    print(f"recovery: {len(recovered)} games in {elapsed:.2f} s")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--games', type=int, default=100000)
+    parser.add_argument('--actions', type=int, default=5, help="actions per game")
+    parser.add_argument('--path', help="directory for the log (a temporary one by default)")
+    args = parser.parse_args()
+
+    path = args.path or tempfile.mkdtemp(prefix='gamebot-storage-')
+    try:
+        bench_writes(path, args.games, args.actions)
+        bench_recovery(path, args.games)
+    finally:
+        if args.path is None:
+            shutil.rmtree(path)
+
+
+if __name__ == '__main__':
+    main()
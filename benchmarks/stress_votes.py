@@ -0,0 +1,172 @@
+"""
+Stress test for concurrent votes in Resistance games.
+
+Ballots of every game are cast from several threads at once, and the last ballot of a vote
+advances the game, as Resistance does. Every action goes through the mailbox of its game in
+the game manager. Decisions are keyed by round, vote and player (see simulation.py), so they
+don't depend on the order of the ballots, and every game must end exactly like the same game
+played on a single thread.
+
+Pass --unsafe to run the actions directly on the submitting threads instead, to see the races
+the mailboxes prevent.
+
+Usage: python -m benchmarks.stress_votes [--games N] [--players N] [--threads N] [--unsafe]
+"""
+
+import argparse
+import logging
+import random
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import Callable
+
+from telegram import User
+
+from core.api import Game, Party, Action, GlobalAPI
+from core.gamemanager import GameManager
+from games.resistance.exceptions import GameError
+from games.resistance.logic import GameInstance, GameState
+from games.resistance.simulation import CounterRNG, SimplePolicy, play_scalar
+
+SEED = 0
+
+# A game takes at most 5 rounds of 5 proposals with 3 steps each
+MAX_STEPS = 100
+
+
+class StressGame(Game):
+    def __init__(self, api: GlobalAPI, party: Party, game_id: int = None, seed: int = None):
+        super().__init__(api, party, game_id, seed)
+
+        self.rng = CounterRNG(SEED, game_id)
+        self.game = GameInstance(party.players, self.rng)
+        self.game.next_state()
+        self.errors: list[Exception] = []
+
+    def handle(self, action: Action) -> list[Callable[[], None]]:
+        return []
+
+    def vote_party(self, player, outcome: bool) -> None:
+        self.game.vote_party(player, outcome)
+        if self.game.state == GameState.PARTY_VOTE_RESULTS:
+            self.game.next_state()
+
+    def vote_mission(self, player, outcome: bool) -> None:
+        self.game.vote_mission(player, outcome)
+        if self.game.state == GameState.MISSION_VOTE_RESULTS:
+            self.game.next_state()
+
+
+def plan_actions(game: StressGame, policy: SimplePolicy) -> list[Callable[[], None]]:
+    """Returns the actions of the next step of a game, in no particular order."""
+    instance, rng = game.game, game.rng
+    if instance.current_round is None:
+        return []
+
+    players = instance.players
+    index = {player: i for i, player in enumerate(players)}
+    round_idx = len(instance.rounds) - 1
+    vote_idx = len(instance.current_round.votes)
+
+    if instance.state == GameState.PROPOSAL_PENDING:
+        party = policy.propose(rng, round_idx, vote_idx, index[instance.leader], instance.current_party_size,
+                               len(players))
+        return [lambda: instance.propose_party(instance.leader, [players[i] for i in party])]
+
+    if instance.state == GameState.PARTY_VOTE_IN_PROGRESS:
+        vote = instance.current_vote
+        party_has_spy = any(instance.is_spy(x) for x in vote.party)
+        return [(lambda p=player, o=policy.vote_party(rng, round_idx, vote_idx - 1, index[player],
+                                                      instance.is_spy(player), player in vote.members,
+                                                      party_has_spy): game.vote_party(p, o))
+                for player in players]
+
+    if instance.state == GameState.MISSION_VOTE_IN_PROGRESS:
+        return [(lambda p=player, o=policy.vote_mission(rng, round_idx, index[player], instance.is_spy(player)):
+                 game.vote_mission(p, o))
+                for player in instance.current_party]
+
+    return []
+
+
+def run(games: int, player_count: int, threads: int, unsafe: bool) -> int:
+    policy = SimplePolicy()
+    manager = GameManager(workers=threads)
+    manager.add_game('stress', StressGame)
+
+    users = [[User(g * player_count + i + 1, f'Player{g * player_count + i + 1}', False)
+              for i in range(player_count)] for g in range(games)]
+    instances: list[StressGame] = [manager.new_game('stress', x) for x in users]
+
+    def record_errors(game: StressGame, fn: Callable[[], None]) -> Callable[[], None]:
+        def action():
+            try:
+                fn()
+            except GameError as e:
+                game.errors.append(e)
+        return action
+
+    shuffle = random.Random(SEED)
+    submitters = ThreadPoolExecutor(max_workers=threads)
+    steps = 0
+    start = time.perf_counter()
+
+    while True:
+        actions = [(game, record_errors(game, action)) for game in instances for action in plan_actions(game, policy)]
+        if not actions:
+            break
+        shuffle.shuffle(actions)
+        steps += 1
+
+        # Every action is submitted from a random thread, so ballots of a game arrive concurrently
+        if unsafe:
+            futures = [submitters.submit(action) for _, action in actions]
+        else:
+            futures = [submitters.submit(manager.submit, game, action) for game, action in actions]
+            futures = [x.result() for x in futures]
+        wait(futures)
+        for future in futures:
+            future.result()
+
+        # Games broken by races may never finish
+        if steps > MAX_STEPS:
+            break
+
+    elapsed = time.perf_counter() - start
+    submitters.shutdown()
+
+    failures = 0
+    for game in instances:
+        expected = play_scalar(player_count, SEED, game.game_id, policy, game.game.players)
+        actual = (game.game.outcome, len(game.game.rounds))
+        if actual != expected or game.errors:
+            failures += 1
+            if failures <= 5:
+                print(f"Game {game.game_id}: expected {expected}, got {actual}, errors: {game.errors[:3]}")
+
+    print(f"{games} games with {player_count} players, {threads} threads, "
+          f"{'direct calls' if unsafe else 'mailboxes'}: {steps} steps in {elapsed:.2f} s, "
+          f"{failures} game(s) diverged")
+    return failures
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--games', type=int, default=500)
+    parser.add_argument('--players', type=int, default=7)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--unsafe', action='store_true', help="bypass the mailboxes")
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+
+    # Switch threads as often as possible to provoke races
+    sys.setswitchinterval(1e-6)
+
+    failures = run(args.games, args.players, args.threads, args.unsafe)
+    sys.exit(1 if failures and not args.unsafe else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+"""
+Timer churn: schedules a large number of deadlines, cancels most of them before they expire (as
+games do whenever players act in time) and lets the rest fire.
+
+The same workload runs against the timing wheel of core.timers and against loop.call_later on
+an asyncio loop, which keeps its timers in a heap and only discards cancelled ones lazily.
+Time per operation is reported for scheduling, cancelling and expiring.
+
+Usage: python -m benchmarks.timers [--timers N] [--cancel FRACTION] [--max-delay SECONDS]
+"""
+
+import argparse
+import asyncio
+import random
+import time
+
+from core.timers import TimingWheel
+
+SEED = 0
+
+
+def run_wheel(delays: list[float], cancelled: list[int]) -> dict[str, float]:
+    wheel = TimingWheel()
+    fired = 0
+
+    def callback():
+        nonlocal fired
+        fired += 1
+
+    start = time.perf_counter()
+    timers = [wheel.schedule(delay, callback) for delay in delays]
+    scheduled = time.perf_counter()
+    for i in cancelled:
+        wheel.cancel(timers[i])
+    cancelled_at = time.perf_counter()
+
+    # Jumps past the last deadline instead of waiting for it
+    remaining = len(wheel)
+    wheel.advance(wheel._start + max(delays) + 2 * wheel.tick)
+    expired_at = time.perf_counter()
+    assert fired == remaining
+
+    return {'schedule': (scheduled - start) / len(delays),
+            'cancel': (cancelled_at - scheduled) / max(1, len(cancelled)),
+            'expire': (expired_at - cancelled_at) / max(1, remaining)}
+
+
+def run_loop(delays: list[float], cancelled: list[int]) -> dict[str, float]:
+    # The expiry of call_later timers can't be simulated, so only scheduling and cancelling are timed
+    loop = asyncio.new_event_loop()
+    try:
+        start = time.perf_counter()
+        handles = [loop.call_later(delay, int) for delay in delays]
+        scheduled = time.perf_counter()
+        for i in cancelled:
+            handles[i].cancel()
+        cancelled_at = time.perf_counter()
+        for handle in handles:
+            handle.cancel()
+    finally:
+        loop.close()
+
+    return {'schedule': (scheduled - start) / len(delays),
+            'cancel': (cancelled_at - scheduled) / max(1, len(cancelled))}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--timers', type=int, default=500000)
+    parser.add_argument('--cancel', type=float, default=0.9, help="fraction of timers cancelled before expiry")
+    parser.add_argument('--max-delay', type=float, default=600, help="delays are uniform up to this, in seconds")
+    args = parser.parse_args()
+
+    rng = random.Random(SEED)
+    delays = [rng.uniform(0, args.max_delay) for _ in range(args.timers)]
+    cancelled = rng.sample(range(args.timers), int(args.timers * args.cancel))
+
+    print(f"{args.timers} timers, {len(cancelled)} cancelled")
+    for name, fn in [('TimingWheel', run_wheel), ('loop.call_later', run_loop)]:
+        result = fn(delays, cancelled)
+        print(f"{name:16}" + "".join(f"{op:>10} {seconds * 1e9:7.0f} ns" for op, seconds in result.items()))
+
+
+if __name__ == '__main__':
+    main()
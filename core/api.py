@@ -1,28 +1,133 @@
+import asyncio
+import random
+import re
+import threading
+import time
 from abc import ABC, abstractmethod
+from concurrent.futures import Executor
+from contextlib import contextmanager
 from collections import defaultdict
 from functools import wraps, partial
-from typing import Callable, Optional, Iterable
+from typing import Any, Awaitable, Callable, Optional, Iterable, Iterator, Pattern, Union
+from weakref import WeakValueDictionary
 
-from telegram import Chat, User, Update
-from telegram.ext import CallbackContext, Handler
+from telegram import Chat, User, Update, CallbackQuery, Message
+from telegram.ext import CallbackContext, Handler, CommandHandler, CallbackQueryHandler
+
+from core.callbacks import encode_callback, decode_callback
+from core.exceptions import GameBotException
+from core.metrics import HANDLER_SECONDS
+from core.outbound import OutboundQueue, MessageBatch
+from core.routing import CALLBACK_SEPARATOR, get_command, iter_callback_prefixes
+from core.timers import Deadlines
 
 
 class Player:
-    def __init__(self, user: User):
+    """
+    A player is a Telegram user taking part in games.
+
+    Players are interned by PlayerRegistry (one object per user id), but they are also compared
+    and hashed by user id, so they can be used as set members and dictionary keys.
+    """
+
+    __slots__ = ('_raw_user', '_outbound', '__weakref__')
+
+    def __init__(self, user: User, outbound: Optional[OutboundQueue] = None):
         self._raw_user = user
+        self._outbound = outbound
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, Player):
+            return NotImplemented
+        return self is other or self._raw_user.id == other._raw_user.id
+
+    def __hash__(self) -> int:
+        return hash(self._raw_user.id)
 
     def tell_raw(self, *args, **kwargs) -> None:
-        self._raw_user.send_message(*args, **kwargs)
+        if self._outbound is not None:
+            self._outbound.send_message(self._raw_user.id, *args, **kwargs)
+        else:
+            self._raw_user.send_message(*args, **kwargs)
+
+    @property
+    def user(self) -> User:
+        return self._raw_user
+
+    @property
+    def id(self) -> int:
+        return self._raw_user.id
 
     @property
     def name(self) -> str:
         return self._raw_user.name
 
 
+class PlayerRegistry:
+    def __init__(self, outbound: Optional[OutboundQueue] = None):
+        self.outbound = outbound
+
+        # Players are kept alive by the games they take part in
+        self._players: WeakValueDictionary[int, Player] = WeakValueDictionary()
+        self._lock = threading.Lock()
+
+    def get(self, user: Optional[User]) -> Optional[Player]:
+        if user is None:
+            return None
+
+        player = self._players.get(user.id)
+        if player is None:
+            with self._lock:
+                player = self._players.get(user.id)
+                if player is None:
+                    player = self._players[user.id] = Player(user, self.outbound)
+        elif player._raw_user is not user:
+            # Keep the latest copy of the user, as names can change
+            player._raw_user = user
+        return player
+
+    def __len__(self) -> int:
+        return len(self._players)
+
+
+player_registry = PlayerRegistry()
+
+
 class Action:
     pass
 
 
+class Timeout(Action):
+    """Delivered to a game when one of its deadlines (see Game.set_deadline) expires."""
+
+    def __init__(self, name: str):
+        super().__init__()
+
+        self.name = name
+        self.sender: Optional[Player] = None
+
+    def to_dict(self) -> dict:
+        return {'timeout': self.name}
+
+
+class Event(Action):
+    """
+    Delivered to a game that posted it (see Game.post), e.g. with the result of work the game
+    started in the background. Events are recorded and replayed like updates, so the payload
+    must be serializable to JSON.
+    """
+
+    def __init__(self, name: str, payload: Optional[dict] = None):
+        super().__init__()
+
+        self.name = name
+        self.payload = payload if payload is not None else {}
+        self.sender: Optional[Player] = None
+
+    def to_dict(self) -> dict:
+        return {'event': self.name, 'payload': self.payload}
+
+
 class TelegramUpdate(Action):
     def __init__(self, update: Update, context: CallbackContext, sender: Player):
         super().__init__()
@@ -41,21 +146,103 @@ class Party:
     private parties).
     """
 
-    def __init__(self, players: Iterable[Player], leader: Optional[Player] = None, chat: Optional[Chat] = None):
+    def __init__(self, players: Iterable[Player], leader: Optional[Player] = None, chat: Optional[Chat] = None,
+                 outbound: Optional[OutboundQueue] = None):
         self.players = list(players)
         self.leader = leader
 
         self._raw_chat = chat
+        self._outbound = outbound
+
+        # A muted party doesn't send anything (used while a game is being restored)
+        self.muted = False
+
+        self._batch: Optional[MessageBatch] = None
+        self._batch_depth = 0
+
+    @property
+    def chat(self) -> Optional[Chat]:
+        return self._raw_chat
+
+    @property
+    def chat_id(self) -> Optional[int]:
+        if self._raw_chat is not None:
+            return self._raw_chat.id
+        return None
 
     def tell_everyone_raw(self, *args, **kwargs) -> None:
+        if self.muted:
+            return
+
+        # With an outbound queue the messages are only enqueued here and sent concurrently
         for player in self.players:
             player.tell_raw(*args, **kwargs)
 
+    @contextmanager
+    def batch(self) -> Iterator[None]:
+        """
+        Collects the announcements made inside the block and sends them as the fewest possible
+        messages when the outermost block exits.
+        """
+        if self._batch_depth == 0:
+            self._batch = MessageBatch()
+        self._batch_depth += 1
+
+        try:
+            yield
+        finally:
+            self._batch_depth -= 1
+            if self._batch_depth == 0:
+                self._flush_batch()
+                self._batch = None
+
     def announce_raw(self, *args, **kwargs) -> None:
-        if self._raw_chat is not None:
-            self._raw_chat.send_message(*args, **kwargs)
+        if self._batch is None:
+            self._announce(*args, **kwargs)
+        elif len(args) == 1 and 'text' not in kwargs:
+            self._batch.add(args[0], **kwargs)
         else:
+            # Keep the order of messages that can't be batched
+            self._flush_batch()
+            self._announce(*args, **kwargs)
+
+    def _flush_batch(self) -> None:
+        for text, kwargs in self._batch.flush():
+            self._announce(text, **kwargs)
+
+    def _announce(self, *args, **kwargs) -> None:
+        if self.muted:
+            return
+
+        if self._raw_chat is None:
             self.tell_everyone_raw(*args, **kwargs)
+        elif self._outbound is not None:
+            self._outbound.send_message(self._raw_chat.id, *args, **kwargs)
+        else:
+            self._raw_chat.send_message(*args, **kwargs)
+
+    def edit_raw(self, message: Message, text: str, flush: bool = False, **kwargs) -> None:
+        """
+        Edits the text of a message. With an outbound queue, edits of the same message are
+        debounced and only the newest content is sent; pass flush=True to send it right away
+        (e.g. when the game state changes).
+        """
+        if self.muted:
+            return
+
+        if self._outbound is not None:
+            self._outbound.edits.edit(message.chat_id, message.message_id, text, flush, **kwargs)
+        else:
+            message.edit_text(text, **kwargs)
+
+    def answer_raw(self, query: CallbackQuery, *args, **kwargs) -> None:
+        if self.muted:
+            return
+
+        if self._outbound is not None:
+            self._outbound.answer_callback_query(query.id, *args, **kwargs)
+        else:
+            query.answer(*args, **kwargs)
 
 
 class GlobalAPI:
@@ -64,46 +251,263 @@ class GlobalAPI:
 
 
 class Game(ABC):
-    def __init__(self, api: GlobalAPI, party: Party):
+    def __init__(self, api: GlobalAPI, party: Party, game_id: Optional[int] = None, seed: Optional[int] = None):
         self.api = api
         self.party = party
+        self.game_id = game_id
+
+        # Games must draw random numbers from here, so that they can be restored by replaying actions
+        self.random = random.Random(seed)
+
+        # Set by the game manager
+        self.executor: Optional[Executor] = None
+
+        # Set by the game manager once the game is live; restored games get their events from the replay
+        self.post: Optional[Callable[[Action], None]] = None
+
+        # Scheduled once the game manager attaches them to its timing wheel
+        self.deadlines = Deadlines()
+
+    @property
+    def commands(self) -> Iterable[str]:
+        """Names of the commands the game reacts to (used for update routing)."""
+        return []
+
+    @property
+    def callback_prefixes(self) -> Iterable[str]:
+        """Prefixes of the callback data the game reacts to (used for update routing)."""
+        return []
+
+    @property
+    def is_finished(self) -> bool:
+        """Finished games are evicted by the game manager."""
+        return False
+
+    def callback_data(self, code: int, *args: int) -> str:
+        """Callback data for a button that triggers the callback action with the given code (see core.callbacks)."""
+        return encode_callback(self.game_id, code, *args)
+
+    def set_deadline(self, name: str, delay: float) -> None:
+        """Delivers Timeout(name) through handle() in delay seconds, unless the deadline is set again or cancelled."""
+        self.deadlines.set(name, delay)
+
+    def cancel_deadline(self, name: str) -> None:
+        self.deadlines.cancel(name)
+
+    def resume(self) -> None:
+        """Runs in the mailbox of the game when it goes live: once created, restored or loaded back."""
+        pass
+
+    def checksum(self) -> Optional[int]:
+        """
+        A 32-bit checksum of the game state, recorded in traces (see core.trace) after every
+        action, so that replays can tell where they diverge. None if the game doesn't provide one.
+        """
+        return None
+
+    def freeze(self) -> bytes:
+        """
+        Packs the state of the game for a snapshot (see core.snapshot), which thaw() restores
+        into a new instance of the game. The random generator and deadlines are taken care of.
+        """
+        raise GameBotException(f"{type(self).__name__} doesn't support snapshots")
+
+    def thaw(self, data: bytes) -> None:
+        """Restores the state packed by freeze() into a game just created with the same players."""
+        raise GameBotException(f"{type(self).__name__} doesn't support snapshots")
 
     @abstractmethod
-    def handle(self, action: Action) -> Iterable[Callable[[], None]]:
+    def handle(self, action: Action) -> Iterable[Callable[[], Optional[Awaitable]]]:
+        """
+        Returns the callables handling an action. The callables may return awaitables (e.g. be
+        coroutine functions), which are awaited on the Scheduler loop in the async mode.
+        """
         return []
 
+    async def offload(self, fn: Callable, *args) -> Any:
+        """Runs CPU-heavy work in the executor of the game manager, so that the loop stays responsive."""
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            loop = None
+
+        # Outside of the async mode (and while a game is restored) games don't run on the loop
+        if loop is None or self.executor is None:
+            return fn(*args)
+        return await loop.run_in_executor(self.executor, partial(fn, *args))
+
 
 class PTBHandlerGame(Game):
-    def __init__(self, api: GlobalAPI, party: Party):
-        super().__init__(api, party)
+    def __init__(self, api: GlobalAPI, party: Party, game_id: Optional[int] = None, seed: Optional[int] = None):
+        super().__init__(api, party, game_id, seed)
 
         self.groups = defaultdict(list)
 
+        # Dispatch tables built by add_handler. Each entry is ((group, seq), handler), so that
+        # handlers from different tables can be merged in registration order
+        self._command_table: dict[str, list[tuple[tuple[int, int], Handler]]] = defaultdict(list)
+        self._callback_table: dict[str, list[tuple[tuple[int, int], Handler]]] = defaultdict(list)
+        self._opaque_handlers: list[tuple[tuple[int, int], Handler]] = []
+        self._handler_seq = 0
+
+        self._timeout_handlers: dict[str, Callable[[Timeout], Optional[Awaitable]]] = {}
+        self._event_handlers: dict[str, Callable[[Event], Optional[Awaitable]]] = {}
+        self._callback_actions: dict[int, Callable[..., Optional[Awaitable]]] = {}
+
+        self._handle_seconds = HANDLER_SECONDS.labels(f'{type(self).__name__}.handle')
+
     def add_handler(self, handler: Handler, group: int = 0):
         self.groups[group].append(handler)
 
-    def handle(self, action: Action) -> Iterable[Callable[[], None]]:
+        entry = ((group, self._handler_seq), handler)
+        self._handler_seq += 1
+
+        if isinstance(handler, CommandHandler):
+            for command in handler.command:
+                self._command_table[command].append(entry)
+            return
+
+        if isinstance(handler, CallbackQueryHandler):
+            prefix = _get_pattern_prefix(handler.pattern)
+            if prefix is not None:
+                self._callback_table[prefix].append(entry)
+                return
+
+        # Handlers with arbitrary filters can only be checked one by one
+        self._opaque_handlers.append(entry)
+        self._opaque_handlers.sort(key=lambda x: x[0])
+
+    def add_timeout_handler(self, name: str, callback: Callable[[Timeout], Optional[Awaitable]]) -> None:
+        self._timeout_handlers[name] = callback
+
+    def add_event_handler(self, name: str, callback: Callable[[Event], Optional[Awaitable]]) -> None:
+        self._event_handlers[name] = callback
+
+    def add_callback_action(self, code: int, callback: Callable[..., Optional[Awaitable]]) -> None:
+        """
+        Calls callback(update, *args) for button presses with data from callback_data(code, *args).
+        Codes are stored in the buttons sent to players, so they must not change between versions.
+        """
+        self._callback_actions[code] = callback
+
+    @property
+    def commands(self) -> Iterable[str]:
+        return list(self._command_table)
+
+    @property
+    def callback_prefixes(self) -> Iterable[str]:
+        prefixes = list(self._callback_table)
+        if any(isinstance(handler, CallbackQueryHandler) for _, handler in self._opaque_handlers):
+            prefixes.append('')
+        return prefixes
+
+    def handle(self, action: Action) -> Iterable[Callable[[], Optional[Awaitable]]]:
+        if isinstance(action, Timeout):
+            callback = self._timeout_handlers.get(action.name)
+            return [partial(callback, action)] if callback is not None else []
+        if isinstance(action, Event):
+            callback = self._event_handlers.get(action.name)
+            return [partial(callback, action)] if callback is not None else []
         if not isinstance(action, TelegramUpdate):
             raise NotImplementedError()
 
+        start = time.perf_counter()
+        update = action.raw_update
+
+        if update.callback_query is not None and self._callback_actions:
+            decoded = decode_callback(update.callback_query.data)
+            if decoded is not None:
+                game_id, code, args = decoded
+                callback = self._callback_actions.get(code) if game_id == self.game_id else None
+                self._handle_seconds.observe(time.perf_counter() - start)
+                return [partial(callback, action, *args)] if callback is not None else []
+
         callables = []
 
-        for _, handlers in sorted(self.groups.items()):
-            for handler in handlers:
-                check = handler.check_update(action.raw_update)
-                if check is not None and check is not False:
-                    bound_handler = partial(
-                        handler.handle_update,
-                        action.raw_update, action.raw_context.dispatcher, check, action.raw_context)
-                    callables.append(bound_handler)
+        for _, handler in self._get_candidate_handlers(update):
+            check = handler.check_update(update)
+            if check is not None and check is not False:
+                bound_handler = partial(
+                    handler.handle_update,
+                    update, action.raw_context.dispatcher, check, action.raw_context)
+                callables.append(bound_handler)
 
+        self._handle_seconds.observe(time.perf_counter() - start)
         return callables
 
+    def _get_candidate_handlers(self, update: Update) -> list[tuple[tuple[int, int], Handler]]:
+        candidates = []
+
+        if update.callback_query is not None:
+            if self._callback_table:
+                for prefix in iter_callback_prefixes(update.callback_query.data):
+                    candidates.extend(self._callback_table.get(prefix, ()))
+        elif self._command_table:
+            command = get_command(update)
+            if command is not None:
+                candidates.extend(self._command_table.get(command, ()))
+
+        if not candidates:
+            return self._opaque_handlers
+
+        if self._opaque_handlers:
+            candidates.extend(self._opaque_handlers)
+        if len(candidates) > 1:
+            candidates.sort(key=lambda x: x[0])
+        return candidates
+
+
+def _get_pattern_prefix(pattern: Union[str, Pattern, None]) -> Optional[str]:
+    # Extract the literal part of an anchored regex (e.g. '^resistance_vote_' -> 'resistance_vote')
+    if pattern is None or callable(pattern):
+        return None
+    if not isinstance(pattern, str):
+        # Case-insensitive patterns also match data that doesn't start with their literal part
+        if pattern.flags & re.IGNORECASE:
+            return None
+        pattern = pattern.pattern
+    if not pattern.startswith('^') or _has_alternation(pattern):
+        return None
+
+    literal = []
+    exact = False
+    for char in pattern[1:]:
+        if char == '$':
+            exact = True
+            break
+        if not (char.isalnum() or char == CALLBACK_SEPARATOR):
+            # The character before a quantifier may be missing from the data (e.g. '^ab_?cd')
+            if char in '?*{' and literal:
+                literal.pop()
+            break
+        literal.append(char)
+    literal = ''.join(literal)
+
+    # Routing looks prefixes up at separator boundaries, so an open-ended literal has to be
+    # cut back to the last separator
+    if not exact and not literal.endswith(CALLBACK_SEPARATOR):
+        literal = literal.rpartition(CALLBACK_SEPARATOR)[0]
+    return literal.rstrip(CALLBACK_SEPARATOR) or None
+
+
+def _has_alternation(pattern: str) -> bool:
+    # A literal prefix only covers the first branch of an alternation (e.g. '^vote_yes|no'), so such
+    # patterns are checked one by one. Bars in character classes count as well, which is only slower
+    escaped = False
+    for char in pattern:
+        if escaped:
+            escaped = False
+        elif char == '\\':
+            escaped = True
+        elif char == '|':
+            return True
+    return False
+
 
 def ptb_handler(handler):
     @wraps(handler)
     def wrapped_handler(update: Update, context: CallbackContext):
-        return handler(TelegramUpdate(update, context, Player(update.effective_user)))
+        return handler(TelegramUpdate(update, context, player_registry.get(update.effective_user)))
 
     return wrapped_handler
 
@@ -111,6 +515,6 @@ def ptb_handler(handler):
 def ptb_handler_method(handler):
     @wraps(handler)
     def wrapped_handler(self, update: Update, context: CallbackContext):
-        return handler(self, TelegramUpdate(update, context, Player(update.effective_user)))
+        return handler(self, TelegramUpdate(update, context, player_registry.get(update.effective_user)))
 
     return wrapped_handler
\ No newline at end of file
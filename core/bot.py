@@ -1,21 +1,39 @@
 import asyncio
 import logging
+import threading
+import time
+from functools import partial
+from typing import Callable, Optional
 
 from telegram import Update, MessageEntity, Chat
+from telegram.error import TelegramError
 from telegram.ext import Updater, CommandHandler, MessageHandler, Filters, CallbackContext, \
-    TypeHandler, ConversationHandler
+    TypeHandler, ConversationHandler, CallbackQueryHandler
 
-from core.api import TelegramUpdate, Player
+from core.api import TelegramUpdate, player_registry
+from core.exceptions import GameBotException
 from core.gamemanager import GameManager
+from core.ingress import IngressWorker
+from core.metrics import metrics, HANDLER_SECONDS, MetricsServer
+from core.outbound import OutboundQueue
+from core.storage import Storage
+from core.timers import TimingWheel
+from core.trace import TraceWriter
 
 logger = logging.getLogger(__name__)
 
 DISAMBIGUATION = 0
 
+# Long polling timeout and the delay before retrying a failed poll, in seconds
+POLL_TIMEOUT = 10
+POLL_RETRY_DELAY = 5
+
 
 class Scheduler:
     def __init__(self):
         self.loop = asyncio.get_event_loop()
+        self.timers = TimingWheel()
+        self.schedule(self.timers.run)
 
     def run(self) -> None:
         try:
@@ -28,15 +46,35 @@ class Scheduler:
         asyncio.run_coroutine_threadsafe(coro(*args, **kwargs), self.loop)
 
 
+class ChatFreeze:
+    """Put through the dispatcher to freeze the games of a chat after the updates queued before it."""
+
+    def __init__(self, chat_id: int, done: Callable[[list[bytes]], None]):
+        self.chat_id = chat_id
+        self.done = done
+
+
 class Bot:
-    def __init__(self, token: str):
+    """
+    The bot runs PTB's dispatcher for the incoming updates and the Scheduler loop for everything
+    asynchronous (outbound requests, sweeping, game deadlines).
+
+    In the async mode, updates are polled and dispatched on the Scheduler loop, and game actions run
+    there as well instead of on the game threads. Game handlers may then be coroutines, which
+    offload CPU-heavy work with Game.offload.
+    """
+
+    def __init__(self, token: str, storage_path: Optional[str] = None, max_live_games: Optional[int] = None,
+                 metrics_port: Optional[int] = None, async_mode: bool = False, trace_path: Optional[str] = None):
         self.token = token
+        self.async_mode = async_mode
         self.updater = Updater(token=self.token)
 
         d = self.updater.dispatcher
 
         d.add_handler(CommandHandler('start', self._handle_start))
         d.add_handler(CommandHandler('new_game', self._handle_new_game))
+        d.add_handler(CallbackQueryHandler(self._handle_callback_query))
 
         d.add_handler(ConversationHandler(
             entry_points=[MessageHandler(Filters.all, self._handle_message)],
@@ -46,23 +84,52 @@ class Bot:
             fallbacks=[MessageHandler(Filters.all, self._handle_disambiguation_fallback)]
         ))
         d.add_handler(TypeHandler(Update, self._handle_update))
+        d.add_handler(TypeHandler(ChatFreeze, self._handle_chat_freeze))
 
         d.add_error_handler(self._handle_error)
 
-        self.game_manager = GameManager()
         self.scheduler = Scheduler()
+        self.outbound = OutboundQueue(self.updater.bot, self.scheduler.loop)
+        player_registry.outbound = self.outbound
+        self.scheduler.schedule(self.outbound.run)
+
+        self.storage = Storage(storage_path) if storage_path is not None else None
+        self.trace = TraceWriter(trace_path) if trace_path is not None else None
+        self.game_manager = GameManager(self.outbound, self.storage, d, max_live_games=max_live_games,
+                                        loop=self.scheduler.loop if async_mode else None,
+                                        timers=self.scheduler.timers, trace=self.trace)
+        self.scheduler.schedule(self.game_manager.run_sweeper)
+
+        self.ingress: Optional[IngressWorker] = None
+        self.metrics_port = metrics_port
+        self.metrics_server: Optional[MetricsServer] = None
+        self._handle_message_seconds = HANDLER_SECONDS.labels('Bot._handle_message')
+        self._handle_callback_query_seconds = HANDLER_SECONDS.labels('Bot._handle_callback_query')
+        metrics.gauge('gamebot_dispatcher_queue_depth', "Number of updates waiting for the dispatcher.",
+                      callback=lambda: {(): d.update_queue.qsize()})
 
     def run(self) -> None:
-        # Start updater in separate thread
-        self.updater.start_polling()
+        self._open_storage()
+        self._start_metrics_server()
+
+        if self.async_mode:
+            self.scheduler.schedule(self._poll_updates)
+        else:
+            # Start updater in separate thread
+            self.updater.start_polling()
 
         # Run scheduler in the main thread
         try:
             self.scheduler.run()
         finally:
             self.updater.stop()
+            self._close_storage()
+            self._stop_metrics_server()
 
     def run_webhook(self, fqdn: str, ip: str, port: int = 80) -> None:
+        self._open_storage()
+        self._start_metrics_server()
+
         self.updater.start_webhook(ip, port, url_path=self.token)
         self.updater.bot.set_webhook(f'https://{fqdn}/{self.token}')
 
@@ -71,6 +138,101 @@ class Bot:
         finally:
             self.updater.bot.delete_webhook()
             self.updater.stop()
+            self._close_storage()
+            self._stop_metrics_server()
+
+    def run_ingress_worker(self, ingress: IngressWorker) -> None:
+        """Runs the bot as a worker of the webhook ingress (see core.ingress.run_ingress)."""
+        # Games keep their ids when they move between workers, so every worker generates its own
+        self.game_manager.partition_game_ids(ingress.index, ingress.workers)
+        self._open_storage()
+        self._start_metrics_server()
+
+        dispatcher = self.updater.dispatcher
+        dispatcher_thread = None
+        if not self.async_mode:
+            dispatcher_thread = threading.Thread(target=dispatcher.start, name='dispatcher', daemon=True)
+            dispatcher_thread.start()
+        self.ingress = ingress
+        ingress.start(self._deliver_update, self._freeze_chat, self.game_manager.thaw_game,
+                      self.game_manager.chat_ids())
+
+        try:
+            self.scheduler.run()
+        finally:
+            ingress.stop()
+            self.ingress = None
+            if dispatcher_thread is not None:
+                dispatcher.stop()
+                dispatcher_thread.join()
+            self._close_storage()
+            self._stop_metrics_server()
+
+    def migrate_chat(self, chat_id: int, worker: int) -> None:
+        """Moves the games of a group chat to another ingress worker (see IngressWorker.migrate)."""
+        if self.ingress is None:
+            raise GameBotException("Only ingress workers can migrate chats")
+        self.ingress.migrate(chat_id, worker)
+
+    def _deliver_update(self, data: dict) -> None:
+        self._dispatch(Update.de_json(data, self.updater.bot))
+
+    def _freeze_chat(self, chat_id: int, done: Callable[[list[bytes]], None]) -> None:
+        self._dispatch(ChatFreeze(chat_id, done))
+
+    def _dispatch(self, update: object) -> None:
+        if self.async_mode:
+            self.scheduler.loop.call_soon_threadsafe(self.updater.dispatcher.process_update, update)
+        else:
+            self.updater.dispatcher.update_queue.put(update)
+
+    def _open_storage(self) -> None:
+        # Restored games are traced again, so the trace has to be open first
+        if self.trace is not None:
+            self.trace.open()
+
+        # Games have to be registered in the game manager before they can be restored
+        if self.storage is not None:
+            games = self.storage.open()
+            self.game_manager.restore_games(games.values())
+            logger.info("Restored %s game(s)", len(games))
+
+    def _close_storage(self) -> None:
+        if self.storage is not None:
+            self.storage.close()
+        if self.trace is not None:
+            self.trace.close()
+
+    async def _poll_updates(self) -> None:
+        loop = asyncio.get_running_loop()
+        bot = self.updater.bot
+        dispatcher = self.updater.dispatcher
+
+        # Only the blocking long poll leaves the loop; updates are dispatched right here
+        await loop.run_in_executor(None, bot.delete_webhook)
+        offset = None
+        while True:
+            try:
+                updates = await loop.run_in_executor(None, partial(bot.get_updates, offset, timeout=POLL_TIMEOUT))
+            except TelegramError as e:
+                logger.warning("Error while polling for updates", exc_info=e)
+                await asyncio.sleep(POLL_RETRY_DELAY)
+                continue
+
+            for update in updates:
+                offset = update.update_id + 1
+                dispatcher.process_update(update)
+
+    def _start_metrics_server(self) -> None:
+        if self.metrics_port is not None:
+            self.metrics_server = MetricsServer(metrics, self.metrics_port)
+            self.metrics_server.start()
+            logger.info("Serving metrics on port %s", self.metrics_server.port)
+
+    def _stop_metrics_server(self) -> None:
+        if self.metrics_server is not None:
+            self.metrics_server.stop()
+            self.metrics_server = None
 
     @staticmethod
     def _handle_start(update: Update, context: CallbackContext) -> None:
@@ -86,40 +248,43 @@ class Bot:
         leader = update.effective_user
         users.add(leader)
 
+        # TODO: Resolve plain @username mentions, which don't carry the user
         for entity in update.message.entities:
-            if entity.type != MessageEntity.MENTION:
-                pass
-            users.add(entity.user)
+            if entity.type == MessageEntity.TEXT_MENTION:
+                users.add(entity.user)
 
-        if update.effective_chat in [Chat.GROUP, Chat.SUPERGROUP]:
+        if update.effective_chat.type in [Chat.GROUP, Chat.SUPERGROUP]:
             chat = update.effective_chat
         else:
             chat = None
 
-        game = self.game_manager.new_game(game_name, users, leader, chat)
-
-        if 'games' not in context.user_data:
-            context.user_data['games'] = []
-        context.user_data['games'].append(game)
+        self.game_manager.new_game(game_name, users, leader, chat)
 
     def _handle_message(self, update: Update, context: CallbackContext) -> int:
-        sender = Player(update.effective_user)
+        start = time.perf_counter()
+        try:
+            return self._dispatch_message(update, context)
+        finally:
+            self._handle_message_seconds.observe(time.perf_counter() - start)
+
+    def _dispatch_message(self, update: Update, context: CallbackContext) -> int:
+        sender = player_registry.get(update.effective_user)
         tg_update = TelegramUpdate(update, context, sender)
 
         relevant_games = {}
-        for game in context.user_data.get('games', []):
+        for game in self.game_manager.find_games(update):
             handlers = game.handle(tg_update)
             if not handlers:
-                break
+                continue
             relevant_games[game] = handlers
 
         if not relevant_games:
             return ConversationHandler.END
 
         if len(relevant_games) == 1:
-            handlers = next(iter(relevant_games.values()))
-            for handler in handlers:
-                handler()
+            game, handlers = next(iter(relevant_games.items()))
+            self.game_manager.dispatch(game, tg_update, handlers,
+                                       on_error=partial(self.updater.dispatcher.dispatch_error, update))
             return ConversationHandler.END
 
         context.user_data['pending_update'] = tg_update
@@ -129,6 +294,21 @@ class Bot:
 
         return DISAMBIGUATION
 
+    def _handle_callback_query(self, update: Update, context: CallbackContext) -> None:
+        start = time.perf_counter()
+        sender = player_registry.get(update.effective_user)
+        tg_update = TelegramUpdate(update, context, sender)
+
+        # A button belongs to the message of a single game, so there is nothing to disambiguate
+        for game in self.game_manager.find_games(update):
+            handlers = game.handle(tg_update)
+            if handlers:
+                self.game_manager.dispatch(game, tg_update, handlers,
+                                           on_error=partial(self.updater.dispatcher.dispatch_error, update))
+                break
+
+        self._handle_callback_query_seconds.observe(time.perf_counter() - start)
+
     def _handle_disambiguation(self, update: Update, context: CallbackContext) -> None:
         update.message.reply_text("Disambiguation implementation")
 
@@ -138,6 +318,9 @@ class Bot:
     def _handle_update(self, update: Update, context: CallbackContext) -> None:
         update.message.reply_text("Update")
 
+    def _handle_chat_freeze(self, freeze: ChatFreeze, context: CallbackContext) -> None:
+        self.game_manager.freeze_chat(freeze.chat_id).add_done_callback(lambda x: freeze.done(x.result()))
+
     @staticmethod
     def _handle_error(update: Update, context: CallbackContext) -> None:
         logger.error(msg="Exception while handling an update:", exc_info=context.error)
@@ -0,0 +1,60 @@
+import base64
+import binascii
+from typing import Optional
+
+from core.exceptions import GameBotException
+
+# Packed callback data starts with this character, which plain callback data doesn't use
+CALLBACK_MARKER = '~'
+
+# Limit of callback data set by Telegram, in bytes
+MAX_CALLBACK_DATA = 64
+
+
+def encode_callback(game_id: int, code: int, *args: int) -> str:
+    """
+    Packs a game id, the code of a callback action and small non-negative integer arguments
+    into callback data. Every value takes one byte per 7 bits (LEB128), and the bytes are
+    written in URL-safe base64, so that they are valid text.
+    """
+    payload = bytearray()
+    for value in (game_id, code, *args):
+        value = int(value)
+        if value < 0:
+            raise GameBotException("Callback values must be non-negative")
+        while value >= 0x80:
+            payload.append(value & 0x7f | 0x80)
+            value >>= 7
+        payload.append(value)
+
+    data = CALLBACK_MARKER + base64.urlsafe_b64encode(payload).rstrip(b'=').decode('ascii')
+    if len(data) > MAX_CALLBACK_DATA:
+        raise GameBotException(f"Callback data must not exceed {MAX_CALLBACK_DATA} bytes")
+    return data
+
+
+def decode_callback(data: Optional[str]) -> Optional[tuple[int, int, tuple[int, ...]]]:
+    """Returns the game id, action code and arguments packed by encode_callback, or None for other data."""
+    if not data or data[0] != CALLBACK_MARKER:
+        return None
+
+    encoded = data[1:]
+    try:
+        payload = base64.urlsafe_b64decode(encoded + '=' * (-len(encoded) % 4))
+    except (ValueError, binascii.Error):
+        return None
+
+    values = []
+    value = shift = 0
+    for byte in payload:
+        value |= (byte & 0x7f) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            values.append(value)
+            value = shift = 0
+
+    # Truncated values and data without an action code are not ours
+    if shift or len(values) < 2:
+        return None
+    return values[0], values[1], tuple(values[2:])
@@ -1,42 +1,622 @@
-from typing import Callable, Optional, Iterable
+import asyncio
+import inspect
+import logging
+import random
+import threading
+import time
+from collections import OrderedDict, Counter
+from concurrent.futures import Future, ThreadPoolExecutor
+from enum import Enum
+from functools import partial
+from typing import Awaitable, Callable, Optional, Iterable, Union
 
-from telegram import Chat, User
+from telegram import Chat, User, Update
+from telegram.ext import CallbackContext, Dispatcher
 
-from core.api import Game, Party, Player
+from core.api import Game, Party, Action, TelegramUpdate, Timeout, Event, player_registry
 from core.exceptions import GameBotException
+from core.logs import log_context
+from core.mailbox import Mailbox, AsyncMailbox, run_synchronously
+from core.metrics import metrics, HANDLER_SECONDS
+from core.outbound import OutboundQueue
+from core.registry import GameRegistry
+from core.routing import RoutingIndex
+from core.snapshot import GameSnapshot
+from core.storage import Storage, GameState, PlayerState
+from core.timers import TimingWheel
+from core.trace import TraceWriter
+
+logger = logging.getLogger(__name__)
+
+# Games without actions for this many seconds are considered abandoned
+DEFAULT_IDLE_TIMEOUT = 24 * 60 * 60
+
+# Interval between two sweeps of finished and abandoned games, in seconds
+DEFAULT_SWEEP_INTERVAL = 60
+
+# Number of threads running game actions; actions of a game never run concurrently
+DEFAULT_GAME_WORKERS = 8
+
+# Number of stored actions after which a game is stored as its snapshot, which bounds the actions
+# replayed to restore it
+DEFAULT_SNAPSHOT_INTERVAL = 100
+
+
+class Lifecycle(Enum):
+    ACTIVE = 0
+    IDLE = 1
+    FINISHED = 2
+    SPILLED = 3
 
 
 class GameManager:
-    def __init__(self):
-        self._game_ctors = {}
+    def __init__(self, outbound: Optional[OutboundQueue] = None, storage: Optional[Storage] = None,
+                 dispatcher: Optional[Dispatcher] = None, idle_timeout: float = DEFAULT_IDLE_TIMEOUT,
+                 max_live_games: Optional[int] = None, workers: int = DEFAULT_GAME_WORKERS,
+                 loop: Optional[asyncio.AbstractEventLoop] = None, timers: Optional[TimingWheel] = None,
+                 trace: Optional[TraceWriter] = None, snapshot_interval: int = DEFAULT_SNAPSHOT_INTERVAL):
+        if max_live_games is not None and storage is None:
+            raise GameBotException("Limiting the number of live games requires storage")
+
+        self._outbound = outbound
+        self._storage = storage
+        self._dispatcher = dispatcher
+        self._timers = timers
+        self._trace = trace
+
+        self.idle_timeout = idle_timeout
+        self.max_live_games = max_live_games
+        self.snapshot_interval = snapshot_interval
+
+        self.games = GameRegistry()
         self._games = {}
+        self._game_names: dict[int, str] = {}
         self._next_game_id = 0
 
-    def add_game(self, game_name: str, ctor: Callable[[], Game]) -> None:
+        # Game ids are generated from this residue class (see partition_game_ids)
+        self._game_id_offset = 0
+        self._game_id_stride = 1
+
+        self._routes = RoutingIndex()
+
+        # Live games in least recently used order, with the time of their last action.
+        # Spilled games are kept in storage only and are loaded back on their next action
+        self._last_activity: OrderedDict[int, float] = OrderedDict()
+        self._spilled: dict[int, float] = {}
+
+        # Games are spilled from their mailbox, after the actions queued for them (see _spill_game)
+        self._spilling: set[int] = set()
+
+        # Actions stored since the latest snapshot of every game. Games that don't support
+        # snapshots are left out and keep all of their actions
+        self._unsnapshotted: dict[int, int] = {}
+
+        # Games are created and used from the dispatcher threads and swept from the Scheduler loop
+        self._lock = threading.RLock()
+
+        # Actions are run through per-game mailboxes, either on a shared pool or, given a loop, on
+        # the loop itself (the pool is then left for the work games offload)
+        self._loop = loop
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='game')
+        self._mailboxes: dict[int, Union[Mailbox, AsyncMailbox]] = {}
+
+        self._new_game_seconds = HANDLER_SECONDS.labels('GameManager.new_game')
+        metrics.gauge('gamebot_live_games', "Number of games by game type and lifecycle state.", ['game', 'state'],
+                      self._count_games)
+
+    def add_game(self, game_name: str, ctor: Union[Callable[[], Game], str]) -> None:
+        """Registers a game by constructor, or by "module:attribute" spec to import it on first use."""
         # TODO: Find a way to manage global commands and settings
-        self._game_ctors[game_name] = ctor
+        self.games.add(game_name, ctor)
 
     def new_game(self, game_name: str, users: Iterable[User], leader: Optional[User] = None, chat: Optional[Chat] = None) -> Game:
-        if game_name not in self._game_ctors:
-            raise GameBotException(f"No such game: {game_name}")
+        start = time.perf_counter()
+
+        # Imports the game if it's the first of its kind, before other games are held up by the lock
+        self.games.get(game_name)
+
+        users = list(users)
+        seed = random.getrandbits(64)
+
+        with self._lock:
+            game_id = self._generate_game_id()
+            game = self._create_game(game_name, game_id, seed, users, leader, chat)
+
+        if self._storage is not None:
+            state = GameState(game_id, game_name, seed, [u.id for u in users],
+                              leader.id if leader is not None else None,
+                              chat.to_dict() if chat is not None else None)
+            players = {u.id: PlayerState(u.id, u.to_dict()) for u in users + [leader] if u is not None}
+            self._storage.add_game(state, list(players.values()))
+        if self._trace is not None:
+            self._trace.add_game(game_id, game_name, seed, users, leader, chat)
+
+        # Only live games start work that produces actions, which must be stored after the game
+        self._go_live(game)
+        self._spill_excess_games()
+        self._new_game_seconds.observe(time.perf_counter() - start)
+        return game
+
+    def freeze_game(self, game_id: int) -> Future:
+        """
+        Takes a game off the manager and returns a future of its snapshot (see core.snapshot), from
+        which thaw_game resumes the game, e.g. in another worker. The game stops receiving updates
+        right away, and the actions it received before are handled before it's frozen.
+        """
+        game = self.get_game(game_id)
+        if game is None:
+            raise GameBotException(f"No such game: {game_id}")
+
+        with self._lock:
+            self._routes.remove(game_id)
+        return self.submit(game, partial(self._freeze_game, game))
+
+    def thaw_game(self, data: bytes) -> Game:
+        """Resumes a game from a snapshot taken by freeze_game, under the same game id."""
+        snapshot = GameSnapshot.decode(data, self._dispatcher.bot if self._dispatcher is not None else None)
+        self.games.get(snapshot.game_name)
+
+        with self._lock:
+            if snapshot.game_id in self._game_names:
+                raise GameBotException(f"Game {snapshot.game_id} already exists")
+            game = self._create_game(snapshot.game_name, snapshot.game_id, snapshot.seed, snapshot.users,
+                                     snapshot.leader, snapshot.chat, muted=True)
+            snapshot.apply(game)
+            game.party.muted = False
+            self._next_game_id = max(self._next_game_id, snapshot.game_id + 1)
+
+        users, leader = snapshot.users, snapshot.leader
+        if self._storage is not None:
+            state = GameState(snapshot.game_id, snapshot.game_name, snapshot.seed, [u.id for u in users],
+                              leader.id if leader is not None else None,
+                              snapshot.chat.to_dict() if snapshot.chat is not None else None, snapshot=data)
+            players = {u.id: PlayerState(u.id, u.to_dict()) for u in users + [leader] if u is not None}
+            self._storage.add_game(state, list(players.values()))
+        if self._trace is not None:
+            self._trace.add_game(snapshot.game_id, snapshot.game_name, snapshot.seed, users, leader, snapshot.chat,
+                                 data)
+
+        self._go_live(game)
+        self._spill_excess_games()
+        return game
+
+    def freeze_chat(self, chat_id: int) -> Future:
+        """
+        Freezes every game played in a chat (see freeze_game) and returns a future of their
+        snapshots. Games that fail to freeze are logged and left out.
+        """
+        with self._lock:
+            game_ids = sorted(self._routes.games_in_chat(chat_id))
+
+        futures = []
+        for game_id in game_ids:
+            try:
+                futures.append(self.freeze_game(game_id))
+            except GameBotException as e:
+                logger.error("Failed to freeze game %s", game_id, exc_info=e)
+
+        result = Future()
+        snapshots: list[Optional[bytes]] = [None] * len(futures)
+        pending = [len(futures)]
+        lock = threading.Lock()
+
+        def collect(index: int, future: Future) -> None:
+            try:
+                snapshots[index] = future.result()
+            except Exception as e:
+                logger.error("Failed to freeze a game of chat %s", chat_id, exc_info=e)
+            with lock:
+                pending[0] -= 1
+                done = pending[0] == 0
+            if done:
+                result.set_result([x for x in snapshots if x is not None])
+
+        if not futures:
+            result.set_result([])
+        for i, future in enumerate(futures):
+            future.add_done_callback(partial(collect, i))
+        return result
+
+    def chat_ids(self) -> list[int]:
+        """Ids of the chats with live or spilled games."""
+        with self._lock:
+            return self._routes.chat_ids()
+
+    def partition_game_ids(self, offset: int, stride: int) -> None:
+        """
+        Generates only game ids equal to offset modulo stride, so that managers given different
+        offsets never share a game id and games can move between them under the same id.
+        """
+        self._game_id_offset = offset
+        self._game_id_stride = stride
+
+    def end_game(self, game_id: int) -> None:
+        with self._lock:
+            self._routes.remove(game_id)
+            self._last_activity.pop(game_id, None)
+            self._game_names.pop(game_id, None)
+            self._mailboxes.pop(game_id, None)
+            self._unsnapshotted.pop(game_id, None)
+            game = self._games.pop(game_id, None)
+            stored = game is not None or self._spilled.pop(game_id, None) is not None
+
+        if game is not None:
+            game.deadlines.pause()
+
+        if stored and self._storage is not None:
+            self._storage.remove_game(game_id)
+
+    def get_game(self, game_id: int) -> Optional[Game]:
+        with self._lock:
+            game = self._games.get(game_id)
+            if game is None and game_id in self._spilled:
+                game = self._load_spilled_game(game_id)
+        return game
+
+    def get_game_name(self, game_id: int) -> Optional[str]:
+        return self._game_names.get(game_id)
+
+    def get_status(self, game_id: int) -> Optional[Lifecycle]:
+        with self._lock:
+            if game_id in self._spilled:
+                return Lifecycle.SPILLED
+            game = self._games.get(game_id)
+            if game is None:
+                return None
+            if game.is_finished:
+                return Lifecycle.FINISHED
+            if time.monotonic() - self._last_activity[game_id] > self.idle_timeout:
+                return Lifecycle.IDLE
+            return Lifecycle.ACTIVE
+
+    def find_games(self, update: Update) -> list[Game]:
+        with self._lock:
+            game_ids = sorted(self._routes.candidates(update))
+        return [game for game in map(self.get_game, game_ids) if game is not None]
+
+    def submit(self, game: Game, fn: Callable[[], object]) -> Future:
+        """Runs a function in the mailbox of a game, after everything submitted for the game before it."""
+        with self._lock:
+            mailbox = self._mailboxes.get(game.game_id)
+            if mailbox is None:
+                if self._loop is not None:
+                    mailbox = AsyncMailbox(self._loop)
+                else:
+                    mailbox = Mailbox(self._executor)
+                self._mailboxes[game.game_id] = mailbox
+        return mailbox.submit(fn)
+
+    def dispatch(self, game: Game, action: Action, handlers: Iterable[Callable[[], Optional[Awaitable]]],
+                 on_error: Optional[Callable[[Exception], None]] = None) -> Future:
+        """Runs the handlers of an action in the mailbox of the game and records the action."""
+        # Games with input waiting in their mailbox are the last to be spilled
+        if isinstance(action, TelegramUpdate):
+            self._touch(game.game_id)
+        return self.submit(game, partial(self._run_action, game, action, handlers, on_error))
+
+    def post(self, game_id: int, action: Action) -> None:
+        """Delivers an action a game posted to itself (see Game.post) through the mailbox of the game."""
+        game = self.get_game(game_id)
+        if game is not None:
+            self.submit(game, partial(self._handle_own_action, game, action))
 
-        players = [Player(u) for u in users]
-        party = Party(players, Player(leader), chat)
+    def record_action(self, game: Game, action: Action) -> None:
+        # Only player input counts as activity, so that games kept going by their own deadlines are evicted
+        if isinstance(action, TelegramUpdate):
+            self._touch(game.game_id)
 
-        game_id = self._generate_game_id()
-        game_ctor = self._game_ctors[game_name]
+        if self._storage is not None:
+            if isinstance(action, TelegramUpdate):
+                self._storage.add_action(game.game_id, action.raw_update)
+            elif isinstance(action, (Timeout, Event)):
+                self._storage.add_action(game.game_id, action)
+            else:
+                return
+            if game.game_id in self._unsnapshotted:
+                self._unsnapshotted[game.game_id] += 1
+
+    def _touch(self, game_id: int) -> None:
+        with self._lock:
+            if game_id in self._last_activity:
+                self._last_activity[game_id] = time.monotonic()
+                self._last_activity.move_to_end(game_id)
+
+    def restore_games(self, states: Iterable[GameState]) -> None:
+        """Recreates stored games from their latest snapshot and the actions after it, with the output muted."""
+        with self._lock:
+            for state in states:
+                self._restore_game(state)
+                self._next_game_id = max(self._next_game_id, state.game_id + 1)
+
+        self._spill_excess_games()
+
+    def sweep(self) -> None:
+        """Evicts finished and abandoned games."""
+        now = time.monotonic()
+        with self._lock:
+            finished = [game_id for game_id, game in self._games.items() if game.is_finished]
+            idle = [game_id for game_id, last_activity in self._last_activity.items()
+                    if now - last_activity > self.idle_timeout]
+            idle += [game_id for game_id, last_activity in self._spilled.items()
+                     if now - last_activity > self.idle_timeout]
+
+        for game_id in set(finished + idle):
+            self.end_game(game_id)
+
+        if finished or idle:
+            logger.info("Swept %s finished and %s idle game(s)", len(finished), len(idle))
+
+    async def run_sweeper(self, interval: float = DEFAULT_SWEEP_INTERVAL) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                self.sweep()
+            except Exception as e:
+                logger.error("Error while sweeping games", exc_info=e)
+
+    async def _run_action(self, game: Game, action: Action, handlers: Iterable[Callable[[], Optional[Awaitable]]],
+                          on_error: Optional[Callable[[Exception], None]]) -> None:
+        # Runs in the mailbox of the game, so actions are recorded in the order they are applied.
+        # The game may have been spilled or ended since the action was dispatched; spilled games
+        # are loaded back, with every action recorded so far, and the action is handled by them
+        current = self.get_game(game.game_id)
+        if current is None:
+            return
+        if current is not game:
+            game, handlers = current, current.handle(action)
+
+        self.record_action(game, action)
+
+        sender = getattr(action, 'sender', None)
+        with log_context(game_id=game.game_id, game_type=self._game_names.get(game.game_id),
+                         player_id=sender.id if sender is not None else None):
+            for handler in handlers:
+                try:
+                    result = handler()
+                    if inspect.isawaitable(result):
+                        await result
+                except Exception as e:
+                    if on_error is None:
+                        logger.error("Error while handling an action", exc_info=e)
+                    else:
+                        on_error(e)
+                    break
+
+        # Traces carry the state the action left the game in, for replays to compare against
+        if self._trace is not None:
+            self._trace.add_action(game.game_id, action, game.checksum())
+
+        if self._unsnapshotted.get(game.game_id, 0) >= self.snapshot_interval and not game.is_finished:
+            self._store_snapshot(game)
+
+    def _store_snapshot(self, game: Game) -> None:
+        # Runs in the mailbox of the game, between two actions
+        game_id = game.game_id
+        game_name = self._game_names[game_id]
+        try:
+            snapshot = GameSnapshot.capture(game, game_name)
+        except GameBotException:
+            # The game doesn't support snapshots
+            self._unsnapshotted.pop(game_id, None)
+            return
+
+        data = snapshot.encode()
+        self._storage.add_snapshot(game_id, data)
+        self._unsnapshotted[game_id] = 0
+
+        # The random generator of the game was reseeded, so replays start over from the snapshot
+        if self._trace is not None:
+            self._trace.add_game(game_id, game_name, snapshot.seed, snapshot.users, snapshot.leader, snapshot.chat,
+                                 data)
+
+    def _freeze_game(self, game: Game) -> bytes:
+        # Runs in the mailbox of the game, after the actions it received before it was taken off
+        game_id = game.game_id
+        game.deadlines.pause()
+        game.post = None
+        data = GameSnapshot.capture(game, self._game_names[game_id]).encode()
+
+        with self._lock:
+            self._games.pop(game_id, None)
+            self._game_names.pop(game_id, None)
+            self._last_activity.pop(game_id, None)
+            self._mailboxes.pop(game_id, None)
+            self._unsnapshotted.pop(game_id, None)
+        if self._storage is not None:
+            self._storage.remove_game(game_id)
+        return data
+
+    def _on_deadline(self, game_id: int, name: str, generation: int) -> None:
+        # Deadlines of spilled games are cancelled, and set again when they are loaded back
+        with self._lock:
+            game = self._games.get(game_id)
+        if game is not None:
+            self.submit(game, partial(self._expire_deadline, game, name, generation))
+
+    def _expire_deadline(self, game: Game, name: str, generation: int) -> Optional[Awaitable]:
+        # The deadline may have been set again or cancelled by an action handled after the timer fired
+        if not game.deadlines.expire(name, generation):
+            return None
+        return self._handle_own_action(game, Timeout(name))
+
+    def _handle_own_action(self, game: Game, action: Action) -> Awaitable:
+        return self._run_action(game, action, game.handle(action), None)
+
+    def _count_games(self) -> dict[tuple[str, str], int]:
+        counts = Counter()
+        with self._lock:
+            for game_id, game_name in self._game_names.items():
+                status = self.get_status(game_id)
+                if status is not None:
+                    counts[game_name, status.name.lower()] += 1
+        return dict(counts)
+
+    def _spill_excess_games(self) -> None:
+        if self.max_live_games is None:
+            return
+
+        # The least recently used games are spilled once the actions queued for them are handled
+        with self._lock:
+            excess = len(self._games) - len(self._spilling) - self.max_live_games
+            games = []
+            for game_id in self._last_activity:
+                if len(games) >= excess:
+                    break
+                if game_id not in self._spilling:
+                    self._spilling.add(game_id)
+                    games.append(self._games[game_id])
+
+        for game in games:
+            self.submit(game, partial(self._spill_game, game))
+
+    def _spill_game(self, game: Game) -> None:
+        # Runs in the mailbox of the game. Games that received input meanwhile are kept, and other
+        # games are spilled instead if there are still too many
+        game_id = game.game_id
+        with self._lock:
+            self._spilling.discard(game_id)
+            if self._games.get(game_id) is not game or len(self._games) <= self.max_live_games:
+                return
+            mailbox = self._mailboxes.get(game_id)
+            busy = mailbox is not None and len(mailbox) > 0
+            if not busy:
+                self._games.pop(game_id)
+                self._spilled[game_id] = self._last_activity.pop(game_id)
+                game.deadlines.pause()
+
+        if busy:
+            self._spill_excess_games()
+
+    def _load_spilled_game(self, game_id: int) -> Optional[Game]:
+        last_activity = self._spilled.pop(game_id)
+        try:
+            state = self._storage.load_game(game_id)
+        except GameBotException:
+            # The game stays spilled, to be loaded by a later action
+            self._spilled[game_id] = last_activity
+            raise
+        if state is None:
+            self._routes.remove(game_id)
+            self._game_names.pop(game_id, None)
+            return None
+
+        game = self._restore_game(state)
+        if game is not None:
+            self._last_activity[game_id] = last_activity
+            self._spill_excess_games()
+        return game
+
+    def _restore_game(self, state: GameState) -> Optional[Game]:
+        bot = self._dispatcher.bot
+
+        users = {}
+        for user_id in state.player_ids + [state.leader_id]:
+            player = self._storage.get_player(user_id) if user_id is not None else None
+            if player is not None:
+                users[user_id] = User.de_json(player.user, bot)
+
+        chat = Chat.de_json(state.chat, bot) if state.chat is not None else None
+        try:
+            game = self._create_game(state.game_name, state.game_id, state.seed,
+                                     [users[x] for x in state.player_ids], users.get(state.leader_id), chat,
+                                     muted=True)
+        except Exception as e:
+            logger.warning("Failed to restore game %s", state.game_id, exc_info=e)
+            self._routes.remove(state.game_id)
+            self._game_names.pop(state.game_id, None)
+            return None
+
+        if state.snapshot is not None:
+            GameSnapshot.decode(state.snapshot, bot).apply(game)
+        if self._trace is not None:
+            self._trace.add_game(state.game_id, state.game_name, state.seed, [users[x] for x in state.player_ids],
+                                 users.get(state.leader_id), chat, state.snapshot)
+
+        for data in state.actions:
+            action = decode_action(data, self._dispatcher)
+            with log_context(game_id=state.game_id, game_type=state.game_name,
+                             player_id=action.sender.id if action.sender is not None else None):
+                replay_action(game, action)
+            if self._trace is not None:
+                self._trace.add_action(state.game_id, action, game.checksum())
+
+        self._unsnapshotted[state.game_id] = len(state.actions)
+        game.party.muted = False
+        self._go_live(game)
+        return game
+
+    def _create_game(self, game_name: str, game_id: int, seed: int, users: list[User], leader: Optional[User],
+                     chat: Optional[Chat], muted: bool = False) -> Game:
+        players = [player_registry.get(u) for u in users]
+        party = Party(players, player_registry.get(leader), chat, self._outbound)
+        party.muted = muted
+
+        game_ctor = self.games.get(game_name)
 
         # TODO: Pass API object to game constructor
-        # TODO: Pass Game ID to game constructor
-        game = game_ctor(None, party)
+        with log_context(game_id=game_id, game_type=game_name):
+            game = game_ctor(None, party, game_id, seed)
+
+        # Restored games are replayed synchronously, work they offload included, and their
+        # deadlines are only set once they are caught up
+        if self._timers is not None:
+            game.deadlines.attach(self._timers, partial(self._on_deadline, game_id))
         self._games[game_id] = game
+        self._game_names[game_id] = game_name
+        self._last_activity[game_id] = time.monotonic()
+        self._unsnapshotted[game_id] = 0
+        if game_id not in self._routes:
+            self._add_routes(game_id, game)
 
-        # TODO: Initialize game and player state
-        
         return game
 
+    def _go_live(self, game: Game) -> None:
+        game.executor = self._executor
+        game.post = partial(self.post, game.game_id)
+        game.deadlines.resume()
+        self.submit(game, partial(self._resume_game, game))
+
+    def _resume_game(self, game: Game) -> None:
+        with log_context(game_id=game.game_id, game_type=self._game_names.get(game.game_id)):
+            game.resume()
+
+    def _add_routes(self, game_id: int, game: Game) -> None:
+        user_ids = [player.id for player in game.party.players]
+
+        # Private parties are played in private chats with the bot, whose ids match user ids
+        if game.party.chat_id is not None:
+            chat_ids = [game.party.chat_id]
+        else:
+            chat_ids = user_ids
+
+        self._routes.add(game_id, chat_ids=chat_ids, user_ids=user_ids,
+                         commands=game.commands, callback_prefixes=game.callback_prefixes)
+
     def _generate_game_id(self) -> int:
         # TODO: More sophisticated game ID generation logic
-        game_id = self._next_game_id
-        self._next_game_id += 1
+        game_id = self._next_game_id + (self._game_id_offset - self._next_game_id) % self._game_id_stride
+        self._next_game_id = game_id + 1
         return game_id
+
+
+def decode_action(data: dict, dispatcher: Dispatcher) -> Action:
+    """Decodes an action recorded by the storage (or a trace, see core.trace)."""
+    if 'timeout' in data:
+        return Timeout(data['timeout'])
+    if 'event' in data:
+        return Event(data['event'], data['payload'])
+    update = Update.de_json(data, dispatcher.bot)
+    return TelegramUpdate(update, CallbackContext.from_update(update, dispatcher),
+                          player_registry.get(update.effective_user))
+
+
+def replay_action(game: Game, action: Action) -> None:
+    """Handles a recorded action synchronously, work the game offloads included."""
+    for handler in game.handle(action):
+        try:
+            result = handler()
+            if inspect.isawaitable(result):
+                run_synchronously(result)
+        except Exception:
+            # The action failed the same way when it was first handled
+            pass
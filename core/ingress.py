@@ -0,0 +1,368 @@
+import bisect
+import hashlib
+import json
+import logging
+import multiprocessing
+import socket
+import threading
+from collections import deque
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Any, Callable, Iterable, Optional
+
+import telegram
+
+from core.exceptions import GameBotException
+from core.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Telegram redelivers an update until it is acknowledged; ids seen among this many latest
+# updates of a worker are dropped
+DEFAULT_WINDOW_SIZE = 10000
+
+# Points per worker on the hash ring; more points spread the chats more evenly
+RING_REPLICAS = 64
+
+# Updates from private chats (and those without a chat) all go to this worker, since the games
+# they belong to can't be told from the update alone
+HOME_WORKER = 0
+
+GROUP_CHAT_TYPES = frozenset({telegram.Chat.GROUP, telegram.Chat.SUPERGROUP, telegram.Chat.CHANNEL})
+
+# Fields of an update that carry a message, in the Bot API JSON
+MESSAGE_FIELDS = ('message', 'edited_message', 'channel_post', 'edited_channel_post')
+
+INGRESS_UPDATES = metrics.counter(
+    'gamebot_ingress_updates_total', "Updates received by the webhook ingress, by what happened to them.",
+    ['outcome'])
+
+# A chat moved away from its worker on the hash ring, as (worker, version). Later moves of a chat
+# have higher versions, so that messages arriving out of order don't undo them
+ChatOwner = tuple[int, int]
+
+
+class UpdateWindow:
+    """Remembers the latest update ids, to drop redelivered updates."""
+
+    def __init__(self, size: int = DEFAULT_WINDOW_SIZE):
+        self.size = size
+
+        self._ids: set[int] = set()
+        self._order: deque[int] = deque()
+
+    def add(self, update_id: int) -> bool:
+        """Returns False if the update has already been seen."""
+        if update_id in self._ids:
+            return False
+
+        self._ids.add(update_id)
+        self._order.append(update_id)
+        if len(self._order) > self.size:
+            self._ids.discard(self._order.popleft())
+        return True
+
+
+class HashRing:
+    """
+    Consistent hashing of chat ids onto workers.
+
+    Every worker owns RING_REPLICAS points of the ring and a key belongs to the worker owning the
+    first point after its hash, so changing the number of workers only moves the chats of the
+    points that changed hands.
+    """
+
+    def __init__(self, workers: int, replicas: int = RING_REPLICAS):
+        points = sorted((self._hash(f'{worker}:{i}'), worker) for worker in range(workers) for i in range(replicas))
+        self._hashes = [x[0] for x in points]
+        self._workers = [x[1] for x in points]
+
+    def get(self, key: int) -> int:
+        idx = bisect.bisect(self._hashes, self._hash(str(key))) % len(self._hashes)
+        return self._workers[idx]
+
+    @staticmethod
+    def _hash(key: str) -> int:
+        return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'big')
+
+
+def get_route_key(data: dict) -> Optional[int]:
+    """Returns the id of the group chat of a raw update, or None if it isn't from a group chat."""
+    message = None
+    for field in MESSAGE_FIELDS:
+        message = data.get(field)
+        if message is not None:
+            break
+    else:
+        query = data.get('callback_query')
+        if query is not None:
+            message = query.get('message')
+
+    chat = message.get('chat') if message is not None else None
+    if chat is None or chat.get('type') not in GROUP_CHAT_TYPES:
+        return None
+    return chat['id']
+
+
+class _ReusePortServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def server_bind(self) -> None:
+        # Every worker binds the same port and the kernel spreads the connections between them
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
+
+
+class IngressWorker:
+    """
+    The webhook ingress of one worker process.
+
+    Updates are accepted on the shared port and acknowledged right away, then forwarded to the
+    inbox of the worker owning their chat. Each worker consumes its own inbox on a background
+    thread, drops redelivered updates and hands the rest to deliver().
+
+    The games of a group chat can be moved to another worker with migrate(), e.g. to take load
+    off a busy worker. The current owner freezes the games, holding back the updates of the
+    chat meanwhile, and sends their snapshots to the new owner, which thaws them. The chat is
+    then routed to the new owner by every worker, and the held updates are forwarded to it.
+    Inboxes carry these messages as tuples, next to the updates themselves (dicts):
+
+    - ('migrate', chat_id, worker): moves the games of the chat to the worker
+    - ('frozen', chat_id, worker, snapshots): the games of the chat have been frozen
+    - ('thaw', chat_id, snapshots, version): resumes the games, whose chat now belongs here
+    - ('route', chat_id, worker, version): the chat now belongs to the worker
+    """
+
+    def __init__(self, index: int, inboxes: list[multiprocessing.Queue], host: str, port: int, path: str,
+                 window_size: int = DEFAULT_WINDOW_SIZE):
+        if not hasattr(socket, 'SO_REUSEPORT'):
+            raise GameBotException("The webhook ingress requires SO_REUSEPORT")
+
+        self.index = index
+        self._inboxes = inboxes
+        self._ring = HashRing(len(inboxes))
+        self._window = UpdateWindow(window_size)
+
+        # Chats moved off their worker on the ring. Written by the inbox thread only
+        self._overrides: dict[int, ChatOwner] = {}
+
+        # Updates of the chats being moved away, held until the games have been frozen
+        self._held: dict[int, list[dict]] = {}
+
+        self._freeze_chat: Optional[Callable[[int, Callable[[list[bytes]], None]], None]] = None
+        self._thaw_game: Optional[Callable[[bytes], Any]] = None
+
+        route = self._route
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self) -> None:
+                if self.path != f'/{path}':
+                    self.send_error(404)
+                    return
+
+                try:
+                    data = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+                    update_id = data['update_id']
+                except (ValueError, TypeError, KeyError):
+                    self.send_error(400)
+                    return
+
+                # Telegram only waits for the acknowledgement; the update is handled later
+                self.send_response(200)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                route(update_id, data)
+
+            def log_message(self, format: str, *args) -> None:
+                logger.debug(format, *args)
+
+        self._server = _ReusePortServer((host, port), Handler)
+        self._server_thread: Optional[threading.Thread] = None
+        self._inbox_thread: Optional[threading.Thread] = None
+
+    @property
+    def workers(self) -> int:
+        return len(self._inboxes)
+
+    def start(self, deliver: Callable[[dict], None],
+              freeze_chat: Optional[Callable[[int, Callable[[list[bytes]], None]], None]] = None,
+              thaw_game: Optional[Callable[[bytes], Any]] = None, chat_ids: Iterable[int] = ()) -> None:
+        """
+        Starts serving updates, which are passed to deliver(). Migrating chats requires
+        freeze_chat(chat_id, done), which freezes the games of the chat after the updates
+        delivered before and passes their snapshots to done(), and thaw_game(snapshot).
+
+        chat_ids are those of the games restored by the worker. Chats that were moved here
+        are claimed from the other workers again.
+        """
+        self._freeze_chat = freeze_chat
+        self._thaw_game = thaw_game
+
+        # Group chats have negative ids, private chats are never moved
+        for chat_id in chat_ids:
+            if chat_id < 0 and self._ring.get(chat_id) != self.index:
+                self._overrides[chat_id] = (self.index, 0)
+                self._broadcast(('route', chat_id, self.index, 0))
+
+        self._inbox_thread = threading.Thread(target=self._consume, args=(deliver,), name='inbox', daemon=True)
+        self._inbox_thread.start()
+        self._server_thread = threading.Thread(target=self._server.serve_forever, name='ingress', daemon=True)
+        self._server_thread.start()
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+        if self._server_thread is not None:
+            self._server_thread.join()
+            self._server_thread = None
+
+        if self._inbox_thread is not None:
+            self._inboxes[self.index].put(None)
+            self._inbox_thread.join()
+            self._inbox_thread = None
+
+    def migrate(self, chat_id: int, worker: int) -> None:
+        """Moves the games of a group chat to the worker, from whichever worker owns them."""
+        if not 0 <= worker < len(self._inboxes):
+            raise GameBotException(f"No such worker: {worker}")
+        self._inboxes[self._owner(chat_id)].put(('migrate', chat_id, worker))
+
+    def _owner(self, chat_id: int) -> int:
+        override = self._overrides.get(chat_id)
+        return override[0] if override is not None else self._ring.get(chat_id)
+
+    def _set_owner(self, chat_id: int, worker: int, version: int) -> None:
+        override = self._overrides.get(chat_id)
+        if override is None or version > override[1]:
+            self._overrides[chat_id] = (worker, version)
+
+    def _broadcast(self, message: tuple, exclude: Iterable[int] = ()) -> None:
+        for i, inbox in enumerate(self._inboxes):
+            if i != self.index and i not in exclude:
+                inbox.put(message)
+
+    def _route(self, update_id: int, data: dict) -> None:
+        key = get_route_key(data)
+        owner = self._owner(key) if key is not None else HOME_WORKER
+        INGRESS_UPDATES.labels('forwarded' if owner != self.index else 'local').inc()
+        self._inboxes[owner].put(data)
+
+    def _consume(self, deliver: Callable[[dict], None]) -> None:
+        inbox = self._inboxes[self.index]
+        while True:
+            data = inbox.get()
+            if data is None:
+                return
+
+            if isinstance(data, tuple):
+                try:
+                    self._handle_message(data)
+                except Exception as e:
+                    logger.error("Error while handling the ingress message %s", data[0], exc_info=e)
+                continue
+
+            # Updates routed before their chat moved (or was held while it moved) go on to the owner
+            key = get_route_key(data)
+            if key is not None:
+                held = self._held.get(key)
+                if held is not None:
+                    held.append(data)
+                    continue
+                owner = self._owner(key)
+                if owner != self.index:
+                    INGRESS_UPDATES.labels('rerouted').inc()
+                    self._inboxes[owner].put(data)
+                    continue
+
+            # Redeliveries may have been accepted by any worker, but they all end up here
+            if not self._window.add(data['update_id']):
+                INGRESS_UPDATES.labels('duplicate').inc()
+                continue
+            try:
+                deliver(data)
+            except Exception as e:
+                logger.error("Error while delivering an update", exc_info=e)
+
+    def _handle_message(self, message: tuple) -> None:
+        kind, chat_id = message[:2]
+        if kind == 'migrate':
+            worker = message[2]
+            owner = self._owner(chat_id)
+            if owner != self.index:
+                self._inboxes[owner].put(message)
+                return
+            if worker == self.index or chat_id in self._held:
+                return
+            if self._freeze_chat is None:
+                raise GameBotException("This worker can't migrate chats")
+
+            logger.info("Moving the games of chat %s to worker %s", chat_id, worker)
+            self._held[chat_id] = []
+            inbox = self._inboxes[self.index]
+            self._freeze_chat(chat_id, lambda snapshots: inbox.put(('frozen', chat_id, worker, snapshots)))
+
+        elif kind == 'frozen':
+            worker, snapshots = message[2:]
+            override = self._overrides.get(chat_id)
+            version = override[1] + 1 if override is not None else 1
+
+            # The new owner thaws the games before it gets the updates forwarded to it
+            self._inboxes[worker].put(('thaw', chat_id, snapshots, version))
+            self._overrides[chat_id] = (worker, version)
+            self._broadcast(('route', chat_id, worker, version), exclude=(worker,))
+            for data in self._held.pop(chat_id):
+                self._inboxes[worker].put(data)
+            logger.info("Moved %s game(s) of chat %s to worker %s", len(snapshots), chat_id, worker)
+
+        elif kind == 'thaw':
+            snapshots, version = message[2:]
+            for snapshot in snapshots:
+                try:
+                    self._thaw_game(snapshot)
+                except Exception as e:
+                    logger.error("Failed to thaw a game of chat %s", chat_id, exc_info=e)
+            self._set_owner(chat_id, self.index, version)
+
+        elif kind == 'route':
+            worker, version = message[2:]
+            self._set_owner(chat_id, worker, version)
+
+
+def _run_worker(bot_factory: Callable[[int], Any], index: int, inboxes: list[multiprocessing.Queue], host: str,
+                port: int, path: str, window_size: int) -> None:
+    bot = bot_factory(index)
+    bot.run_ingress_worker(IngressWorker(index, inboxes, host, port, path, window_size))
+
+
+def run_ingress(bot_factory: Callable[[int], Any], token: str, fqdn: str, ip: str, port: int = 80,
+                workers: Optional[int] = None, window_size: int = DEFAULT_WINDOW_SIZE) -> None:
+    """
+    Runs the bot as a webhook served by several worker processes sharing the port.
+
+    bot_factory(index) creates the Bot of a worker, with its games registered; it is called in
+    the worker process, so it has to be a module-level function. Every worker owns the games of
+    the group chats hashed to it, unless they were moved (see IngressWorker.migrate), and all
+    private chats are owned by one of them.
+    """
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+
+    # Workers are spawned rather than forked, so that they don't inherit the threads of the parent
+    context = multiprocessing.get_context('spawn')
+    inboxes = [context.Queue() for _ in range(workers)]
+    processes = [context.Process(target=_run_worker, args=(bot_factory, i, inboxes, ip, port, token, window_size),
+                                 name=f'worker{i}')
+                 for i in range(workers)]
+    for process in processes:
+        process.start()
+
+    bot = telegram.Bot(token)
+    bot.set_webhook(f'https://{fqdn}/{token}')
+    logger.info("Serving the webhook with %s worker(s) on port %s", workers, port)
+
+    try:
+        for process in processes:
+            process.join()
+    finally:
+        bot.delete_webhook()
+        for process in processes:
+            process.join()
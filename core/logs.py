@@ -0,0 +1,173 @@
+import atexit
+import logging
+import queue
+import random
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from logging.handlers import QueueHandler, QueueListener
+from typing import Iterator, Optional
+
+from core.metrics import metrics
+from core.outbound import TokenBucket
+
+# Records waiting to be written beyond this number are dropped rather than blocking the caller
+DEFAULT_QUEUE_SIZE = 10000
+
+DEFAULT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+# Fields attached to every record; they are None outside of a game
+CONTEXT_FIELDS = ('game_id', 'game_type', 'player_id')
+
+_context: dict[str, ContextVar] = {field: ContextVar(field, default=None) for field in CONTEXT_FIELDS}
+
+LOG_DROPPED = metrics.counter(
+    'gamebot_log_records_dropped_total', "Log records dropped by sampling, rate caps or a full queue.", ['reason'])
+
+
+@contextmanager
+def log_context(**fields) -> Iterator[None]:
+    """Attaches the given fields (game_id, game_type, player_id) to the records logged inside the block."""
+    tokens = [(_context[k], _context[k].set(v)) for k, v in fields.items() if v is not None]
+    try:
+        yield
+    finally:
+        for var, token in reversed(tokens):
+            var.reset(token)
+
+
+class ContextFilter(logging.Filter):
+    def filter(self, record: logging.LogRecord) -> bool:
+        # Fields passed explicitly with extra= take precedence
+        for field, var in _context.items():
+            if not hasattr(record, field):
+                setattr(record, field, var.get())
+        return True
+
+
+class LoggerPolicy:
+    """
+    Limits the records below WARNING emitted by a logger and its children: only a random
+    sample_rate fraction of them is kept, and at most max_per_second of those.
+    """
+
+    def __init__(self, sample_rate: float = 1.0, max_per_second: Optional[float] = None):
+        self.sample_rate = sample_rate
+        self.max_per_second = max_per_second
+
+        self._bucket = TokenBucket(max_per_second, max(1, int(max_per_second))) if max_per_second else None
+        self._lock = threading.Lock()
+
+    def admit(self) -> Optional[str]:
+        """Returns the reason to drop a record, or None to keep it."""
+        if self.sample_rate < 1 and random.random() >= self.sample_rate:
+            return 'sampled'
+
+        if self._bucket is not None:
+            now = time.monotonic()
+            with self._lock:
+                if self._bucket.delay(now) > 0:
+                    return 'rate_capped'
+                self._bucket.consume(now)
+        return None
+
+
+class SamplingFilter(logging.Filter):
+    def __init__(self, policies: dict[str, LoggerPolicy]):
+        super().__init__()
+        self.policies = policies
+
+        self._resolved: dict[str, Optional[LoggerPolicy]] = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+
+        policy = self._get_policy(record.name)
+        if policy is None:
+            return True
+
+        reason = policy.admit()
+        if reason is not None:
+            LOG_DROPPED.labels(reason).inc()
+            return False
+        return True
+
+    def _get_policy(self, name: str) -> Optional[LoggerPolicy]:
+        try:
+            return self._resolved[name]
+        except KeyError:
+            pass
+
+        # The policy of the closest configured ancestor applies, like logger levels do
+        policy, candidate = None, name
+        while candidate:
+            policy = self.policies.get(candidate)
+            if policy is not None:
+                break
+            candidate = candidate.rpartition('.')[0]
+
+        self._resolved[name] = policy
+        return policy
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """Hands records to a bounded queue and drops them when the queue is full."""
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOG_DROPPED.labels('queue_full').inc()
+
+
+class _Listener(QueueListener):
+    def stop(self) -> None:
+        # Also called at exit, possibly after an explicit stop
+        if self._thread is not None:
+            super().stop()
+
+    def enqueue_sentinel(self) -> None:
+        # The sentinel must not be dropped, or stop() would wait forever
+        self.queue.put(self._sentinel)
+
+
+class StructuredFormatter(logging.Formatter):
+    """Appends the context fields of a record as key=value pairs."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        text = super().format(record)
+        fields = ' '.join(f'{field}={getattr(record, field)}' for field in CONTEXT_FIELDS
+                          if getattr(record, field, None) is not None)
+        return f'{text} [{fields}]' if fields else text
+
+
+def setup_logging(level: int = logging.INFO, handlers: Optional[list[logging.Handler]] = None,
+                  policies: Optional[dict[str, LoggerPolicy]] = None,
+                  queue_size: int = DEFAULT_QUEUE_SIZE) -> QueueListener:
+    """
+    Routes all logging through a queue that is drained by a background thread, so that slow
+    log sinks never block the threads that log. Returns the listener draining the queue; it
+    is stopped (and the queue flushed) at exit.
+    """
+    if handlers is None:
+        handler = logging.StreamHandler()
+        handler.setFormatter(StructuredFormatter(DEFAULT_FORMAT))
+        handlers = [handler]
+
+    # Sampling and context capture happen in the logging thread, before the record is queued
+    queue_handler = NonBlockingQueueHandler(queue.Queue(queue_size))
+    queue_handler.addFilter(SamplingFilter(policies or {}))
+    queue_handler.addFilter(ContextFilter())
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+
+    listener = _Listener(queue_handler.queue, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
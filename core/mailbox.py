@@ -0,0 +1,125 @@
+import asyncio
+import inspect
+import threading
+from collections import deque
+from concurrent.futures import Future, Executor
+from typing import Awaitable, Callable
+
+from core.exceptions import GameBotException
+
+# A busy mailbox gives its worker back to the pool after this many tasks, so that other
+# games sharing the pool are not starved
+MAX_TASKS_PER_TURN = 16
+
+
+class Mailbox:
+    """
+    Runs the tasks submitted for one game one at a time and in submission order.
+
+    The tasks are run on a shared executor, so tasks of different games run in parallel while
+    the tasks of a game never overlap. A mailbox occupies at most one worker of the executor
+    at a time.
+    """
+
+    def __init__(self, executor: Executor):
+        self._executor = executor
+
+        self._tasks: deque[tuple[Callable[[], object], Future]] = deque()
+        self._scheduled = False
+        self._lock = threading.Lock()
+
+    def submit(self, fn: Callable[[], object]) -> Future:
+        """Enqueues a task. Safe to call from any thread."""
+        future = Future()
+        with self._lock:
+            self._tasks.append((fn, future))
+            if self._scheduled:
+                return future
+            self._scheduled = True
+
+        self._executor.submit(self._run)
+        return future
+
+    def __len__(self) -> int:
+        return len(self._tasks)
+
+    def _run(self) -> None:
+        for _ in range(MAX_TASKS_PER_TURN):
+            with self._lock:
+                if not self._tasks:
+                    self._scheduled = False
+                    return
+                fn, future = self._tasks.popleft()
+
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                result = fn()
+                if inspect.isawaitable(result):
+                    result = run_synchronously(result)
+            except BaseException as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+
+        # More tasks are waiting; queue up behind the other mailboxes
+        self._executor.submit(self._run)
+
+
+class AsyncMailbox:
+    """
+    Runs the tasks submitted for one game one at a time and in submission order on an event loop.
+
+    Tasks may return awaitables, which are awaited before the next task of the game starts, so
+    a game is never entered twice even while it awaits. Tasks of different games interleave at
+    their await points.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self._loop = loop
+
+        self._tasks: deque[tuple[Callable[[], object], Future]] = deque()
+        self._running = False
+
+    def submit(self, fn: Callable[[], object]) -> Future:
+        """Enqueues a task. Safe to call from any thread."""
+        future = Future()
+        self._loop.call_soon_threadsafe(self._enqueue, fn, future)
+        return future
+
+    def __len__(self) -> int:
+        return len(self._tasks)
+
+    def _enqueue(self, fn: Callable[[], object], future: Future) -> None:
+        self._tasks.append((fn, future))
+        if not self._running:
+            self._running = True
+            self._loop.create_task(self._run())
+
+    async def _run(self) -> None:
+        while self._tasks:
+            fn, future = self._tasks.popleft()
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                result = fn()
+                if inspect.isawaitable(result):
+                    result = await result
+            except Exception as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+
+        self._running = False
+
+
+def run_synchronously(awaitable: Awaitable) -> object:
+    """Runs an awaitable that never suspends (e.g. a coroutine wrapping plain handlers) without a loop."""
+    coro = awaitable.__await__()
+    try:
+        coro.send(None)
+    except StopIteration as e:
+        return e.value
+
+    coro.close()
+    raise GameBotException("Handlers that await require the async mode of the bot")
@@ -0,0 +1,374 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from collections import deque, OrderedDict
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
+from enum import IntEnum
+from functools import partial
+from typing import Any, Callable, Hashable, Optional
+
+from telegram.error import RetryAfter
+
+from core.metrics import OUTBOUND_SECONDS, OUTBOUND_ERRORS
+
+logger = logging.getLogger(__name__)
+
+# Telegram's documented limits: 30 messages per second overall, about one message per second
+# in a private chat and 20 messages per minute in a group
+GLOBAL_RATE, GLOBAL_BURST = 30.0, 30
+PRIVATE_CHAT_RATE, PRIVATE_CHAT_BURST = 1.0, 3
+GROUP_CHAT_RATE, GROUP_CHAT_BURST = 20 / 60, 5
+
+# Maximum length of a message text
+MAX_MESSAGE_LENGTH = 4096
+
+# Edits of a message issued within this many seconds are merged into one
+EDIT_DEBOUNCE_DELAY = 1.0
+
+# Number of messages whose last sent content is remembered to skip no-op edits
+MAX_TRACKED_EDITS = 10000
+
+# Idle chat buckets are dropped once there are more of them than this
+MAX_IDLE_BUCKETS = 10000
+
+
+class Priority(IntEnum):
+    CALLBACK_ANSWER = 0
+    REPLY = 1
+    ANNOUNCEMENT = 2
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: int, now: Optional[float] = None):
+        self.rate = rate
+        self.burst = burst
+
+        self._tokens = float(burst)
+        self._updated = now if now is not None else time.monotonic()
+
+    def delay(self, now: float) -> float:
+        """Returns the number of seconds until a token is available."""
+        self._refill(now)
+        if self._tokens >= 1:
+            return 0.0
+        return (1 - self._tokens) / self.rate
+
+    def consume(self, now: float) -> None:
+        self._refill(now)
+        self._tokens -= 1
+
+    def is_full(self, now: float) -> bool:
+        self._refill(now)
+        return self._tokens >= self.burst
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+
+class _Request:
+    __slots__ = ('lane', 'priority', 'method', 'args', 'kwargs', 'future')
+
+    def __init__(self, lane: Hashable, priority: Priority, method: str, args: tuple, kwargs: dict):
+        self.lane = lane
+        self.priority = priority
+        self.method = method
+        self.args = args
+        self.kwargs = kwargs
+        self.future = Future()
+
+
+class EditCoalescer:
+    """
+    Debounces message edits issued through an outbound queue.
+
+    Only the newest pending content of a message is kept. It is sent when the debounce delay
+    expires or when the edit is flushed explicitly, and it is dropped if it doesn't differ from
+    the content last sent successfully.
+    """
+
+    def __init__(self, outbound: 'OutboundQueue', delay: float = EDIT_DEBOUNCE_DELAY,
+                 max_tracked: int = MAX_TRACKED_EDITS):
+        self.outbound = outbound
+        self.delay = delay
+        self.max_tracked = max_tracked
+
+        self._pending: dict[tuple[int, int], tuple[str, dict]] = {}
+        self._timers: dict[tuple[int, int], asyncio.TimerHandle] = {}
+        self._sent: OrderedDict[tuple[int, int], tuple[str, dict]] = OrderedDict()
+
+    def edit(self, chat_id: int, message_id: int, text: str, flush: bool = False, **kwargs) -> None:
+        """
+        Schedules an edit of a message text. Safe to call from any thread; a flushed edit is sent
+        before the requests submitted after it to the same chat.
+        """
+        self.outbound.call_soon(self._update, (chat_id, message_id), text, kwargs, flush)
+
+    def _update(self, key: tuple[int, int], text: str, kwargs: dict, flush: bool) -> None:
+        self._pending[key] = (text, kwargs)
+        if flush:
+            self._flush(key)
+        elif key not in self._timers:
+            self._timers[key] = self.outbound.loop.call_later(self.delay, self._flush, key)
+
+    def _flush(self, key: tuple[int, int]) -> None:
+        timer = self._timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+
+        pending = self._pending.pop(key, None)
+        if pending is None:
+            return
+        text, kwargs = pending
+
+        sent = self._sent.get(key)
+        if sent is not None and _same_content(sent, pending):
+            return
+
+        chat_id, message_id = key
+        future = self.outbound.edit_message_text(chat_id, text, message_id=message_id, **kwargs)
+        future.add_done_callback(partial(self._record_sent, key, pending))
+
+    def _record_sent(self, key: tuple[int, int], content: tuple[str, dict], future: Future) -> None:
+        # The queue completes requests on its loop. Failed edits aren't recorded, so that sending
+        # the same content again isn't taken for a no-op
+        if future.cancelled() or future.exception() is not None:
+            return
+        self._sent[key] = content
+        self._sent.move_to_end(key)
+        if len(self._sent) > self.max_tracked:
+            self._sent.popitem(last=False)
+
+
+def _same_content(a: tuple[str, dict], b: tuple[str, dict]) -> bool:
+    if a[0] != b[0] or a[1].keys() != b[1].keys():
+        return False
+
+    # Cached renderings (see core.render) are the same objects; other reply markups are
+    # compared by their content
+    for k, v in a[1].items():
+        other = b[1][k]
+        if v is other:
+            continue
+        if hasattr(v, 'to_dict') and hasattr(other, 'to_dict'):
+            if v.to_dict() != other.to_dict():
+                return False
+        elif v != other:
+            return False
+    return True
+
+
+class OutboundQueue:
+    """
+    Sends Bot API requests from the Scheduler loop.
+
+    Requests are grouped in lanes: every chat is a lane, so messages to a chat are delivered
+    in order and within the chat's rate budget, while different chats are served concurrently.
+    Lanes with the most urgent head request are served first, and callback query answers get
+    lanes of their own, so they never wait behind announcements. Any object implementing the
+    used Bot methods can serve as the bot, which makes the queue testable without Telegram.
+
+    Bot methods are called on the executor (a pool of a thread per worker by default), and the
+    time is read from the loop.
+    """
+
+    def __init__(self, bot: Any, loop: asyncio.AbstractEventLoop, workers: int = 8,
+                 global_rate: float = GLOBAL_RATE, global_burst: int = GLOBAL_BURST,
+                 executor: Optional[Executor] = None):
+        self.bot = bot
+        self.loop = loop
+
+        self._workers = workers
+        self._executor = executor or ThreadPoolExecutor(max_workers=workers, thread_name_prefix='outbound')
+        self._global_bucket = TokenBucket(global_rate, global_burst, loop.time())
+
+        self._lanes: dict[Hashable, deque[_Request]] = {}
+        self._busy_lanes: set[Hashable] = set()
+        self._chat_buckets: dict[Hashable, TokenBucket] = {}
+
+        # Heap of (priority, seq, lane) for lanes that have a request ready to be sent
+        self._ready: list[tuple[int, int, Hashable]] = []
+        self._seq = itertools.count()
+        self._wakeup: Optional[asyncio.Event] = None
+
+        self.edits = EditCoalescer(self)
+
+    def send_message(self, chat_id: int, *args, priority: Priority = Priority.ANNOUNCEMENT, **kwargs) -> Future:
+        return self.submit(chat_id, priority, 'send_message', chat_id, *args, **kwargs)
+
+    def edit_message_text(self, chat_id: int, *args, priority: Priority = Priority.REPLY, **kwargs) -> Future:
+        return self.submit(chat_id, priority, 'edit_message_text', *args, chat_id=chat_id, **kwargs)
+
+    def answer_callback_query(self, query_id: str, *args, **kwargs) -> Future:
+        return self.submit(('callback_query', query_id), Priority.CALLBACK_ANSWER,
+                           'answer_callback_query', query_id, *args, **kwargs)
+
+    def submit(self, lane: Hashable, priority: Priority, method: str, *args, **kwargs) -> Future:
+        """Enqueues a call of a bot method. Safe to call from any thread."""
+        request = _Request(lane, priority, method, args, kwargs)
+        self.call_soon(self._enqueue, request)
+        return request.future
+
+    def call_soon(self, fn: Callable, *args) -> None:
+        """
+        Runs a function on the loop: right away when called from the loop, so that requests keep
+        the order they were submitted in, whatever the number of hops they took to get there.
+        """
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is self.loop:
+            fn(*args)
+        else:
+            self.loop.call_soon_threadsafe(fn, *args)
+
+    async def run(self) -> None:
+        self._wakeup = asyncio.Event()
+        await asyncio.gather(*(self._worker() for _ in range(self._workers)))
+
+    def _enqueue(self, request: _Request) -> None:
+        queue = self._lanes.get(request.lane)
+        if queue is None:
+            queue = self._lanes[request.lane] = deque()
+        queue.append(request)
+
+        if len(queue) == 1 and request.lane not in self._busy_lanes:
+            self._mark_ready(request.lane)
+
+    def _mark_ready(self, lane: Hashable) -> None:
+        heapq.heappush(self._ready, (self._lanes[lane][0].priority, next(self._seq), lane))
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def _worker(self) -> None:
+        while True:
+            if not self._ready:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            now = self.loop.time()
+            delay = self._global_bucket.delay(now)
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+
+            _, _, lane = heapq.heappop(self._ready)
+            bucket = self._get_bucket(lane)
+            if bucket is not None:
+                delay = bucket.delay(now)
+                if delay > 0:
+                    self._busy_lanes.add(lane)
+                    self.loop.call_later(delay, self._release, lane)
+                    continue
+                bucket.consume(now)
+            self._global_bucket.consume(now)
+
+            request = self._lanes[lane].popleft()
+            self._busy_lanes.add(lane)
+            try:
+                await self._send(request)
+            finally:
+                self._release(lane)
+
+    async def _send(self, request: _Request) -> None:
+        if request.future.set_running_or_notify_cancel():
+            method = getattr(self.bot, request.method)
+            while True:
+                start = time.perf_counter()
+                try:
+                    result = await self.loop.run_in_executor(
+                        self._executor, partial(method, *request.args, **request.kwargs))
+                except RetryAfter as e:
+                    OUTBOUND_ERRORS.labels(request.method, type(e).__name__).inc()
+                    logger.warning("Flood control exceeded, retrying in %s s", e.retry_after)
+                    await asyncio.sleep(e.retry_after)
+                except Exception as e:
+                    OUTBOUND_ERRORS.labels(request.method, type(e).__name__).inc()
+                    logger.error("Error while sending %s", request.method, exc_info=e)
+                    request.future.set_exception(e)
+                    return
+                else:
+                    OUTBOUND_SECONDS.labels(request.method).observe(time.perf_counter() - start)
+                    request.future.set_result(result)
+                    return
+
+    def _release(self, lane: Hashable) -> None:
+        self._busy_lanes.discard(lane)
+        if self._lanes.get(lane):
+            self._mark_ready(lane)
+        else:
+            self._lanes.pop(lane, None)
+            if len(self._chat_buckets) > MAX_IDLE_BUCKETS:
+                self._drop_idle_buckets()
+
+    def _get_bucket(self, lane: Hashable) -> Optional[TokenBucket]:
+        if not isinstance(lane, int):
+            return None
+
+        bucket = self._chat_buckets.get(lane)
+        if bucket is None:
+            # Group chats have negative ids
+            if lane < 0:
+                bucket = TokenBucket(GROUP_CHAT_RATE, GROUP_CHAT_BURST, self.loop.time())
+            else:
+                bucket = TokenBucket(PRIVATE_CHAT_RATE, PRIVATE_CHAT_BURST, self.loop.time())
+            self._chat_buckets[lane] = bucket
+        return bucket
+
+    def _drop_idle_buckets(self) -> None:
+        now = self.loop.time()
+        for lane, bucket in list(self._chat_buckets.items()):
+            if lane not in self._lanes and bucket.is_full(now):
+                del self._chat_buckets[lane]
+
+
+class MessageBatch:
+    """
+    Collects outgoing messages and merges consecutive ones into as few messages as possible.
+
+    Messages are merged when they use the same sending options, the merged text fits in
+    Telegram's message length limit and at most one of them carries a reply markup (the
+    markup is attached to the bottom of a message, so a message with one closes the chunk).
+    """
+
+    def __init__(self, separator: str = '\n\n', limit: int = MAX_MESSAGE_LENGTH):
+        self.separator = separator
+        self.limit = limit
+
+        self._messages: list[tuple[str, dict]] = []
+
+    def add(self, text: str, **kwargs) -> None:
+        self._messages.append((text, kwargs))
+
+    def __len__(self) -> int:
+        return len(self._messages)
+
+    def flush(self) -> list[tuple[str, dict]]:
+        """Returns merged (text, kwargs) pairs and empties the batch."""
+        chunks = []
+        texts, options, chunk_kwargs, closed = [], None, {}, True
+
+        for text, kwargs in self._messages:
+            markup = kwargs.get('reply_markup')
+            plain_kwargs = {k: v for k, v in kwargs.items() if k != 'reply_markup'}
+            length = sum(len(x) for x in texts) + len(self.separator) * len(texts) + len(text)
+
+            if closed or plain_kwargs != options or length > self.limit:
+                if texts:
+                    chunks.append((self.separator.join(texts), chunk_kwargs))
+                texts, options, chunk_kwargs = [], plain_kwargs, dict(plain_kwargs)
+
+            texts.append(text)
+            closed = markup is not None
+            if closed:
+                chunk_kwargs['reply_markup'] = markup
+
+        if texts:
+            chunks.append((self.separator.join(texts), chunk_kwargs))
+
+        self._messages.clear()
+        return chunks
@@ -0,0 +1,114 @@
+import importlib
+import json
+import logging
+import threading
+import time
+from typing import Callable, Iterable, Union
+
+from core.api import Game
+from core.exceptions import GameBotException
+
+logger = logging.getLogger(__name__)
+
+# Entry point group under which installed packages can provide games, as name = "module:attribute"
+ENTRY_POINT_GROUP = 'gamebot.games'
+
+GameCtor = Callable[..., Game]
+
+
+class GameRegistry:
+    """
+    Maps game names to game constructors.
+
+    A game is either registered with its constructor, or with a "module:attribute" spec (from a
+    manifest or an entry point), in which case its module is only imported the first time the
+    game is needed. Entry points are only looked up for names that aren't registered otherwise,
+    as scanning the installed packages takes a while.
+    """
+
+    def __init__(self, entry_point_group: str = ENTRY_POINT_GROUP):
+        self.entry_point_group = entry_point_group
+
+        self._ctors: dict[str, GameCtor] = {}
+        self._specs: dict[str, str] = {}
+        self._entry_points_loaded = False
+        self._lock = threading.RLock()
+
+    def add(self, name: str, game: Union[GameCtor, str]) -> None:
+        with self._lock:
+            if isinstance(game, str):
+                self._specs[name] = game
+                self._ctors.pop(name, None)
+            else:
+                self._ctors[name] = game
+                self._specs.pop(name, None)
+
+    def add_manifest(self, path: str) -> None:
+        """Registers the games of a JSON manifest mapping game names to "module:attribute" specs."""
+        with open(path) as f:
+            manifest = json.load(f)
+        for name, spec in manifest.items():
+            self.add(name, spec)
+
+    def __contains__(self, name: str) -> bool:
+        with self._lock:
+            if name not in self._ctors and name not in self._specs:
+                self._load_entry_points()
+            return name in self._ctors or name in self._specs
+
+    @property
+    def names(self) -> list[str]:
+        with self._lock:
+            self._load_entry_points()
+            return sorted(set(self._ctors) | set(self._specs))
+
+    def get(self, name: str) -> GameCtor:
+        # Loaded games don't wait for games being imported
+        ctor = self._ctors.get(name)
+        if ctor is not None:
+            return ctor
+
+        with self._lock:
+            ctor = self._ctors.get(name)
+            if ctor is not None:
+                return ctor
+
+            if name not in self:
+                raise GameBotException(f"No such game: {name}")
+
+            # The spec is kept until the import succeeds, so that a failed import is retried next time
+            spec = self._specs[name]
+            start = time.perf_counter()
+            ctor = self._ctors[name] = _import_spec(spec)
+            del self._specs[name]
+            logger.info("Loaded game %s from %s in %.1f ms", name, spec, (time.perf_counter() - start) * 1000)
+            return ctor
+
+    def preload(self, names: Iterable[str]) -> None:
+        """Imports games ahead of their first use (e.g. the popular ones, right after startup)."""
+        for name in names:
+            try:
+                self.get(name)
+            except Exception as e:
+                logger.warning("Failed to preload game %s", name, exc_info=e)
+
+    def _load_entry_points(self) -> None:
+        if self._entry_points_loaded:
+            return
+        self._entry_points_loaded = True
+
+        from importlib.metadata import entry_points
+        for entry_point in entry_points(group=self.entry_point_group):
+            if entry_point.name not in self._ctors and entry_point.name not in self._specs:
+                self._specs[entry_point.name] = entry_point.value
+
+
+def _import_spec(spec: str) -> GameCtor:
+    module_name, _, attribute = spec.partition(':')
+    if not attribute:
+        raise GameBotException(f"Game spec must look like module:attribute, got {spec!r}")
+
+    obj = importlib.import_module(module_name)
+    for part in attribute.split('.'):
+        obj = getattr(obj, part)
+    return obj
@@ -0,0 +1,39 @@
+from typing import Callable, Hashable, TypeVar
+
+from core.metrics import metrics
+
+T = TypeVar('T')
+
+RENDER_CACHE_LOOKUPS = metrics.counter(
+    'gamebot_render_cache_lookups_total', "Lookups of rendered messages and keyboards, by result.", ['result'])
+
+
+class RenderCache:
+    """
+    Keeps the latest rendering of each piece of a game's output (a message text, a keyboard)
+    along with the version of the game state it was rendered from.
+
+    Content is only rendered again once the version changes, and the same object is returned
+    until then, so that unchanged content can be recognized by identity (e.g. to skip no-op
+    edits). Content that never changes is cached under a constant version.
+    """
+
+    def __init__(self):
+        self._entries: dict[Hashable, tuple[Hashable, object]] = {}
+
+        self._hits = RENDER_CACHE_LOOKUPS.labels('hit')
+        self._misses = RENDER_CACHE_LOOKUPS.labels('miss')
+
+    def get(self, key: Hashable, version: Hashable, render: Callable[[], T]) -> T:
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] == version:
+            self._hits.inc()
+            return entry[1]
+
+        self._misses.inc()
+        value = render()
+        self._entries[key] = (version, value)
+        return value
+
+    def clear(self) -> None:
+        self._entries.clear()
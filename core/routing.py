@@ -0,0 +1,115 @@
+from collections import defaultdict
+from typing import Iterable, Iterator, Optional
+
+from telegram import Update
+
+from core.callbacks import decode_callback
+
+# Callback data is split on this separator to look up prefixes
+CALLBACK_SEPARATOR = '_'
+
+
+class RoutingIndex:
+    """
+    Maps chat ids, user ids, command names and callback data prefixes to the ids of the
+    games that may be interested in an update. Lookups are dictionary accesses, so the
+    cost of routing an update doesn't depend on the number of games a user has played.
+    """
+
+    def __init__(self):
+        self._by_chat: dict[int, set[int]] = defaultdict(set)
+        self._by_user: dict[int, set[int]] = defaultdict(set)
+        self._by_command: dict[str, set[int]] = defaultdict(set)
+        self._by_callback: dict[str, set[int]] = defaultdict(set)
+
+        # Reverse mapping used to remove all entries of a game at once
+        self._keys: dict[int, list[tuple[dict, object]]] = {}
+
+    def add(self, game_id: int, chat_ids: Iterable[int] = (), user_ids: Iterable[int] = (),
+            commands: Iterable[str] = (), callback_prefixes: Iterable[str] = ()) -> None:
+        keys = self._keys.setdefault(game_id, [])
+
+        for index, values in ((self._by_chat, chat_ids), (self._by_user, user_ids),
+                              (self._by_command, commands), (self._by_callback, callback_prefixes)):
+            for value in values:
+                index[value].add(game_id)
+                keys.append((index, value))
+
+    def remove(self, game_id: int) -> None:
+        for index, value in self._keys.pop(game_id, []):
+            game_ids = index.get(value)
+            if game_ids is None:
+                continue
+            game_ids.discard(game_id)
+            if not game_ids:
+                del index[value]
+
+    def games_in_chat(self, chat_id: int) -> set[int]:
+        return set(self._by_chat.get(chat_id, ()))
+
+    def chat_ids(self) -> list[int]:
+        return list(self._by_chat)
+
+    def __contains__(self, game_id: int) -> bool:
+        return game_id in self._keys
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def candidates(self, update: Update) -> set[int]:
+        user = update.effective_user
+        if user is None:
+            return set()
+        user_games = self._by_user.get(user.id)
+        if not user_games:
+            return set()
+
+        if update.callback_query is not None:
+            # Packed callback data names its game, so it needs no lookup at all
+            decoded = decode_callback(update.callback_query.data)
+            if decoded is not None:
+                return {decoded[0]} if decoded[0] in user_games else set()
+            return user_games & self._lookup_callback(update.callback_query.data)
+
+        command = get_command(update)
+        if command is not None:
+            return user_games & self._by_command.get(command, set())
+
+        chat = update.effective_chat
+        if chat is None:
+            return set()
+        return user_games & self._by_chat.get(chat.id, set())
+
+    def _lookup_callback(self, data: Optional[str]) -> set[int]:
+        result = set()
+        for prefix in iter_callback_prefixes(data):
+            result |= self._by_callback.get(prefix, set())
+        return result
+
+
+def iter_callback_prefixes(data: Optional[str]) -> Iterator[str]:
+    if not data:
+        return
+
+    # The empty prefix matches any callback data
+    yield ''
+
+    # Every prefix ending at a separator is a potential key; callback data is limited
+    # to 64 bytes by Telegram, so there are only a handful of them
+    pos = data.find(CALLBACK_SEPARATOR)
+    while pos != -1:
+        yield data[:pos]
+        pos = data.find(CALLBACK_SEPARATOR, pos + 1)
+    yield data
+
+
+def get_command(update: Update) -> Optional[str]:
+    message = update.effective_message
+    if message is None or not message.text or not message.text.startswith('/'):
+        return None
+
+    # Strip the leading slash and the optional bot username (/command@bot)
+    command = message.text[1:].split(maxsplit=1)
+    if not command:
+        return None
+    return command[0].split('@', 1)[0].lower()
@@ -0,0 +1,179 @@
+import struct
+from typing import Optional
+
+from telegram import Bot, Chat, User
+
+from core.api import Game
+from core.exceptions import GameBotException
+
+# Snapshots start with this magic and the version of the envelope below; the state of the game
+# itself is versioned by the game (see Game.freeze)
+SNAPSHOT_MAGIC = b'GBSN'
+SNAPSHOT_VERSION = 1
+
+# Magic, version, game id, seed of the random generator from then on, and counts of the users and deadlines
+HEADER = struct.Struct('<4sBQQBB')
+
+# User id and whether the user is a bot; first name, last name and username follow
+USER = struct.Struct('<qB')
+
+# Whether the leader is one of the users, someone else (who follows as a user) or missing, the
+# leader id, and the chat id with a flag telling whether it's set; the chat type and title follow
+PARTY = struct.Struct('<BqBq')
+NO_LEADER, LEADER_AMONG_USERS, OTHER_LEADER = 0, 1, 2
+
+# Delay of a deadline in seconds; its name follows
+DEADLINE = struct.Struct('<d')
+
+# Strings and the state of the game are prefixed with their length
+LENGTH = struct.Struct('<H')
+STATE_LENGTH = struct.Struct('<I')
+
+
+class GameSnapshot:
+    """
+    A live game packed into bytes, to be resumed elsewhere (see GameManager.freeze_game), e.g. by
+    another worker.
+
+    The snapshot keeps what's needed to create the game again (its name and id, and the Telegram
+    users and chat of its party) along with the state the game packs itself. The random generator
+    of the game is reseeded with a seed kept in the snapshot, so that the game draws the same
+    numbers wherever it's resumed. Deadlines are kept with their delays and start over on resume.
+    """
+
+    def __init__(self, game_id: int, game_name: str, seed: int, users: list[User], leader: Optional[User],
+                 chat: Optional[Chat], deadlines: dict[str, float], state: bytes):
+        self.game_id = game_id
+        self.game_name = game_name
+        self.seed = seed
+        self.users = users
+        self.leader = leader
+        self.chat = chat
+        self.deadlines = deadlines
+        self.state = state
+
+    @classmethod
+    def capture(cls, game: Game, game_name: str) -> 'GameSnapshot':
+        """
+        Packs a game. Its random generator is then reseeded with the seed kept in the snapshot, so
+        it must be recorded along with the snapshot if the game goes on.
+        """
+        # Games that don't support snapshots fail before their random generator is touched
+        state = game.freeze()
+        seed = game.random.getrandbits(64)
+        game.random.seed(seed)
+
+        party = game.party
+        return cls(game.game_id, game_name, seed, [x.user for x in party.players],
+                   party.leader.user if party.leader is not None else None, party.chat, game.deadlines.delays(),
+                   state)
+
+    def apply(self, game: Game) -> None:
+        """Restores the state into a game just created from the snapshot, before it goes live."""
+        game.random.seed(self.seed)
+        game.thaw(self.state)
+
+        for name in game.deadlines.delays():
+            game.cancel_deadline(name)
+        for name, delay in self.deadlines.items():
+            game.set_deadline(name, delay)
+
+    def encode(self) -> bytes:
+        chunks = [HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, self.game_id, self.seed, len(self.users),
+                              len(self.deadlines)), _pack_str(self.game_name)]
+
+        chunks.extend(_pack_user(x) for x in self.users)
+
+        if self.leader is None:
+            leader = NO_LEADER
+        elif any(x.id == self.leader.id for x in self.users):
+            leader = LEADER_AMONG_USERS
+        else:
+            leader = OTHER_LEADER
+        chunks.append(PARTY.pack(leader, self.leader.id if self.leader is not None else 0,
+                                 self.chat is not None, self.chat.id if self.chat is not None else 0))
+        if leader == OTHER_LEADER:
+            chunks.append(_pack_user(self.leader))
+        if self.chat is not None:
+            chunks.extend(_pack_str(x) for x in (self.chat.type, self.chat.title))
+
+        for name, delay in self.deadlines.items():
+            chunks.append(DEADLINE.pack(delay))
+            chunks.append(_pack_str(name))
+
+        chunks.append(STATE_LENGTH.pack(len(self.state)))
+        chunks.append(self.state)
+        return b''.join(chunks)
+
+    @classmethod
+    def decode(cls, data: bytes, bot: Optional[Bot] = None) -> 'GameSnapshot':
+        """Unpacks a snapshot; the users and the chat are bound to the bot, if given."""
+        reader = _Reader(data)
+        magic, version, game_id, seed, user_count, deadline_count = reader.unpack(HEADER)
+        if magic != SNAPSHOT_MAGIC:
+            raise GameBotException("Not a game snapshot")
+        if version != SNAPSHOT_VERSION:
+            raise GameBotException(f"Unsupported snapshot version: {version}")
+        game_name = reader.string()
+
+        users = [reader.user(bot) for _ in range(user_count)]
+
+        leader_kind, leader_id, has_chat, chat_id = reader.unpack(PARTY)
+        leader = None
+        if leader_kind == LEADER_AMONG_USERS:
+            leader = next(x for x in users if x.id == leader_id)
+        elif leader_kind == OTHER_LEADER:
+            leader = reader.user(bot)
+        chat = None
+        if has_chat:
+            chat_type, title = reader.string(), reader.string()
+            chat = Chat(chat_id, chat_type, title=title or None, bot=bot)
+
+        deadlines = {}
+        for _ in range(deadline_count):
+            delay, = reader.unpack(DEADLINE)
+            deadlines[reader.string()] = delay
+
+        state_length, = reader.unpack(STATE_LENGTH)
+        return cls(game_id, game_name, seed, users, leader, chat, deadlines, reader.read(state_length))
+
+
+def _pack_user(user: User) -> bytes:
+    strings = [_pack_str(x) for x in (user.first_name, user.last_name, user.username)]
+    return USER.pack(user.id, user.is_bot) + b''.join(strings)
+
+
+def _pack_str(value: Optional[str]) -> bytes:
+    data = value.encode() if value else b''
+    return LENGTH.pack(len(data)) + data
+
+
+class _Reader:
+    def __init__(self, data: bytes):
+        self._data = data
+        self._pos = 0
+
+    def unpack(self, layout: struct.Struct) -> tuple:
+        try:
+            values = layout.unpack_from(self._data, self._pos)
+        except struct.error:
+            raise GameBotException("Truncated game snapshot")
+        self._pos += layout.size
+        return values
+
+    def user(self, bot: Optional[Bot]) -> User:
+        user_id, is_bot = self.unpack(USER)
+        first_name, last_name, username = self.string(), self.string(), self.string()
+        return User(user_id, first_name, bool(is_bot), last_name=last_name or None, username=username or None,
+                    bot=bot)
+
+    def string(self) -> str:
+        length, = self.unpack(LENGTH)
+        return self.read(length).decode()
+
+    def read(self, length: int) -> bytes:
+        data = self._data[self._pos:self._pos + length]
+        if len(data) < length:
+            raise GameBotException("Truncated game snapshot")
+        self._pos += length
+        return data
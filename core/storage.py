@@ -1,10 +1,361 @@
+import base64
+import json
+import logging
+import os
+import queue
+import struct
+import threading
+import time
+import zlib
+from typing import Any, Optional
+
+from core.exceptions import GameBotException
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_VERSION = 1
+
+# Every log record is framed with its length and CRC32, so that a torn write at the end
+# of the log can be detected and discarded during recovery
+FRAME_HEADER = struct.Struct('<II')
+
+
+class _SyncRequest:
+    """Waits for the records added before it, and carries the error if writing them failed."""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.error: Optional[Exception] = None
+
+
+class PlayerState:
+    def __init__(self, user_id: int, user: dict):
+        self.user_id = user_id
+        self.user = user
+
+    def to_dict(self) -> dict:
+        return {'id': self.user_id, 'user': self.user}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'PlayerState':
+        return cls(data['id'], data['user'])
+
+
+class GameState:
+    def __init__(self, game_id: int, game_name: str, seed: int, player_ids: list[int],
+                 leader_id: Optional[int] = None, chat: Optional[dict] = None, actions: Optional[list] = None,
+                 snapshot: Optional[bytes] = None):
+        self.game_id = game_id
+        self.game_name = game_name
+        self.seed = seed
+        self.player_ids = player_ids
+        self.leader_id = leader_id
+        self.chat = chat
+        self.actions: list = actions if actions is not None else []
+
+        # Games with a snapshot (see core.snapshot) are restored from it, and their actions follow it
+        self.snapshot = snapshot
+
+    def to_dict(self) -> dict:
+        data = {'id': self.game_id, 'name': self.game_name, 'seed': self.seed, 'players': self.player_ids,
+                'leader': self.leader_id, 'chat': self.chat, 'actions': self.actions}
+        if self.snapshot is not None:
+            data['snapshot'] = base64.b64encode(self.snapshot).decode('ascii')
+        return data
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'GameState':
+        snapshot = data.get('snapshot')
+        return cls(data['id'], data['name'], data['seed'], data['players'], data['leader'], data['chat'],
+                   data['actions'], base64.b64decode(snapshot) if snapshot is not None else None)
+
+
 class Storage:
-    pass
+    """
+    Persists games as an append-only log of actions plus periodic snapshots.
+
+    Records are handed to a writer thread and written in batches that share a single fsync
+    (group commit), so appending never blocks the caller on I/O. Games can be stored as their
+    own snapshot (see core.snapshot and add_snapshot), which replaces the actions before it, so
+    that they are restored from it instead of from their first action. Every `snapshot_every`
+    records the writer starts a new log segment and writes a snapshot of all live games, after
+    which older segments are deleted. Recovery loads the newest snapshot and replays only the
+    segments written after it.
+    """
+
+    def __init__(self, path: str, commit_interval: float = 0.005, snapshot_every: int = 100000):
+        self.path = path
+        self.commit_interval = commit_interval
+        self.snapshot_every = snapshot_every
+
+        self._games: dict[int, GameState] = {}
+        self._players: dict[int, PlayerState] = {}
+
+        self._queue: queue.SimpleQueue = queue.SimpleQueue()
+        self._writer: Optional[threading.Thread] = None
+        self._segment = 0
+        self._log_file = None
+        self._records_since_snapshot = 0
+
+    def open(self) -> dict[int, GameState]:
+        """Recovers the stored games and starts accepting new records."""
+        os.makedirs(self.path, exist_ok=True)
+        games = self._recover()
+
+        self._start_segment(self._segment + 1)
+        self._writer = threading.Thread(target=self._write_loop, name='storage', daemon=True)
+        self._writer.start()
+        return games
+
+    def close(self) -> None:
+        if self._writer is None:
+            return
+        self._queue.put(None)
+        self._writer.join()
+        self._writer = None
+        self._log_file.close()
+
+    def get_player(self, user_id: int) -> Optional[PlayerState]:
+        return self._players.get(user_id)
+
+    def load_game(self, game_id: int) -> Optional[GameState]:
+        """Returns the stored state of a live game, including every action added so far."""
+        self.sync()
+        state = self._games.get(game_id)
+        if state is None:
+            return None
+        return GameState(state.game_id, state.game_name, state.seed, list(state.player_ids), state.leader_id,
+                         state.chat, list(state.actions), state.snapshot)
+
+    def add_game(self, state: GameState, players: list[PlayerState]) -> None:
+        self._queue.put(('new', state.to_dict(), [x.to_dict() for x in players]))
+
+    def add_action(self, game_id: int, action: Any) -> None:
+        # Serialization is left to the writer thread, the action only needs to have to_dict()
+        self._queue.put(('act', game_id, action))
+
+    def add_snapshot(self, game_id: int, snapshot: bytes) -> None:
+        """Stores a snapshot of a game, from which it's restored along with the actions added after it."""
+        self._queue.put(('snap', game_id, snapshot))
+
+    def remove_game(self, game_id: int) -> None:
+        self._queue.put(('end', game_id))
+
+    def sync(self) -> None:
+        """Blocks until every record added so far is durable, and raises if some couldn't be written."""
+        request = _SyncRequest()
+        self._queue.put(request)
+        request.event.wait()
+        if request.error is not None:
+            raise GameBotException("Failed to write the game log") from request.error
+
+    def snapshot(self) -> None:
+        self._queue.put('snapshot')
+
+    def _write_loop(self) -> None:
+        while True:
+            batch = [self._queue.get()]
+
+            # Collect everything that arrives during the commit interval into a single write
+            deadline = time.monotonic() + self.commit_interval
+            while batch[-1] is not None:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+
+            try:
+                self._commit(batch)
+            except Exception as e:
+                logger.error("Error while writing the game log", exc_info=e)
+
+            if batch[-1] is None:
+                return
+
+    def _commit(self, batch: list) -> None:
+        records = []
+        frames = []
+        requests = []
+        snapshot_requested = False
+        error = None
+
+        try:
+            for item in batch:
+                if isinstance(item, _SyncRequest):
+                    requests.append(item)
+                elif item == 'snapshot':
+                    snapshot_requested = True
+                elif item is not None:
+                    try:
+                        record = self._encode(item)
+                        data = json.dumps(record, separators=(',', ':')).encode()
+                    except Exception as e:
+                        logger.error("Dropping a record that can't be encoded", exc_info=e)
+                        error = e
+                        continue
+                    records.append(record)
+                    frames.append(FRAME_HEADER.pack(len(data), zlib.crc32(data)))
+                    frames.append(data)
+
+            if frames:
+                try:
+                    self._log_file.write(b''.join(frames))
+                    self._log_file.flush()
+                    os.fsync(self._log_file.fileno())
+                except Exception as e:
+                    # The batch may be partly written, which leaves a torn record in the segment. Recovery
+                    # stops reading a segment there, so later records go to a new one
+                    logger.error("Error while writing the game log", exc_info=e)
+                    error = e
+                    try:
+                        self._log_file.close()
+                    except OSError:
+                        pass
+                    self._log_file = None
+                    self._start_segment(self._segment + 1)
+                    return
+
+                # The games in memory only follow what's durable
+                for record in records:
+                    self._apply(record)
+                self._records_since_snapshot += len(records)
+
+            if snapshot_requested or self._records_since_snapshot >= self.snapshot_every:
+                try:
+                    self._write_snapshot()
+                except Exception as e:
+                    # The records are durable in the log, which is only compacted by a later snapshot
+                    logger.error("Error while writing a snapshot of the game log", exc_info=e)
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            # Waiters are never left hanging, and learn about records that were lost
+            for request in requests:
+                request.error = error
+                request.event.set()
+
+    @staticmethod
+    def _encode(item: tuple) -> dict:
+        kind = item[0]
+        if kind == 'new':
+            return {'t': 'new', 'game': item[1], 'players': item[2]}
+        if kind == 'act':
+            action = item[2]
+            return {'t': 'act', 'g': item[1], 'a': action if isinstance(action, dict) else action.to_dict()}
+        if kind == 'snap':
+            return {'t': 'snap', 'g': item[1], 's': base64.b64encode(item[2]).decode('ascii')}
+        return {'t': 'end', 'g': item[1]}
+
+    def _apply(self, record: dict) -> None:
+        kind = record['t']
+        if kind == 'new':
+            state = GameState.from_dict(record['game'])
+            self._games[state.game_id] = state
+            for player in record['players']:
+                player = PlayerState.from_dict(player)
+                self._players[player.user_id] = player
+        elif kind == 'act':
+            state = self._games.get(record['g'])
+            if state is not None:
+                state.actions.append(record['a'])
+        elif kind == 'snap':
+            state = self._games.get(record['g'])
+            if state is not None:
+                state.snapshot = base64.b64decode(record['s'])
+                state.actions = []
+        elif kind == 'end':
+            self._games.pop(record['g'], None)
+
+    def _start_segment(self, segment: int) -> None:
+        if self._log_file is not None:
+            self._log_file.close()
+        self._segment = segment
+        self._log_file = open(self._segment_path(segment), 'ab')
+
+    def _write_snapshot(self) -> None:
+        # The snapshot covers every segment before the new one
+        self._start_segment(self._segment + 1)
+
+        live_players = {user_id for state in self._games.values() for user_id in state.player_ids}
+        self._players = {k: v for k, v in self._players.items() if k in live_players}
+
+        data = zlib.compress(json.dumps({
+            'version': SNAPSHOT_VERSION,
+            'segment': self._segment,
+            'games': [x.to_dict() for x in self._games.values()],
+            'players': [x.to_dict() for x in self._players.values()],
+        }, separators=(',', ':')).encode())
+
+        path = self._snapshot_path(self._segment)
+        with open(path + '.tmp', 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + '.tmp', path)
+        self._records_since_snapshot = 0
+
+        for name in os.listdir(self.path):
+            number = self._parse_name(name)
+            if number is not None and number[1] < self._segment:
+                os.remove(os.path.join(self.path, name))
+
+    def _recover(self) -> dict[int, GameState]:
+        snapshots, segments = [], []
+        for name in os.listdir(self.path):
+            number = self._parse_name(name)
+            if number is not None:
+                (snapshots if number[0] == 'snapshot' else segments).append(number[1])
+
+        first_segment = 0
+        for number in sorted(snapshots, reverse=True):
+            try:
+                with open(self._snapshot_path(number), 'rb') as f:
+                    snapshot = json.loads(zlib.decompress(f.read()))
+            except (OSError, ValueError, zlib.error) as e:
+                logger.warning("Skipping unreadable snapshot %s", number, exc_info=e)
+                continue
+
+            if snapshot['version'] != SNAPSHOT_VERSION:
+                raise ValueError(f"Unsupported snapshot version: {snapshot['version']}")
+            self._games = {x['id']: GameState.from_dict(x) for x in snapshot['games']}
+            self._players = {x['id']: PlayerState.from_dict(x) for x in snapshot['players']}
+            first_segment = snapshot['segment']
+            break
+
+        for number in sorted(segments):
+            if number >= first_segment:
+                self._replay_segment(number)
+
+        self._segment = max(segments + snapshots, default=0)
+        return dict(self._games)
+
+    def _replay_segment(self, number: int) -> None:
+        with open(self._segment_path(number), 'rb') as f:
+            data = f.read()
 
+        pos = 0
+        while pos + FRAME_HEADER.size <= len(data):
+            length, crc = FRAME_HEADER.unpack_from(data, pos)
+            record = data[pos + FRAME_HEADER.size:pos + FRAME_HEADER.size + length]
+            if len(record) < length or zlib.crc32(record) != crc:
+                logger.warning("Discarding a torn record at the end of segment %s", number)
+                break
+            self._apply(json.loads(record))
+            pos += FRAME_HEADER.size + length
 
-class GameState(Storage):
-    pass
+    def _segment_path(self, number: int) -> str:
+        return os.path.join(self.path, f'log-{number:08d}')
 
+    def _snapshot_path(self, number: int) -> str:
+        return os.path.join(self.path, f'snapshot-{number:08d}')
 
-class PlayerState(Storage):
-    pass
+    @staticmethod
+    def _parse_name(name: str) -> Optional[tuple[str, int]]:
+        kind, _, number = name.partition('-')
+        if kind not in ('log', 'snapshot') or not number.isdigit():
+            return None
+        return kind, int(number)
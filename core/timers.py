@@ -0,0 +1,204 @@
+import asyncio
+import threading
+import time
+from typing import Callable, Optional
+
+# Resolution of timers, in seconds
+DEFAULT_TICK = 0.1
+
+# Every level of the wheel has 2 ** SLOT_BITS slots, each spanning all slots of the level below.
+# With the default tick, four levels cover delays of up to 13 years
+SLOT_BITS = 8
+LEVELS = 4
+
+
+class Timer:
+    __slots__ = ('expires', 'callback', 'args', '_slot')
+
+    def __init__(self, expires: int, callback: Callable, args: tuple):
+        self.expires = expires
+        self.callback = callback
+        self.args = args
+        self._slot: Optional[dict] = None
+
+    @property
+    def active(self) -> bool:
+        return self._slot is not None
+
+
+class TimingWheel:
+    """
+    A hierarchical timing wheel.
+
+    Time is counted in ticks. A timer is kept in the lowest level whose slots still distinguish
+    its expiry tick from the current one, so scheduling and cancelling take constant time
+    regardless of the number of timers. When the current tick crosses the span of a higher-level
+    slot, the timers of that slot are moved down (cascaded), and timers in the current slot of
+    the lowest level expire.
+
+    Timers can be scheduled and cancelled from any thread; callbacks run on the thread that
+    advances the wheel (the Scheduler loop, see run()).
+    """
+
+    def __init__(self, tick: float = DEFAULT_TICK, slot_bits: int = SLOT_BITS, levels: int = LEVELS):
+        self.tick = tick
+
+        self._slot_bits = slot_bits
+        self._slot_mask = (1 << slot_bits) - 1
+        self._levels: list[list[dict[Timer, None]]] = [
+            [{} for _ in range(1 << slot_bits)] for _ in range(levels)]
+
+        self._start = time.monotonic()
+        self._current = 0
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def schedule(self, delay: float, callback: Callable, *args) -> Timer:
+        """Calls callback(*args) after delay seconds (rounded up to a tick)."""
+        with self._lock:
+            # Ticks are counted from when they are processed, which lags behind the clock by up to a tick
+            ticks = max(1, -int(-delay // self.tick))
+            timer = Timer(self._current + ticks, callback, args)
+            self._insert(timer)
+            self._count += 1
+        return timer
+
+    def cancel(self, timer: Timer) -> bool:
+        """Cancels a timer; returns False if it has already expired or been cancelled."""
+        with self._lock:
+            if timer._slot is None:
+                return False
+            del timer._slot[timer]
+            timer._slot = None
+            self._count -= 1
+        return True
+
+    def __len__(self) -> int:
+        return self._count
+
+    def advance(self, now: Optional[float] = None) -> int:
+        """Processes every tick up to the given time and runs the expired callbacks; returns their number."""
+        if now is None:
+            now = time.monotonic()
+        target = int((now - self._start) / self.tick)
+
+        expired = []
+        with self._lock:
+            if self._count == 0:
+                self._current = max(self._current, target)
+            while self._current < target:
+                self._current += 1
+                self._cascade()
+
+                slot = self._levels[0][self._current & self._slot_mask]
+                if slot:
+                    timers = list(slot)
+                    slot.clear()
+                    for timer in timers:
+                        timer._slot = None
+                    self._count -= len(timers)
+                    expired.extend(timers)
+
+        for timer in expired:
+            timer.callback(*timer.args)
+        return len(expired)
+
+    async def run(self) -> None:
+        while True:
+            await asyncio.sleep(self.tick)
+            self.advance()
+
+    def _insert(self, timer: Timer) -> None:
+        delta = timer.expires - self._current
+
+        level = 0
+        while level < len(self._levels) - 1 and delta >> (self._slot_bits * (level + 1)):
+            level += 1
+
+        # Timers beyond the span of the wheel are parked in the farthest slot and cascaded again
+        shift = self._slot_bits * level
+        expires = min(timer.expires, self._current + (self._slot_mask << shift))
+        slot = self._levels[level][(expires >> shift) & self._slot_mask]
+
+        slot[timer] = None
+        timer._slot = slot
+
+    def _cascade(self) -> None:
+        for level in range(1, len(self._levels)):
+            shift = self._slot_bits * level
+            if self._current & ((1 << shift) - 1):
+                return
+
+            slot = self._levels[level][(self._current >> shift) & self._slot_mask]
+            if slot:
+                timers = list(slot)
+                slot.clear()
+                for timer in timers:
+                    self._insert(timer)
+
+
+class Deadlines:
+    """
+    Named deadlines of a game.
+
+    Setting a deadline replaces the one with the same name. When a deadline expires, on_expired
+    is called with its name and generation; the deadline only counts as expired if expire()
+    confirms that it hasn't been set again or cancelled in the meantime. Until the deadlines are
+    attached to a wheel and resumed, they are only remembered (games set them in their
+    constructors, and while they are replayed).
+    """
+
+    def __init__(self):
+        self._wheel: Optional[TimingWheel] = None
+        self._on_expired: Optional[Callable[[str, int], None]] = None
+        self._paused = True
+
+        self._timers: dict[str, tuple[Optional[Timer], int, float]] = {}
+        self._generation = 0
+
+    def attach(self, wheel: TimingWheel, on_expired: Callable[[str, int], None]) -> None:
+        self._wheel = wheel
+        self._on_expired = on_expired
+
+    def set(self, name: str, delay: float) -> None:
+        self.cancel(name)
+        self._generation += 1
+
+        timer = None
+        if not self._paused:
+            timer = self._wheel.schedule(delay, self._on_expired, name, self._generation)
+        self._timers[name] = (timer, self._generation, delay)
+
+    def cancel(self, name: str) -> None:
+        entry = self._timers.pop(name, None)
+        if entry is not None and entry[0] is not None:
+            self._wheel.cancel(entry[0])
+
+    def pause(self) -> None:
+        """Cancels the scheduled timers but keeps the deadlines, to be scheduled again on resume()."""
+        for name, (timer, generation, delay) in list(self._timers.items()):
+            if timer is not None:
+                self._wheel.cancel(timer)
+            self._timers[name] = (None, generation, delay)
+        self._paused = True
+
+    def resume(self) -> None:
+        if self._wheel is None:
+            return
+        self._paused = False
+        for name, (_, _, delay) in list(self._timers.items()):
+            self.set(name, delay)
+
+    def expire(self, name: str, generation: int) -> bool:
+        entry = self._timers.get(name)
+        if entry is None or entry[1] != generation:
+            return False
+        del self._timers[name]
+        return True
+
+    def delays(self) -> dict[str, float]:
+        """The delays of the pending deadlines, by name (a resumed deadline starts over with its delay)."""
+        return {name: delay for name, (_, _, delay) in self._timers.items()}
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._timers
@@ -0,0 +1,241 @@
+import base64
+import json
+import logging
+import os
+import queue
+import struct
+import threading
+import time
+import zlib
+from typing import Iterator, Optional
+
+from telegram import Chat, User
+
+from core.api import Action, TelegramUpdate, Timeout, Event
+
+logger = logging.getLogger(__name__)
+
+# Every run of a writer appends this header and a zlib stream of records, so that a file can hold
+# the traces of consecutive runs of the bot
+TRACE_MAGIC = b'GBTRACE'
+TRACE_VERSION = 1
+TRACE_HEADER = struct.Struct('<7sB')
+
+# The stream is written in frames (one per batch) with their length and CRC32, so that a torn write
+# left by a crash can be detected and skipped up to the trace of the next run
+FRAME_HEADER = struct.Struct('<II')
+
+# Record kind, flags, game id, milliseconds since the writer was opened, game checksum after the
+# action (see Game.checksum) and body length
+RECORD_HEADER = struct.Struct('<BBQIII')
+
+GAME, UPDATE, TIMEOUT, EVENT = 0, 1, 2, 3
+
+# Set in the record flags when the record carries a checksum
+HAS_CHECKSUM = 1
+
+# Bodies are compressed as a single stream, so the field names repeated in every update cost next to nothing
+COMPRESSION_LEVEL = 6
+
+
+class TraceRecord:
+    __slots__ = ('kind', 'game_id', 'time', 'checksum', 'body')
+
+    def __init__(self, kind: int, game_id: int, time: float, checksum: Optional[int], body: bytes):
+        self.kind = kind
+        self.game_id = game_id
+        self.time = time
+        self.checksum = checksum
+        self.body = body
+
+    @property
+    def game(self) -> dict:
+        """Game name, seed, players, leader, chat and snapshot of a GAME record (see TraceWriter.add_game)."""
+        return json.loads(self.body)
+
+    @property
+    def action(self) -> dict:
+        """The action of an UPDATE, TIMEOUT or EVENT record, as stored by core.storage."""
+        if self.kind == TIMEOUT:
+            return {'timeout': self.body.decode()}
+        name, _, payload = self.body.partition(b'\0')
+        if self.kind == EVENT:
+            return {'event': name.decode(), 'payload': json.loads(payload)}
+        return json.loads(self.body)
+
+
+class TraceWriter:
+    """
+    Writes every action handled by the games to a compact binary trace, along with the games
+    themselves, so that sessions can be replayed headlessly (see replay.py) to reproduce bugs or
+    as realistic load.
+
+    Like Storage, records are encoded and compressed by a writer thread, which flushes the
+    stream after every batch, so that a trace cut short by a crash stays readable up to its last
+    batch. Records of a game are in the order they were handled in; records of different games
+    are interleaved.
+    """
+
+    def __init__(self, path: str, commit_interval: float = 0.05):
+        self.path = path
+        self.commit_interval = commit_interval
+
+        self._queue: queue.SimpleQueue = queue.SimpleQueue()
+        self._writer: Optional[threading.Thread] = None
+        self._file = None
+        self._compressor = None
+        self._start = time.monotonic()
+
+    def open(self) -> None:
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self._file = open(self.path, 'ab')
+        self._file.write(TRACE_HEADER.pack(TRACE_MAGIC, TRACE_VERSION))
+        self._compressor = zlib.compressobj(COMPRESSION_LEVEL)
+        self._start = time.monotonic()
+
+        self._writer = threading.Thread(target=self._write_loop, name='trace', daemon=True)
+        self._writer.start()
+
+    def close(self) -> None:
+        if self._writer is None:
+            return
+        self._queue.put(None)
+        self._writer.join()
+        self._writer = None
+        self._write_frame(self._compressor.flush(zlib.Z_FINISH))
+        self._file.close()
+
+    def add_game(self, game_id: int, game_name: str, seed: int, users: list[User], leader: Optional[User],
+                 chat: Optional[Chat], snapshot: Optional[bytes] = None) -> None:
+        """
+        Records a game as it was created (or restored, in which case its actions are added again),
+        or resumed from a snapshot.
+        """
+        self._queue.put((GAME, game_id, self._now(), None, (game_name, seed, users, leader, chat, snapshot)))
+
+    def add_action(self, game_id: int, action: Action, checksum: Optional[int]) -> None:
+        # Serialization is left to the writer thread
+        if isinstance(action, TelegramUpdate):
+            kind = UPDATE
+        elif isinstance(action, Timeout):
+            kind = TIMEOUT
+        elif isinstance(action, Event):
+            kind = EVENT
+        else:
+            return
+        self._queue.put((kind, game_id, self._now(), checksum, action))
+
+    def _now(self) -> int:
+        return int((time.monotonic() - self._start) * 1000)
+
+    def _write_loop(self) -> None:
+        while True:
+            batch = [self._queue.get()]
+
+            deadline = time.monotonic() + self.commit_interval
+            while batch[-1] is not None:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+
+            try:
+                self._commit(batch)
+            except Exception as e:
+                logger.error("Error while writing the trace", exc_info=e)
+
+            if batch[-1] is None:
+                return
+
+    def _commit(self, batch: list) -> None:
+        chunks = []
+        for item in batch:
+            if item is None:
+                continue
+            kind, game_id, timestamp, checksum, data = item
+            body = _encode_body(kind, data)
+            flags = HAS_CHECKSUM if checksum is not None else 0
+            header = RECORD_HEADER.pack(kind, flags, game_id, timestamp, checksum or 0, len(body))
+            chunks.append(self._compressor.compress(header))
+            chunks.append(self._compressor.compress(body))
+
+        chunks.append(self._compressor.flush(zlib.Z_SYNC_FLUSH))
+        self._write_frame(b''.join(chunks))
+
+    def _write_frame(self, data: bytes) -> None:
+        self._file.write(FRAME_HEADER.pack(len(data), zlib.crc32(data)))
+        self._file.write(data)
+        self._file.flush()
+
+
+def _encode_body(kind: int, data) -> bytes:
+    if kind == GAME:
+        game_name, seed, users, leader, chat, snapshot = data
+        game = {
+            'name': game_name, 'seed': seed, 'players': [x.to_dict() for x in users],
+            'leader': leader.to_dict() if leader is not None else None,
+            'chat': chat.to_dict() if chat is not None else None,
+        }
+        if snapshot is not None:
+            game['snapshot'] = base64.b64encode(snapshot).decode('ascii')
+        return json.dumps(game, separators=(',', ':')).encode()
+    if kind == TIMEOUT:
+        return data.name.encode()
+    if kind == EVENT:
+        return data.name.encode() + b'\0' + json.dumps(data.payload, separators=(',', ':')).encode()
+    return json.dumps(data.raw_update.to_dict(), separators=(',', ':')).encode()
+
+
+def read_trace(path: str) -> Iterator[TraceRecord]:
+    """Yields the records of a trace file, skipping what a crash left torn."""
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    pos = 0
+    decompressor = None
+    records = b''
+    while pos < len(data):
+        if data.startswith(TRACE_MAGIC, pos):
+            _, version = TRACE_HEADER.unpack_from(data, pos)
+            if version != TRACE_VERSION:
+                raise ValueError(f"Unsupported trace version: {version}")
+            decompressor = zlib.decompressobj()
+            records = b''
+            pos += TRACE_HEADER.size
+            continue
+
+        frame = None
+        if decompressor is not None and pos + FRAME_HEADER.size <= len(data):
+            length, crc = FRAME_HEADER.unpack_from(data, pos)
+            frame = data[pos + FRAME_HEADER.size:pos + FRAME_HEADER.size + length]
+            if len(frame) < length or zlib.crc32(frame) != crc:
+                frame = None
+
+        if frame is None:
+            if pos == 0:
+                raise ValueError(f"Not a trace: {path}")
+            logger.warning("Skipping a torn part of trace %s", path)
+            decompressor = None
+            next_run = data.find(TRACE_MAGIC, pos)
+            pos = next_run if next_run >= 0 else len(data)
+            continue
+
+        pos += FRAME_HEADER.size + len(frame)
+        records += decompressor.decompress(frame)
+
+        # Frames end with a flush, so they hold whole records
+        offset = 0
+        while offset + RECORD_HEADER.size <= len(records):
+            kind, flags, game_id, timestamp, checksum, length = RECORD_HEADER.unpack_from(records, offset)
+            body = records[offset + RECORD_HEADER.size:offset + RECORD_HEADER.size + length]
+            if len(body) < length:
+                break
+            yield TraceRecord(kind, game_id, timestamp / 1000, checksum if flags & HAS_CHECKSUM else None, body)
+            offset += RECORD_HEADER.size + length
+        records = records[offset:]
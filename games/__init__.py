@@ -1,2 +1,19 @@
-from games.chess import Chess
-from games.resistance import Resistance
+import importlib
+import json
+import os
+from typing import Any
+
+# Games shipped with the bot, as game names mapped to "module:attribute" specs (see core.registry)
+MANIFEST = os.path.join(os.path.dirname(__file__), 'manifest.json')
+
+
+def __getattr__(name: str) -> Any:
+    # Game classes are only imported when used (e.g. from games import Chess), so that importing
+    # a single game doesn't import all of them
+    with open(MANIFEST) as f:
+        specs = json.load(f).values()
+    for spec in specs:
+        module_name, _, attribute = spec.partition(':')
+        if attribute == name:
+            return getattr(importlib.import_module(module_name), attribute)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
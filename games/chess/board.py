@@ -0,0 +1,694 @@
+import random
+import re
+from typing import Optional
+
+from games.chess.exceptions import GameError
+
+WHITE, BLACK = 0, 1
+PAWN, KNIGHT, BISHOP, ROOK, QUEEN, KING = range(6)
+
+# Pieces are numbered color * 6 + kind, and squares a1 = 0, b1 = 1, ..., h8 = 63
+EMPTY = -1
+
+PIECE_LETTERS = 'PNBRQK'
+FILE_NAMES = 'abcdefgh'
+
+STARTING_FEN = 'rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1'
+
+WHITE_KINGSIDE, WHITE_QUEENSIDE, BLACK_KINGSIDE, BLACK_QUEENSIDE = 1, 2, 4, 8
+CASTLING_LETTERS = 'KQkq'
+
+# Moves are ints: origin | target << 6 | promotion kind << 12 | flag << 15
+NORMAL, DOUBLE_PUSH, EN_PASSANT, CASTLING = range(4)
+
+FULL = (1 << 64) - 1
+RANK_1 = 0xff
+RANK_3 = 0xff << 16
+RANK_6 = 0xff << 40
+RANK_8 = 0xff << 56
+
+SAN_PATTERN = re.compile(r'([NBRQK])?([a-h])?([1-8])?x?([a-h][1-8])(?:=?([NBRQ]))?')
+UCI_PATTERN = re.compile(r'([a-h][1-8])([a-h][1-8])([nbrq])?')
+
+
+def _step_attacks(deltas: list[tuple[int, int]]) -> list[int]:
+    table = []
+    for sq in range(64):
+        attacks = 0
+        for df, dr in deltas:
+            f, r = (sq & 7) + df, (sq >> 3) + dr
+            if 0 <= f < 8 and 0 <= r < 8:
+                attacks |= 1 << (r * 8 + f)
+        table.append(attacks)
+    return table
+
+
+def _ray(sq: int, df: int, dr: int) -> list[int]:
+    squares = []
+    f, r = (sq & 7) + df, (sq >> 3) + dr
+    while 0 <= f < 8 and 0 <= r < 8:
+        squares.append(r * 8 + f)
+        f, r = f + df, r + dr
+    return squares
+
+
+def _line_table(sq: int, direction: tuple[int, int]) -> tuple[int, dict[int, int]]:
+    # Attacks of a slider along one line (both ways) for every occupancy of the line. The last
+    # square of each ray is attacked whether it is occupied or not, so it is left out of the mask
+    df, dr = direction
+    rays = [_ray(sq, df, dr), _ray(sq, -df, -dr)]
+    mask = 0
+    for ray in rays:
+        for s in ray[:-1]:
+            mask |= 1 << s
+
+    table = {}
+    subset = 0
+    while True:
+        attacks = 0
+        for ray in rays:
+            for s in ray:
+                attacks |= 1 << s
+                if subset >> s & 1:
+                    break
+        table[subset] = attacks
+
+        # Next subset of the mask (Carry-Rippler)
+        subset = (subset - mask) & mask
+        if not subset:
+            return mask, table
+
+
+KNIGHT_ATTACKS = _step_attacks([(1, 2), (2, 1), (2, -1), (1, -2), (-1, -2), (-2, -1), (-2, 1), (-1, 2)])
+KING_ATTACKS = _step_attacks([(1, 0), (1, 1), (0, 1), (-1, 1), (-1, 0), (-1, -1), (0, -1), (1, -1)])
+PAWN_ATTACKS = [_step_attacks([(1, 1), (-1, 1)]), _step_attacks([(1, -1), (-1, -1)])]
+
+ROOK_LINES = [_line_table(sq, (1, 0)) + _line_table(sq, (0, 1)) for sq in range(64)]
+BISHOP_LINES = [_line_table(sq, (1, 1)) + _line_table(sq, (1, -1)) for sq in range(64)]
+
+
+def rook_attacks(sq: int, occupied: int) -> int:
+    rank_mask, rank_table, file_mask, file_table = ROOK_LINES[sq]
+    return rank_table[occupied & rank_mask] | file_table[occupied & file_mask]
+
+
+def bishop_attacks(sq: int, occupied: int) -> int:
+    diag_mask, diag_table, anti_mask, anti_table = BISHOP_LINES[sq]
+    return diag_table[occupied & diag_mask] | anti_table[occupied & anti_mask]
+
+
+def _line_tables() -> tuple[list[list[int]], list[list[int]]]:
+    # Squares strictly between two aligned squares, and the whole line through them
+    between = [[0] * 64 for _ in range(64)]
+    line = [[0] * 64 for _ in range(64)]
+    for sq in range(64):
+        for df, dr in [(1, 0), (0, 1), (1, 1), (1, -1), (-1, 0), (0, -1), (-1, -1), (-1, 1)]:
+            full = 1 << sq
+            for s in _ray(sq, df, dr) + _ray(sq, -df, -dr):
+                full |= 1 << s
+            passed = 0
+            for s in _ray(sq, df, dr):
+                between[sq][s] = passed
+                line[sq][s] = full
+                passed |= 1 << s
+    return between, line
+
+
+BETWEEN, LINE = _line_tables()
+
+# Castling rights kept when a piece moves from or to a square
+CASTLING_KEEP = [15] * 64
+CASTLING_KEEP[0] = 15 & ~WHITE_QUEENSIDE
+CASTLING_KEEP[7] = 15 & ~WHITE_KINGSIDE
+CASTLING_KEEP[4] = 15 & ~(WHITE_KINGSIDE | WHITE_QUEENSIDE)
+CASTLING_KEEP[56] = 15 & ~BLACK_QUEENSIDE
+CASTLING_KEEP[63] = 15 & ~BLACK_KINGSIDE
+CASTLING_KEEP[60] = 15 & ~(BLACK_KINGSIDE | BLACK_QUEENSIDE)
+
+# Rook moves of castling by the target square of the king
+CASTLING_ROOKS = {6: (7, 5), 2: (0, 3), 62: (63, 61), 58: (56, 59)}
+
+# Zobrist keys; the seed is fixed so that keys agree between processes
+_zobrist = random.Random(0x5EED)
+ZOBRIST_PIECES = [[_zobrist.getrandbits(64) for _ in range(64)] for _ in range(12)]
+ZOBRIST_CASTLING = [_zobrist.getrandbits(64) for _ in range(16)]
+ZOBRIST_EN_PASSANT = [_zobrist.getrandbits(64) for _ in range(8)]
+ZOBRIST_BLACK = _zobrist.getrandbits(64)
+
+
+def square_name(sq: int) -> str:
+    return FILE_NAMES[sq & 7] + str((sq >> 3) + 1)
+
+
+def parse_square(name: str) -> int:
+    return (int(name[1]) - 1) * 8 + FILE_NAMES.index(name[0])
+
+
+def encode_move(origin: int, target: int, promotion: int = 0, flag: int = NORMAL) -> int:
+    return origin | target << 6 | promotion << 12 | flag << 15
+
+
+def move_to_uci(move: int) -> str:
+    promotion = (move >> 12) & 7
+    return (square_name(move & 63) + square_name((move >> 6) & 63)
+            + (PIECE_LETTERS[promotion].lower() if promotion else ''))
+
+
+def _squares(bitboard: int):
+    while bitboard:
+        lsb = bitboard & -bitboard
+        yield lsb.bit_length() - 1
+        bitboard ^= lsb
+
+
+class Board:
+    """
+    A chess position on bitboards, with legal move generation, make/unmake and the history
+    needed for the repetition rule.
+
+    Every piece has a bitboard, and a mailbox array maps squares back to pieces. The Zobrist
+    key of the position is updated incrementally by make_move() and unmake_move().
+    """
+
+    __slots__ = ('pieces', 'colors', 'squares', 'turn', 'castling', 'ep_square', 'halfmove_clock',
+                 'fullmove_number', 'key', '_undo', '_keys')
+
+    def __init__(self, fen: str = STARTING_FEN):
+        self.set_fen(fen)
+
+    def set_fen(self, fen: str) -> None:
+        fields = fen.split()
+        if len(fields) not in (4, 6):
+            raise GameError(f"Invalid FEN: {fen}")
+
+        self.pieces = [0] * 12
+        self.colors = [0, 0]
+        self.squares = [EMPTY] * 64
+
+        ranks = fields[0].split('/')
+        if len(ranks) != 8:
+            raise GameError(f"Invalid FEN: {fen}")
+        for rank_idx, rank in enumerate(ranks):
+            file = 0
+            for char in rank:
+                if char.isdigit():
+                    file += int(char)
+                    continue
+                kind = PIECE_LETTERS.find(char.upper())
+                if kind == -1 or file > 7:
+                    raise GameError(f"Invalid FEN: {fen}")
+                self._put(WHITE if char.isupper() else BLACK, kind, (7 - rank_idx) * 8 + file)
+                file += 1
+            if file != 8:
+                raise GameError(f"Invalid FEN: {fen}")
+
+        if bin(self.pieces[KING]).count('1') != 1 or bin(self.pieces[6 + KING]).count('1') != 1:
+            raise GameError("Each side must have exactly one king")
+
+        if fields[1] not in ('w', 'b'):
+            raise GameError(f"Invalid FEN: {fen}")
+        self.turn = WHITE if fields[1] == 'w' else BLACK
+
+        self.castling = 0
+        if fields[2] != '-':
+            for char in fields[2]:
+                if char not in CASTLING_LETTERS:
+                    raise GameError(f"Invalid FEN: {fen}")
+                self.castling |= 1 << CASTLING_LETTERS.index(char)
+
+        try:
+            self.ep_square = parse_square(fields[3]) if fields[3] != '-' else EMPTY
+            self.halfmove_clock = int(fields[4]) if len(fields) == 6 else 0
+            self.fullmove_number = int(fields[5]) if len(fields) == 6 else 1
+        except (ValueError, IndexError):
+            raise GameError(f"Invalid FEN: {fen}")
+
+        self.key = self._compute_key()
+        self._undo: list[tuple] = []
+        self._keys = [self.key]
+
+    def fen(self) -> str:
+        ranks = []
+        for rank in range(7, -1, -1):
+            text, empty = '', 0
+            for file in range(8):
+                piece = self.squares[rank * 8 + file]
+                if piece == EMPTY:
+                    empty += 1
+                    continue
+                if empty:
+                    text += str(empty)
+                    empty = 0
+                letter = PIECE_LETTERS[piece % 6]
+                text += letter if piece < 6 else letter.lower()
+            ranks.append(text + (str(empty) if empty else ''))
+
+        castling = ''.join(x for i, x in enumerate(CASTLING_LETTERS) if self.castling >> i & 1) or '-'
+        ep = square_name(self.ep_square) if self.ep_square != EMPTY else '-'
+        return (f"{'/'.join(ranks)} {'wb'[self.turn]} {castling} {ep} "
+                f"{self.halfmove_clock} {self.fullmove_number}")
+
+    def copy(self) -> 'Board':
+        board = Board.__new__(Board)
+        board.pieces = self.pieces[:]
+        board.colors = self.colors[:]
+        board.squares = self.squares[:]
+        board.turn = self.turn
+        board.castling = self.castling
+        board.ep_square = self.ep_square
+        board.halfmove_clock = self.halfmove_clock
+        board.fullmove_number = self.fullmove_number
+        board.key = self.key
+        board._undo = self._undo[:]
+        board._keys = self._keys[:]
+        return board
+
+    @property
+    def occupied(self) -> int:
+        return self.colors[WHITE] | self.colors[BLACK]
+
+    def king_square(self, color: int) -> int:
+        return self.pieces[color * 6 + KING].bit_length() - 1
+
+    def is_attacked(self, sq: int, by: int, occupied: Optional[int] = None) -> bool:
+        if occupied is None:
+            occupied = self.colors[WHITE] | self.colors[BLACK]
+        p = self.pieces
+        base = by * 6
+        return bool(PAWN_ATTACKS[by ^ 1][sq] & p[base + PAWN]
+                    or KNIGHT_ATTACKS[sq] & p[base + KNIGHT]
+                    or KING_ATTACKS[sq] & p[base + KING]
+                    or bishop_attacks(sq, occupied) & (p[base + BISHOP] | p[base + QUEEN])
+                    or rook_attacks(sq, occupied) & (p[base + ROOK] | p[base + QUEEN]))
+
+    def is_check(self) -> bool:
+        return self.is_attacked(self.king_square(self.turn), self.turn ^ 1)
+
+    def pseudo_legal_moves(self) -> list[int]:
+        """Moves that follow the movement rules but may leave the own king in check."""
+        us = self.turn
+        them = us ^ 1
+        p = self.pieces
+        base = us * 6
+        own = self.colors[us]
+        enemy = self.colors[them]
+        occupied = own | enemy
+        empty = ~occupied & FULL
+        targets = ~own & FULL
+
+        moves = []
+        append = moves.append
+
+        # Pawn pushes
+        pawns = p[base + PAWN]
+        if us == WHITE:
+            single = (pawns << 8) & empty
+            double = ((single & RANK_3) << 8) & empty
+            step, last_rank = 8, RANK_8
+        else:
+            single = (pawns >> 8) & empty
+            double = ((single & RANK_6) >> 8) & empty
+            step, last_rank = -8, RANK_1
+
+        for to in _squares(single):
+            if last_rank >> to & 1:
+                for promotion in (QUEEN, ROOK, BISHOP, KNIGHT):
+                    append((to - step) | to << 6 | promotion << 12)
+            else:
+                append((to - step) | to << 6)
+        for to in _squares(double):
+            append((to - 2 * step) | to << 6 | DOUBLE_PUSH << 15)
+
+        # Pawn captures
+        pawn_attacks = PAWN_ATTACKS[us]
+        ep = self.ep_square
+        for frm in _squares(pawns):
+            attacks = pawn_attacks[frm]
+            for to in _squares(attacks & enemy):
+                if last_rank >> to & 1:
+                    for promotion in (QUEEN, ROOK, BISHOP, KNIGHT):
+                        append(frm | to << 6 | promotion << 12)
+                else:
+                    append(frm | to << 6)
+            if ep != EMPTY and attacks >> ep & 1:
+                append(frm | ep << 6 | EN_PASSANT << 15)
+
+        for frm in _squares(p[base + KNIGHT]):
+            for to in _squares(KNIGHT_ATTACKS[frm] & targets):
+                append(frm | to << 6)
+        for frm in _squares(p[base + BISHOP]):
+            for to in _squares(bishop_attacks(frm, occupied) & targets):
+                append(frm | to << 6)
+        for frm in _squares(p[base + ROOK]):
+            for to in _squares(rook_attacks(frm, occupied) & targets):
+                append(frm | to << 6)
+        for frm in _squares(p[base + QUEEN]):
+            for to in _squares((rook_attacks(frm, occupied) | bishop_attacks(frm, occupied)) & targets):
+                append(frm | to << 6)
+
+        king = p[base + KING].bit_length() - 1
+        for to in _squares(KING_ATTACKS[king] & targets):
+            append(king | to << 6)
+
+        # Castling; the king must not be in check nor pass through an attacked square. The
+        # target square is checked like for any other king move
+        if self.castling:
+            if us == WHITE:
+                if (self.castling & WHITE_KINGSIDE and not occupied & 0x60
+                        and not self.is_attacked(4, them, occupied) and not self.is_attacked(5, them, occupied)):
+                    append(4 | 6 << 6 | CASTLING << 15)
+                if (self.castling & WHITE_QUEENSIDE and not occupied & 0x0e
+                        and not self.is_attacked(4, them, occupied) and not self.is_attacked(3, them, occupied)):
+                    append(4 | 2 << 6 | CASTLING << 15)
+            else:
+                if (self.castling & BLACK_KINGSIDE and not occupied & (0x60 << 56)
+                        and not self.is_attacked(60, them, occupied) and not self.is_attacked(61, them, occupied)):
+                    append(60 | 62 << 6 | CASTLING << 15)
+                if (self.castling & BLACK_QUEENSIDE and not occupied & (0x0e << 56)
+                        and not self.is_attacked(60, them, occupied) and not self.is_attacked(59, them, occupied)):
+                    append(60 | 58 << 6 | CASTLING << 15)
+
+        return moves
+
+    def legal_moves(self) -> list[int]:
+        us = self.turn
+        them = us ^ 1
+        king = self.king_square(us)
+        occupied = self.colors[WHITE] | self.colors[BLACK]
+        in_check = self.is_attacked(king, them, occupied)
+        pinned = self._pinned(king)
+        line = LINE[king]
+
+        moves = []
+        for move in self.pseudo_legal_moves():
+            frm = move & 63
+            # Out of check, only king moves, en passant and moves of pinned pieces can be illegal
+            if not in_check and frm != king and move >> 15 != EN_PASSANT:
+                if not pinned >> frm & 1 or line[frm] >> ((move >> 6) & 63) & 1:
+                    moves.append(move)
+            elif self._is_legal_slow(move):
+                moves.append(move)
+        return moves
+
+    def is_legal(self, move: int) -> bool:
+        return move in self.pseudo_legal_moves() and self._is_legal_slow(move)
+
+    def make_move(self, move: int) -> None:
+        frm = move & 63
+        to = (move >> 6) & 63
+        promotion = (move >> 12) & 7
+        flag = move >> 15
+
+        pieces, colors, squares = self.pieces, self.colors, self.squares
+        us = self.turn
+        them = us ^ 1
+        piece = squares[frm]
+        captured = squares[to]
+        key = self.key
+        self._undo.append((move, captured, self.castling, self.ep_square, self.halfmove_clock, key))
+
+        from_bit, to_bit = 1 << frm, 1 << to
+        if captured != EMPTY:
+            pieces[captured] ^= to_bit
+            colors[them] ^= to_bit
+            key ^= ZOBRIST_PIECES[captured][to]
+        elif flag == EN_PASSANT:
+            cap_sq = to - 8 if us == WHITE else to + 8
+            cap = them * 6 + PAWN
+            pieces[cap] ^= 1 << cap_sq
+            colors[them] ^= 1 << cap_sq
+            squares[cap_sq] = EMPTY
+            key ^= ZOBRIST_PIECES[cap][cap_sq]
+
+        pieces[piece] ^= from_bit | to_bit
+        colors[us] ^= from_bit | to_bit
+        squares[frm] = EMPTY
+        squares[to] = piece
+        key ^= ZOBRIST_PIECES[piece][frm] ^ ZOBRIST_PIECES[piece][to]
+
+        if promotion:
+            new = us * 6 + promotion
+            pieces[piece] ^= to_bit
+            pieces[new] ^= to_bit
+            squares[to] = new
+            key ^= ZOBRIST_PIECES[piece][to] ^ ZOBRIST_PIECES[new][to]
+        elif flag == CASTLING:
+            rook_from, rook_to = CASTLING_ROOKS[to]
+            rook = us * 6 + ROOK
+            bits = 1 << rook_from | 1 << rook_to
+            pieces[rook] ^= bits
+            colors[us] ^= bits
+            squares[rook_from] = EMPTY
+            squares[rook_to] = rook
+            key ^= ZOBRIST_PIECES[rook][rook_from] ^ ZOBRIST_PIECES[rook][rook_to]
+
+        castling = self.castling & CASTLING_KEEP[frm] & CASTLING_KEEP[to]
+        if castling != self.castling:
+            key ^= ZOBRIST_CASTLING[self.castling] ^ ZOBRIST_CASTLING[castling]
+            self.castling = castling
+
+        # The en passant square is only set when a capture is possible, so that it doesn't tell
+        # apart otherwise identical positions
+        if self.ep_square != EMPTY:
+            key ^= ZOBRIST_EN_PASSANT[self.ep_square & 7]
+        self.ep_square = EMPTY
+        if flag == DOUBLE_PUSH:
+            sq = (frm + to) >> 1
+            if PAWN_ATTACKS[us][sq] & pieces[them * 6 + PAWN]:
+                self.ep_square = sq
+                key ^= ZOBRIST_EN_PASSANT[sq & 7]
+
+        if piece % 6 == PAWN or captured != EMPTY:
+            self.halfmove_clock = 0
+        else:
+            self.halfmove_clock += 1
+        if us == BLACK:
+            self.fullmove_number += 1
+
+        self.turn = them
+        key ^= ZOBRIST_BLACK
+        self.key = key
+        self._keys.append(key)
+
+    def unmake_move(self) -> int:
+        """Takes back the last move and returns it."""
+        move, captured, castling, ep_square, halfmove_clock, key = self._undo.pop()
+        self._keys.pop()
+
+        frm = move & 63
+        to = (move >> 6) & 63
+        promotion = (move >> 12) & 7
+        flag = move >> 15
+
+        pieces, colors, squares = self.pieces, self.colors, self.squares
+        them = self.turn
+        us = them ^ 1
+        from_bit, to_bit = 1 << frm, 1 << to
+
+        piece = squares[to]
+        if promotion:
+            pieces[piece] ^= to_bit
+            piece = us * 6 + PAWN
+            pieces[piece] ^= to_bit
+
+        pieces[piece] ^= from_bit | to_bit
+        colors[us] ^= from_bit | to_bit
+        squares[frm] = piece
+        squares[to] = EMPTY
+
+        if captured != EMPTY:
+            pieces[captured] ^= to_bit
+            colors[them] ^= to_bit
+            squares[to] = captured
+        elif flag == EN_PASSANT:
+            cap_sq = to - 8 if us == WHITE else to + 8
+            cap = them * 6 + PAWN
+            pieces[cap] ^= 1 << cap_sq
+            colors[them] ^= 1 << cap_sq
+            squares[cap_sq] = cap
+        elif flag == CASTLING:
+            rook_from, rook_to = CASTLING_ROOKS[to]
+            rook = us * 6 + ROOK
+            bits = 1 << rook_from | 1 << rook_to
+            pieces[rook] ^= bits
+            colors[us] ^= bits
+            squares[rook_to] = EMPTY
+            squares[rook_from] = rook
+
+        self.castling = castling
+        self.ep_square = ep_square
+        self.halfmove_clock = halfmove_clock
+        if us == BLACK:
+            self.fullmove_number -= 1
+        self.turn = us
+        self.key = key
+        return move
+
+    @property
+    def move_stack(self) -> list[int]:
+        return [x[0] for x in self._undo]
+
+    def is_capture(self, move: int) -> bool:
+        return self.squares[(move >> 6) & 63] != EMPTY or move >> 15 == EN_PASSANT
+
+    def is_checkmate(self) -> bool:
+        return self.is_check() and not self.legal_moves()
+
+    def is_stalemate(self) -> bool:
+        return not self.is_check() and not self.legal_moves()
+
+    def is_insufficient_material(self) -> bool:
+        # Only bare kings, or a single minor piece against a bare king
+        p = self.pieces
+        if p[PAWN] | p[ROOK] | p[QUEEN] | p[6 + PAWN] | p[6 + ROOK] | p[6 + QUEEN]:
+            return False
+        minors = p[KNIGHT] | p[BISHOP] | p[6 + KNIGHT] | p[6 + BISHOP]
+        return minors & (minors - 1) == 0
+
+    def is_fifty_moves(self) -> bool:
+        return self.halfmove_clock >= 100
+
+    def is_repetition(self, count: int = 3) -> bool:
+        """Whether the position occurred count times; only positions since the last capture or pawn move can repeat."""
+        keys = self._keys
+        seen = 0
+        for i in range(len(keys) - 1, max(-1, len(keys) - 2 - self.halfmove_clock), -2):
+            if keys[i] == self.key:
+                seen += 1
+                if seen >= count:
+                    return True
+        return False
+
+    def san(self, move: int) -> str:
+        """Standard algebraic notation of a legal move."""
+        frm = move & 63
+        to = (move >> 6) & 63
+        promotion = (move >> 12) & 7
+        flag = move >> 15
+
+        if flag == CASTLING:
+            text = 'O-O' if to & 7 == 6 else 'O-O-O'
+        else:
+            piece = self.squares[frm]
+            kind = piece % 6
+            capture = self.is_capture(move)
+
+            if kind == PAWN:
+                text = (FILE_NAMES[frm & 7] + 'x' if capture else '') + square_name(to)
+                if promotion:
+                    text += '=' + PIECE_LETTERS[promotion]
+            else:
+                others = [m & 63 for m in self.legal_moves()
+                          if (m >> 6) & 63 == to and m & 63 != frm and self.squares[m & 63] == piece]
+                disambiguation = ''
+                if others:
+                    if all(x & 7 != frm & 7 for x in others):
+                        disambiguation = FILE_NAMES[frm & 7]
+                    elif all(x >> 3 != frm >> 3 for x in others):
+                        disambiguation = str((frm >> 3) + 1)
+                    else:
+                        disambiguation = square_name(frm)
+                text = PIECE_LETTERS[kind] + disambiguation + ('x' if capture else '') + square_name(to)
+
+        self.make_move(move)
+        if self.is_check():
+            text += '#' if not self.legal_moves() else '+'
+        self.unmake_move()
+        return text
+
+    def parse_san(self, text: str) -> int:
+        """Finds the legal move written in standard algebraic notation (or as UCI, e.g. e2e4)."""
+        text = text.strip().rstrip('+#!?')
+
+        match = UCI_PATTERN.fullmatch(text)
+        if match is not None:
+            frm, to = parse_square(match.group(1)), parse_square(match.group(2))
+            promotion = PIECE_LETTERS.index(match.group(3).upper()) if match.group(3) else 0
+            candidates = [m for m in self.pseudo_legal_moves()
+                          if m & 63 == frm and (m >> 6) & 63 == to and (m >> 12) & 7 == promotion]
+            return self._single_legal(candidates, text)
+
+        if text in ('O-O', '0-0', 'O-O-O', '0-0-0'):
+            to = (6 if len(text) == 3 else 2) + 56 * self.turn
+            candidates = [m for m in self.pseudo_legal_moves() if m >> 15 == CASTLING and (m >> 6) & 63 == to]
+            return self._single_legal(candidates, text)
+
+        match = SAN_PATTERN.fullmatch(text)
+        if match is None:
+            raise GameError(f"Can't read the move {text}")
+        letter, file, rank, target, promotion = match.groups()
+
+        piece = self.turn * 6 + (PIECE_LETTERS.index(letter) if letter else PAWN)
+        to = parse_square(target)
+        promotion = PIECE_LETTERS.index(promotion) if promotion else 0
+        candidates = [m for m in self.pseudo_legal_moves()
+                      if (m >> 6) & 63 == to and self.squares[m & 63] == piece and (m >> 12) & 7 == promotion
+                      and m >> 15 != CASTLING
+                      and (file is None or FILE_NAMES[m & 7] == file)
+                      and (rank is None or str(((m & 63) >> 3) + 1) == rank)]
+        return self._single_legal(candidates, text)
+
+    def _single_legal(self, candidates: list[int], text: str) -> int:
+        legal = [m for m in candidates if self._is_legal_slow(m)]
+        if not legal:
+            raise GameError(f"Illegal move: {text}")
+        if len(legal) > 1:
+            raise GameError(f"Ambiguous move: {text}")
+        return legal[0]
+
+    def _is_legal_slow(self, move: int) -> bool:
+        self.make_move(move)
+        legal = not self.is_attacked(self.king_square(self.turn ^ 1), self.turn)
+        self.unmake_move()
+        return legal
+
+    def _pinned(self, king: int) -> int:
+        us = self.turn
+        base = (us ^ 1) * 6
+        p = self.pieces
+        own = self.colors[us]
+        enemy = self.colors[us ^ 1]
+        occupied = own | enemy
+
+        # Enemy sliders that would attack the king if our pieces were out of the way
+        snipers = (rook_attacks(king, enemy) & (p[base + ROOK] | p[base + QUEEN])
+                   | bishop_attacks(king, enemy) & (p[base + BISHOP] | p[base + QUEEN]))
+        pinned = 0
+        between = BETWEEN[king]
+        for sniper in _squares(snipers):
+            blockers = between[sniper] & occupied
+            if blockers and not blockers & (blockers - 1) and blockers & own:
+                pinned |= blockers
+        return pinned
+
+    def _put(self, color: int, kind: int, sq: int) -> None:
+        piece = color * 6 + kind
+        self.pieces[piece] |= 1 << sq
+        self.colors[color] |= 1 << sq
+        self.squares[sq] = piece
+
+    def _compute_key(self) -> int:
+        key = 0
+        for sq, piece in enumerate(self.squares):
+            if piece != EMPTY:
+                key ^= ZOBRIST_PIECES[piece][sq]
+        key ^= ZOBRIST_CASTLING[self.castling]
+        if self.ep_square != EMPTY:
+            key ^= ZOBRIST_EN_PASSANT[self.ep_square & 7]
+        if self.turn == BLACK:
+            key ^= ZOBRIST_BLACK
+        return key
+
+
+def perft(board: Board, depth: int) -> int:
+    """Number of leaf positions of the move tree of the given depth (used to check move generation)."""
+    moves = board.legal_moves()
+    if depth <= 1:
+        return len(moves) if depth == 1 else 1
+
+    nodes = 0
+    for move in moves:
+        board.make_move(move)
+        nodes += perft(board, depth - 1)
+        board.unmake_move()
+    return nodes
@@ -0,0 +1,532 @@
+import multiprocessing
+import os
+import threading
+import time
+from array import array
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Optional
+
+from games.chess.board import Board, EMPTY, EN_PASSANT, PAWN, QUEEN, KING
+from games.chess.exceptions import GameError
+
+# Centipawn values of the pieces, by kind
+PIECE_VALUES = [100, 320, 330, 500, 900, 0]
+
+# Piece-square tables from White's point of view, rank 8 first (the way a board is printed)
+_PAWN_TABLE = [
+    0, 0, 0, 0, 0, 0, 0, 0,
+    50, 50, 50, 50, 50, 50, 50, 50,
+    10, 10, 20, 30, 30, 20, 10, 10,
+    5, 5, 10, 25, 25, 10, 5, 5,
+    0, 0, 0, 20, 20, 0, 0, 0,
+    5, -5, -10, 0, 0, -10, -5, 5,
+    5, 10, 10, -20, -20, 10, 10, 5,
+    0, 0, 0, 0, 0, 0, 0, 0,
+]
+_KNIGHT_TABLE = [
+    -50, -40, -30, -30, -30, -30, -40, -50,
+    -40, -20, 0, 0, 0, 0, -20, -40,
+    -30, 0, 10, 15, 15, 10, 0, -30,
+    -30, 5, 15, 20, 20, 15, 5, -30,
+    -30, 0, 15, 20, 20, 15, 0, -30,
+    -30, 5, 10, 15, 15, 10, 5, -30,
+    -40, -20, 0, 5, 5, 0, -20, -40,
+    -50, -40, -30, -30, -30, -30, -40, -50,
+]
+_BISHOP_TABLE = [
+    -20, -10, -10, -10, -10, -10, -10, -20,
+    -10, 0, 0, 0, 0, 0, 0, -10,
+    -10, 0, 5, 10, 10, 5, 0, -10,
+    -10, 5, 5, 10, 10, 5, 5, -10,
+    -10, 0, 10, 10, 10, 10, 0, -10,
+    -10, 10, 10, 10, 10, 10, 10, -10,
+    -10, 5, 0, 0, 0, 0, 5, -10,
+    -20, -10, -10, -10, -10, -10, -10, -20,
+]
+_ROOK_TABLE = [
+    0, 0, 0, 0, 0, 0, 0, 0,
+    5, 10, 10, 10, 10, 10, 10, 5,
+    -5, 0, 0, 0, 0, 0, 0, -5,
+    -5, 0, 0, 0, 0, 0, 0, -5,
+    -5, 0, 0, 0, 0, 0, 0, -5,
+    -5, 0, 0, 0, 0, 0, 0, -5,
+    -5, 0, 0, 0, 0, 0, 0, -5,
+    0, 0, 0, 5, 5, 0, 0, 0,
+]
+_QUEEN_TABLE = [
+    -20, -10, -10, -5, -5, -10, -10, -20,
+    -10, 0, 0, 0, 0, 0, 0, -10,
+    -10, 0, 5, 5, 5, 5, 0, -10,
+    -5, 0, 5, 5, 5, 5, 0, -5,
+    0, 0, 5, 5, 5, 5, 0, -5,
+    -10, 5, 5, 5, 5, 5, 0, -10,
+    -10, 0, 5, 0, 0, 0, 0, -10,
+    -20, -10, -10, -5, -5, -10, -10, -20,
+]
+_KING_TABLE = [
+    -30, -40, -40, -50, -50, -40, -40, -30,
+    -30, -40, -40, -50, -50, -40, -40, -30,
+    -30, -40, -40, -50, -50, -40, -40, -30,
+    -30, -40, -40, -50, -50, -40, -40, -30,
+    -20, -30, -30, -40, -40, -30, -30, -20,
+    -10, -20, -20, -20, -20, -20, -20, -10,
+    20, 20, 0, 0, 0, 0, 20, 20,
+    20, 30, 10, 0, 0, 10, 30, 20,
+]
+# Without the heavy pieces the king should come to the center, and the losing king gets mated on the edge
+_KING_ENDGAME_TABLE = [
+    -50, -40, -30, -20, -20, -30, -40, -50,
+    -30, -20, -10, 0, 0, -10, -20, -30,
+    -30, -10, 20, 30, 30, 20, -10, -30,
+    -30, -10, 30, 40, 40, 30, -10, -30,
+    -30, -10, 30, 40, 40, 30, -10, -30,
+    -30, -10, 20, 30, 30, 20, -10, -30,
+    -30, -30, 0, 0, 0, 0, -30, -30,
+    -50, -30, -30, -30, -30, -30, -30, -50,
+]
+
+
+def _square_values(kind: int, table: list[int]) -> list[list[int]]:
+    # Signed values of a white and a black piece of the kind on every square; a1 = 0 is the
+    # bottom left of the printed table, and Black's table is White's mirrored vertically
+    white = [PIECE_VALUES[kind] + table[(7 - (sq >> 3)) * 8 + (sq & 7)] for sq in range(64)]
+    black = [-white[sq ^ 56] for sq in range(64)]
+    return [white, black]
+
+
+_values = [_square_values(kind, table) for kind, table in
+           enumerate([_PAWN_TABLE, _KNIGHT_TABLE, _BISHOP_TABLE, _ROOK_TABLE, _QUEEN_TABLE, _KING_TABLE])]
+SQUARE_VALUES = [_values[kind][0] for kind in range(6)] + [_values[kind][1] for kind in range(6)]
+
+_king_endgame = _square_values(KING, _KING_ENDGAME_TABLE)
+KING_ENDGAME_SHIFT = [[eg - mg for eg, mg in zip(_king_endgame[color], SQUARE_VALUES[color * 6 + KING])]
+                      for color in range(2)]
+
+# Game phase: 24 with all the pieces on the board, 0 with only kings and pawns left
+PHASE_WEIGHTS = [0, 1, 1, 2, 4, 0] * 2
+MAX_PHASE = 24
+
+# Orders captures by the value of the victim first, then by the value of the attacker (MVV-LVA)
+MVV_LVA = [[(1 << 20) + (victim + 1) * 16 - attacker for attacker in range(6)] for victim in range(6)]
+KILLER_SCORES = [1 << 19, 1 << 18]
+MAX_HISTORY = (1 << 18) - 1
+
+MATE = 100000
+# Scores beyond this are mates, found the number of plies below MATE away from the root
+MATE_BOUND = MATE - 1000
+INFINITY = MATE + 1
+
+# Bounds of transposition table scores; 0 marks an empty slot
+EXACT, LOWER, UPPER = 1, 2, 3
+
+# Every entry of the transposition table takes two 64-bit words
+ENTRY_BYTES = 16
+DEFAULT_TT_BYTES = 16 << 20
+
+# Scores are stored with this offset, so that the packed entries stay positive
+SCORE_OFFSET = 1 << 17
+
+MAX_PLY = 64
+MAX_DEPTH = 32
+
+# The clock is read once per this many nodes (plus one)
+CLOCK_CHECK_MASK = 1023
+
+# An iteration takes several times as long as the previous one, so none is started after this
+# fraction of the time budget is spent
+NEXT_ITERATION_FRACTION = 0.4
+
+# Time budget of the bot's moves, in seconds
+DEFAULT_MOVE_TIME = 2.0
+
+# Searches get at least this much time even if they waited for a free process past their budget
+MIN_MOVE_TIME = 0.05
+
+# The bot keeps a CPU for the dispatcher and the loop
+DEFAULT_SEARCH_WORKERS = max(1, (os.cpu_count() or 2) - 1)
+
+
+def evaluate(board: Board) -> int:
+    """Static score of the position in centipawns, from the point of view of the side to move."""
+    score = 0
+    phase = 0
+    for sq, piece in enumerate(board.squares):
+        if piece != EMPTY:
+            score += SQUARE_VALUES[piece][sq]
+            phase += PHASE_WEIGHTS[piece]
+
+    if phase < MAX_PHASE:
+        weight = MAX_PHASE - min(phase, MAX_PHASE)
+        shift = (KING_ENDGAME_SHIFT[0][board.king_square(0)] + KING_ENDGAME_SHIFT[1][board.king_square(1)])
+        score += shift * weight // MAX_PHASE
+
+    return score if board.turn == 0 else -score
+
+
+class TranspositionTable:
+    """
+    A fixed-size hash table of search results, indexed by the Zobrist keys of the positions.
+
+    The entries live in two preallocated arrays (the keys, and the best moves, depths, bounds,
+    scores and search generations packed into one word), so the table never grows past its
+    memory cap. A slot taken by another position is only replaced by a result at least as deep,
+    unless the old entry was stored by an earlier search.
+    """
+
+    def __init__(self, max_bytes: int = DEFAULT_TT_BYTES):
+        if max_bytes < ENTRY_BYTES:
+            raise GameError("The transposition table needs room for at least one entry")
+
+        size = 1
+        while size * 2 * ENTRY_BYTES <= max_bytes:
+            size *= 2
+        self.size = size
+        self.generation = 0
+
+        self._mask = size - 1
+        self._keys = array('Q', bytes(8 * size))
+        self._data = array('q', bytes(8 * size))
+
+    @property
+    def memory(self) -> int:
+        return self.size * ENTRY_BYTES
+
+    def new_search(self) -> None:
+        self.generation = (self.generation + 1) & 0xff
+
+    def probe(self, key: int) -> Optional[tuple[int, int, int, int]]:
+        """Returns (move, depth, bound, score) stored for the position, if any."""
+        i = key & self._mask
+        if self._keys[i] != key:
+            return None
+        data = self._data[i]
+        return data & 0x1ffff, (data >> 17) & 0xff, (data >> 25) & 3, (data >> 35) - SCORE_OFFSET
+
+    def store(self, key: int, move: int, depth: int, bound: int, score: int) -> None:
+        i = key & self._mask
+        data = self._data[i]
+        if (self._keys[i] != key and data and (data >> 27) & 0xff == self.generation
+                and (data >> 17) & 0xff > depth):
+            return
+
+        self._keys[i] = key
+        self._data[i] = move | depth << 17 | bound << 25 | self.generation << 27 | (score + SCORE_OFFSET) << 35
+
+    def usage(self) -> float:
+        """Share of the slots in use."""
+        return sum(1 for x in self._data if x) / self.size
+
+    def clear(self) -> None:
+        self._keys = array('Q', bytes(8 * self.size))
+        self._data = array('q', bytes(8 * self.size))
+
+
+class SearchResult:
+    __slots__ = ('move', 'score', 'depth', 'nodes', 'seconds')
+
+    def __init__(self, move: int, score: int, depth: int, nodes: int, seconds: float):
+        self.move = move
+        self.score = score
+        self.depth = depth
+        self.nodes = nodes
+        self.seconds = seconds
+
+    @property
+    def mate_in(self) -> Optional[int]:
+        """Number of moves to the mate found by the search (negative when the side to move is mated)."""
+        if abs(self.score) < MATE_BOUND:
+            return None
+        plies = MATE - abs(self.score)
+        return (plies + 1) // 2 if self.score > 0 else -(plies // 2)
+
+
+class SearchTimeout(Exception):
+    pass
+
+
+class Searcher:
+    """
+    Iterative deepening alpha-beta search (negamax with principal variation search), with a
+    quiescence search of captures at the leaves.
+
+    Moves are tried in order of the move stored in the transposition table, captures by MVV-LVA,
+    killer moves and the history heuristic. The search stops when its time budget is spent and
+    returns the best move of the deepest iteration it got through.
+    """
+
+    def __init__(self, table: Optional[TranspositionTable] = None):
+        self.table = table if table is not None else TranspositionTable()
+        self.nodes = 0
+
+        self._deadline = 0.0
+        self._killers = [[0, 0] for _ in range(MAX_PLY + 1)]
+        self._history = [[0] * 64 for _ in range(12)]
+        self._root_best: Optional[tuple[int, int]] = None
+
+    def search(self, board: Board, time_limit: float, max_depth: int = MAX_DEPTH) -> SearchResult:
+        start = time.perf_counter()
+        self._deadline = start + time_limit
+        self.nodes = 0
+        self._killers = [[0, 0] for _ in range(MAX_PLY + 1)]
+        self._history = [[0] * 64 for _ in range(12)]
+        self.table.new_search()
+
+        moves = board.legal_moves()
+        if not moves:
+            raise GameError("There are no legal moves to search")
+
+        best_move, best_score, completed = moves[0], 0, 0
+        for depth in range(1, max_depth + 1):
+            self._root_best = None
+            try:
+                best_score, best_move = self._search_root(board, moves, depth)
+                completed = depth
+            except SearchTimeout:
+                # Moves searched completely in the unfinished iteration are still better informed
+                if self._root_best is not None:
+                    best_score, best_move = self._root_best
+                break
+
+            if len(moves) == 1 or abs(best_score) >= MATE_BOUND:
+                break
+            if time.perf_counter() - start > time_limit * NEXT_ITERATION_FRACTION:
+                break
+
+        return SearchResult(best_move, best_score, completed, self.nodes, time.perf_counter() - start)
+
+    def _search_root(self, board: Board, moves: list[int], depth: int) -> tuple[int, int]:
+        entry = self.table.probe(board.key)
+        ordered = self._order(board, moves, entry[0] if entry is not None else 0, 0)
+
+        alpha, beta = -INFINITY, INFINITY
+        best_move = ordered[0]
+        for i, move in enumerate(ordered):
+            board.make_move(move)
+            try:
+                if i == 0:
+                    score = -self._negamax(board, depth - 1, -beta, -alpha, 1)
+                else:
+                    score = -self._negamax(board, depth - 1, -alpha - 1, -alpha, 1)
+                    if score > alpha:
+                        score = -self._negamax(board, depth - 1, -beta, -alpha, 1)
+            finally:
+                board.unmake_move()
+
+            if score > alpha:
+                alpha, best_move = score, move
+                self._root_best = (score, move)
+
+        self.table.store(board.key, best_move, depth, EXACT, alpha)
+        return alpha, best_move
+
+    def _negamax(self, board: Board, depth: int, alpha: int, beta: int, ply: int) -> int:
+        self.nodes += 1
+        if not self.nodes & CLOCK_CHECK_MASK and time.perf_counter() > self._deadline:
+            raise SearchTimeout()
+
+        if board.halfmove_clock >= 100 or board.is_repetition(2):
+            return 0
+
+        in_check = board.is_check()
+        if in_check:
+            depth += 1
+        if depth <= 0 or ply >= MAX_PLY:
+            return self._quiescence(board, alpha, beta, ply)
+
+        table = self.table
+        key = board.key
+        tt_move = 0
+        entry = table.probe(key)
+        if entry is not None:
+            tt_move, tt_depth, bound, score = entry
+            if tt_depth >= depth:
+                score = _score_from_table(score, ply)
+                if (bound == EXACT or (bound == LOWER and score >= beta)
+                        or (bound == UPPER and score <= alpha)):
+                    return score
+
+        moves = board.legal_moves()
+        if not moves:
+            return -MATE + ply if in_check else 0
+
+        squares = board.squares
+        original_alpha = alpha
+        best_score, best_move = -INFINITY, 0
+        for i, move in enumerate(self._order(board, moves, tt_move, ply)):
+            piece = squares[move & 63]
+            quiet = squares[(move >> 6) & 63] == EMPTY and not (move >> 12) & 7 and move >> 15 != EN_PASSANT
+
+            board.make_move(move)
+            try:
+                if i == 0:
+                    score = -self._negamax(board, depth - 1, -beta, -alpha, ply + 1)
+                else:
+                    score = -self._negamax(board, depth - 1, -alpha - 1, -alpha, ply + 1)
+                    if alpha < score < beta:
+                        score = -self._negamax(board, depth - 1, -beta, -alpha, ply + 1)
+            finally:
+                board.unmake_move()
+
+            if score > best_score:
+                best_score, best_move = score, move
+                if score > alpha:
+                    alpha = score
+                    if alpha >= beta:
+                        if quiet:
+                            killers = self._killers[ply]
+                            if killers[0] != move:
+                                killers[1], killers[0] = killers[0], move
+                            history = self._history[piece]
+                            history[(move >> 6) & 63] = min(history[(move >> 6) & 63] + depth * depth, MAX_HISTORY)
+                        break
+
+        if best_score >= beta:
+            bound = LOWER
+        elif best_score > original_alpha:
+            bound = EXACT
+        else:
+            bound = UPPER
+        table.store(key, best_move, depth, bound, _score_to_table(best_score, ply))
+        return best_score
+
+    def _quiescence(self, board: Board, alpha: int, beta: int, ply: int) -> int:
+        self.nodes += 1
+        if not self.nodes & CLOCK_CHECK_MASK and time.perf_counter() > self._deadline:
+            raise SearchTimeout()
+
+        stand_pat = evaluate(board)
+        if stand_pat >= beta or ply >= MAX_PLY:
+            return stand_pat
+        if stand_pat > alpha:
+            alpha = stand_pat
+
+        squares = board.squares
+        captures = []
+        for move in board.legal_moves():
+            victim = squares[(move >> 6) & 63]
+            if victim != EMPTY:
+                captures.append((MVV_LVA[victim % 6][squares[move & 63] % 6], move))
+            elif move >> 15 == EN_PASSANT:
+                captures.append((MVV_LVA[PAWN][PAWN], move))
+            elif (move >> 12) & 7 == QUEEN:
+                captures.append((MVV_LVA[QUEEN][PAWN], move))
+        captures.sort(reverse=True)
+
+        for _, move in captures:
+            board.make_move(move)
+            try:
+                score = -self._quiescence(board, -beta, -alpha, ply + 1)
+            finally:
+                board.unmake_move()
+
+            if score >= beta:
+                return score
+            if score > alpha:
+                alpha = score
+        return alpha
+
+    def _order(self, board: Board, moves: list[int], tt_move: int, ply: int) -> list[int]:
+        squares = board.squares
+        killers = self._killers[ply]
+        history = self._history
+        scored = []
+        for move in moves:
+            if move == tt_move:
+                score = 1 << 30
+            else:
+                piece = squares[move & 63]
+                target = (move >> 6) & 63
+                victim = squares[target]
+                if victim != EMPTY:
+                    score = MVV_LVA[victim % 6][piece % 6]
+                elif move >> 15 == EN_PASSANT:
+                    score = MVV_LVA[PAWN][PAWN]
+                elif (move >> 12) & 7:
+                    score = MVV_LVA[(move >> 12) & 7][PAWN]
+                elif move == killers[0]:
+                    score = KILLER_SCORES[0]
+                elif move == killers[1]:
+                    score = KILLER_SCORES[1]
+                else:
+                    score = history[piece][target]
+            scored.append((score, move))
+        scored.sort(reverse=True)
+        return [move for _, move in scored]
+
+
+def _score_to_table(score: int, ply: int) -> int:
+    # Mate scores are stored relative to the position, and made relative to the root again when read
+    if score >= MATE_BOUND:
+        return score + ply
+    if score <= -MATE_BOUND:
+        return score - ply
+    return score
+
+
+def _score_from_table(score: int, ply: int) -> int:
+    if score >= MATE_BOUND:
+        return score - ply
+    if score <= -MATE_BOUND:
+        return score + ply
+    return score
+
+
+# Transposition table of a search process, kept between the searches it runs
+_process_table: Optional[TranspositionTable] = None
+
+
+def _init_search_process(tt_bytes: int) -> None:
+    global _process_table
+    _process_table = TranspositionTable(tt_bytes)
+
+
+def search_position(fen: str, moves: list[int], deadline: float, max_depth: int = MAX_DEPTH) -> SearchResult:
+    """
+    Searches the position reached by playing the moves from the FEN until the deadline (a
+    time.time() timestamp). The moves are replayed, rather than the position passed as a FEN,
+    so that the search knows which positions would repeat.
+    """
+    board = Board(fen)
+    for move in moves:
+        board.make_move(move)
+
+    time_limit = max(deadline - time.time(), MIN_MOVE_TIME)
+    table = _process_table if _process_table is not None else TranspositionTable()
+    return Searcher(table).search(board, time_limit, max_depth)
+
+
+class SearchPool:
+    """
+    Runs searches in worker processes, so that they neither hold the GIL of the bot nor block
+    its loop. Each process keeps its transposition table across the searches it runs, and the
+    processes are only started with the first search.
+
+    The time budget of a search starts when it is submitted, so a search that waited for a free
+    process still ends on time.
+    """
+
+    def __init__(self, workers: int = DEFAULT_SEARCH_WORKERS, tt_bytes: int = DEFAULT_TT_BYTES):
+        # Forking a process that runs threads may copy held locks, so the processes are spawned
+        self._executor = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn'),
+                                             initializer=_init_search_process, initargs=(tt_bytes,))
+
+    def submit(self, fen: str, moves: list[int], time_limit: float = DEFAULT_MOVE_TIME,
+               max_depth: int = MAX_DEPTH) -> Future:
+        """Returns a future of the SearchResult."""
+        return self._executor.submit(search_position, fen, list(moves), time.time() + time_limit, max_depth)
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+_pool: Optional[SearchPool] = None
+_pool_lock = threading.Lock()
+
+
+def get_search_pool() -> SearchPool:
+    """The search pool shared by all chess games."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = SearchPool()
+        return _pool
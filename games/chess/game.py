@@ -1,8 +1,211 @@
-from typing import Iterable, Callable
+import logging
+import struct
+import zlib
+from concurrent.futures import Future
+from functools import partial
+from typing import Callable, Optional
 
-from core.api import Game, Action
+from telegram.ext import CommandHandler
 
+from core.api import TelegramUpdate, GlobalAPI, Party, Player, PTBHandlerGame, Action, Event, ptb_handler_method
+from core.render import RenderCache
+from games.chess.board import Board, STARTING_FEN, WHITE, BLACK, EMPTY, move_to_uci
+from games.chess.engine import DEFAULT_MOVE_TIME, get_search_pool
+from games.chess.exceptions import GameError
 
-class Chess(Game):
-    def handle(self, action: Action) -> Iterable[Callable[[], None]]:
-        pass
+logger = logging.getLogger(__name__)
+
+PIECE_SYMBOLS = '♙♘♗♖♕♔♟♞♝♜♛♚'
+EMPTY_SQUARE = '·'
+
+# Name of the bot when it plays against a single player
+ENGINE_NAME = 'Gamebot'
+
+# Time budget of the bot's moves, in seconds
+ENGINE_MOVE_TIME = DEFAULT_MOVE_TIME
+
+# Version of the packed game state (see Chess.freeze), to be bumped whenever the layout changes
+SNAPSHOT_VERSION = 1
+
+# Snapshot version, result, user ids of White and Black (0 for the bot) and number of moves, which
+# follow as 32-bit ints
+SNAPSHOT_HEADER = struct.Struct('<BBqqH')
+
+RESULTS = [None, '1-0', '0-1', '1/2-1/2']
+
+
+class Chess(PTBHandlerGame):
+    def __init__(self, api: GlobalAPI, party: Party, game_id: Optional[int] = None, seed: Optional[int] = None):
+        super().__init__(api, party, game_id, seed)
+
+        if len(party.players) not in (1, 2):
+            raise GameError("Chess is played by two players, or by one player against the bot!")
+
+        self.add_handler(CommandHandler('move', self.move))
+        self.add_handler(CommandHandler('board', self.board))
+        self.add_handler(CommandHandler('resign', self.resign))
+        self.add_event_handler('engine_move', self._play_engine_move)
+
+        # Colors are drawn with the seeded RNG, so that restored games replay the same way. The
+        # bot plays the color without a player
+        players: list[Optional[Player]] = list(party.players)
+        self.players = self.random.sample(players + [None] * (2 - len(players)), 2)
+        self.position = Board()
+        self.result: Optional[str] = None
+        self.renders = RenderCache()
+
+        self.party.announce_raw(
+            "_The game has started!_ ♟\n"
+            f"White: {self._name(WHITE)}\n"
+            f"Black: {self._name(BLACK)}\n"
+            "\n"
+            "Send /move followed by a move in algebraic notation (e.g. /move Nf3) to play.",
+            parse_mode='markdown')
+        self._show_board()
+
+    @property
+    def is_finished(self) -> bool:
+        return self.result is not None
+
+    def checksum(self) -> int:
+        return zlib.crc32(f'{self.position.fen()} {self.result}'.encode())
+
+    def freeze(self) -> bytes:
+        # The position is played again from the moves on thaw, which keeps its history for repetitions
+        moves = self.position.move_stack
+        ids = [x.id if x is not None else 0 for x in self.players]
+        return (SNAPSHOT_HEADER.pack(SNAPSHOT_VERSION, RESULTS.index(self.result), *ids, len(moves))
+                + struct.pack(f'<{len(moves)}I', *moves))
+
+    def thaw(self, data: bytes) -> None:
+        version, result, white, black, move_count = SNAPSHOT_HEADER.unpack_from(data)
+        if version != SNAPSHOT_VERSION:
+            raise GameError(f"Unsupported snapshot version: {version}")
+
+        players = {x.id: x for x in self.party.players}
+        self.players = [players[x] if x else None for x in (white, black)]
+        self.result = RESULTS[result]
+        self.position = Board()
+        for move in struct.unpack_from(f'<{move_count}I', data, SNAPSHOT_HEADER.size):
+            self.position.make_move(move)
+        self.renders = RenderCache()
+
+    def resume(self) -> None:
+        # The bot may be to move, e.g. playing White, or its search was lost with the previous process
+        self._request_engine_move()
+
+    @ptb_handler_method
+    def move(self, update: TelegramUpdate) -> None:
+        if self.result is not None:
+            raise GameError("The game is over!")
+        if update.sender != self.players[self.position.turn]:
+            raise GameError("It's not your turn!")
+
+        args = update.raw_update.message.text.split()[1:]
+        if len(args) != 1:
+            raise GameError("Send exactly one move, e.g. /move e4")
+
+        self._play(update.sender.name, self.position.parse_san(args[0]))
+        self._request_engine_move()
+
+    @ptb_handler_method
+    def board(self, update: TelegramUpdate) -> None:
+        self._show_board()
+
+    @ptb_handler_method
+    def resign(self, update: TelegramUpdate) -> None:
+        if self.result is not None:
+            raise GameError("The game is over!")
+        if update.sender not in self.players:
+            raise GameError("Only players can resign!")
+
+        winner = self.players.index(update.sender) ^ 1
+        self.result = '0-1' if winner == BLACK else '1-0'
+        self.party.announce_raw(f"{update.sender.name} resigns. *{self._name(winner)} wins!* ({self.result})",
+                                parse_mode='markdown')
+
+    def _play(self, name: str, move: int) -> None:
+        san = self.position.san(move)
+        self.position.make_move(move)
+
+        with self.party.batch():
+            self.party.announce_raw(f"{name}: *{san}*", parse_mode='markdown')
+            self._check_result()
+            self._show_board()
+
+    def _request_engine_move(self) -> None:
+        # Restored games replay the moves of the bot from their events instead of searching again
+        if self.result is not None or self.players[self.position.turn] is not None or self.post is None:
+            return
+
+        ply = len(self.position.move_stack)
+        future = get_search_pool().submit(STARTING_FEN, self.position.move_stack, ENGINE_MOVE_TIME)
+        future.add_done_callback(partial(_post_engine_move, self.post, ply))
+
+    def _play_engine_move(self, event: Event) -> None:
+        # Searches of positions that are gone (e.g. started twice for a game loaded back) are ignored
+        if (self.result is not None or self.players[self.position.turn] is not None
+                or event.payload['ply'] != len(self.position.move_stack)):
+            return
+
+        uci = event.payload.get('move')
+        if uci is not None:
+            move = self.position.parse_san(uci)
+        else:
+            move = self.random.choice(self.position.legal_moves())
+        self._play(ENGINE_NAME, move)
+
+    def _name(self, color: int) -> str:
+        player = self.players[color]
+        return player.name if player is not None else ENGINE_NAME
+
+    def _check_result(self) -> None:
+        position = self.position
+        if not position.legal_moves():
+            if position.is_check():
+                self.result = '1-0' if position.turn == BLACK else '0-1'
+                message = f"Checkmate. *{self._name(position.turn ^ 1)} wins!*"
+            else:
+                self.result = '1/2-1/2'
+                message = "Stalemate. *Draw!*"
+        elif position.is_insufficient_material():
+            self.result = '1/2-1/2'
+            message = "Insufficient material. *Draw!*"
+        elif position.is_repetition():
+            self.result = '1/2-1/2'
+            message = "Threefold repetition. *Draw!*"
+        elif position.is_fifty_moves():
+            self.result = '1/2-1/2'
+            message = "Fifty moves without a capture or a pawn move. *Draw!*"
+        else:
+            return
+
+        self.party.announce_raw(f"{message} ({self.result})", parse_mode='markdown')
+
+    def _show_board(self) -> None:
+        self.party.announce_raw(self.renders.get('board', self.position.key, self._render_board),
+                                parse_mode='markdown')
+
+    def _render_board(self) -> str:
+        rows = []
+        for rank in range(7, -1, -1):
+            squares = self.position.squares[rank * 8:rank * 8 + 8]
+            rows.append(f"{rank + 1} " + ' '.join(PIECE_SYMBOLS[x] if x != EMPTY else EMPTY_SQUARE for x in squares))
+        rows.append("  a b c d e f g h")
+        board = "\n".join(rows)
+
+        side = 'White' if self.position.turn == WHITE else 'Black'
+        return f"```\n{board}\n```\n{side} to move ({self._name(self.position.turn)})"
+
+
+def _post_engine_move(post: Callable[[Action], None], ply: int, future: Future) -> None:
+    # Runs in a thread of the search pool, so the game is only touched through its mailbox. A
+    # failed search still gets the game going, with a random move drawn by the game
+    if future.cancelled():
+        return
+    try:
+        payload = {'ply': ply, 'move': move_to_uci(future.result().move)}
+    except Exception as e:
+        logger.error("Chess engine search failed", exc_info=e)
+        payload = {'ply': ply}
+    post(Event('engine_move', payload))
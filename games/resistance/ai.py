@@ -0,0 +1,201 @@
+import math
+import random
+from functools import lru_cache
+from itertools import combinations
+from typing import Optional, Sequence
+
+import numpy as np
+
+# Behaviour assumed of the players when weighing the evidence: spies play black on most missions
+# and approve parties with spies in them, while resistance members can only guess
+SPY_BLACK_RATE = 0.9
+SPY_APPROVE_WITH_SPY = 0.85
+SPY_APPROVE_WITHOUT_SPY = 0.3
+RESISTANCE_APPROVE = 0.6
+
+# Resistance members approve parties that are nearly as likely to be clean as the best one they
+# could propose themselves
+APPROVE_RATIO = 0.8
+
+# Parties with clean probabilities this close are considered equally good
+TIE_TOLERANCE = 1e-9
+
+# Spies hide among the resistance members, whose behaviour the belief is built on: they vote on
+# most parties able to fail the mission as a resistance member would, and sometimes propose the
+# party a resistance member would
+SPY_BLUFF_VOTE_RATE = 0.7
+SPY_CLEAN_PROPOSAL_RATE = 0.2
+
+
+@lru_cache(maxsize=None)
+def spy_hypotheses(player_count: int, spy_count: int) -> np.ndarray:
+    """Every possible spy assignment, as the rows of a (hypotheses, players) boolean matrix."""
+    return _subsets(player_count, spy_count)
+
+
+@lru_cache(maxsize=None)
+def candidate_parties(player_count: int, size: int) -> np.ndarray:
+    """Every possible party of the size, as the rows of a (parties, players) boolean matrix."""
+    return _subsets(player_count, size)
+
+
+@lru_cache(maxsize=None)
+def _clean_parties(player_count: int, spy_count: int, size: int) -> np.ndarray:
+    # (hypotheses, parties): 1.0 where the party has no spy under the hypothesis
+    spies = spy_hypotheses(player_count, spy_count).astype(np.int8)
+    parties = candidate_parties(player_count, size).astype(np.int8)
+    clean = (spies @ parties.T == 0).astype(np.float64)
+    clean.setflags(write=False)
+    return clean
+
+
+@lru_cache(maxsize=None)
+def _mission_log_likelihoods(max_spies: int) -> np.ndarray:
+    # [spies in the party, black cards]: log-probability of the black cards, -inf if impossible
+    table = np.full((max_spies + 1, max_spies + 1), -np.inf)
+    for spies in range(max_spies + 1):
+        for black in range(spies + 1):
+            table[spies, black] = math.log(math.comb(spies, black) * SPY_BLACK_RATE ** black
+                                           * (1 - SPY_BLACK_RATE) ** (spies - black))
+    table.setflags(write=False)
+    return table
+
+
+def _subsets(n: int, k: int) -> np.ndarray:
+    rows = np.zeros((math.comb(n, k), n), dtype=bool)
+    for i, members in enumerate(combinations(range(n), k)):
+        rows[i, list(members)] = True
+    rows.setflags(write=False)
+    return rows
+
+
+class SpyBelief:
+    """
+    A probability distribution over every possible spy assignment of a game (at most
+    C(10, 4) = 210 hypotheses), as seen by someone who only knows the public information: the
+    ballots of the party votes and the number of black cards played on the missions.
+
+    The distribution is kept as log-weights and updated in place by one vectorized operation per
+    vote or mission. Players (who also know their own role) condition it on their innocence when
+    they read it.
+    """
+
+    def __init__(self, player_count: int, spy_count: int):
+        self.player_count = player_count
+        self.spy_count = spy_count
+        self.hypotheses = spy_hypotheses(player_count, spy_count)
+
+        self._log_weights = np.zeros(len(self.hypotheses))
+        self._missions = _mission_log_likelihoods(spy_count)
+
+        # Likelihoods of a player's approval, by hypothesis and player, for parties with and without a spy
+        self._approve_with_spy = np.where(self.hypotheses, SPY_APPROVE_WITH_SPY, RESISTANCE_APPROVE)
+        self._approve_without_spy = np.where(self.hypotheses, SPY_APPROVE_WITHOUT_SPY, RESISTANCE_APPROVE)
+
+    def observe_vote(self, party: Sequence[int], ballots: Sequence[bool]) -> None:
+        """Updates the distribution with the ballots (by player index) of a vote on the party."""
+        has_spy = self.hypotheses[:, list(party)].any(axis=1)
+        approve = np.where(has_spy[:, None], self._approve_with_spy, self._approve_without_spy)
+        likelihoods = np.where(np.asarray(ballots, dtype=bool), approve, 1 - approve)
+        self._log_weights += np.log(likelihoods).sum(axis=1)
+
+    def observe_mission(self, party: Sequence[int], black_cards: int) -> None:
+        """Updates the distribution with the number of black cards played by the party."""
+        spies = self.hypotheses[:, list(party)].sum(axis=1)
+        self._log_weights += self._missions[spies, black_cards]
+
+    def weights(self, innocent: Optional[int] = None) -> np.ndarray:
+        """Probabilities of the hypotheses, optionally given that a player is not a spy."""
+        log_weights = self._log_weights
+        if innocent is not None:
+            conditioned = np.where(self.hypotheses[:, innocent], -np.inf, log_weights)
+            # A spy may have been unmasked, in which case its innocence can't be assumed
+            if np.isfinite(conditioned.max()):
+                log_weights = conditioned
+
+        weights = np.exp(log_weights - log_weights.max())
+        return weights / weights.sum()
+
+    def spy_probabilities(self, innocent: Optional[int] = None) -> np.ndarray:
+        """Probability of every player being a spy."""
+        return self.weights(innocent) @ self.hypotheses
+
+    def clean_probabilities(self, size: int, innocent: Optional[int] = None) -> np.ndarray:
+        """Probability of every party of the size (see candidate_parties) having no spy."""
+        return self.weights(innocent) @ _clean_parties(self.player_count, self.spy_count, size)
+
+
+class AIPlayer:
+    """
+    Decisions of an AI seat, by player index.
+
+    A resistance member reads the belief given its own innocence: it proposes the party most
+    likely to be clean and approves parties nearly as good. A spy knows the other spies, and
+    steers the game towards parties with enough spies to fail the mission while looking clean
+    to the others, but mostly votes and sometimes proposes like a resistance member would, so
+    as not to stand out.
+    """
+
+    def __init__(self, index: int, belief: SpyBelief, rng: random.Random, spies: Optional[Sequence[int]] = None):
+        self.index = index
+        self.belief = belief
+
+        self._random = rng
+        self._spies = np.zeros(belief.player_count, dtype=bool)
+        if spies is not None:
+            self._spies[list(spies)] = True
+
+    @property
+    def is_spy(self) -> bool:
+        return bool(self._spies[self.index])
+
+    def propose(self, size: int, winning_count: int) -> list[int]:
+        parties = candidate_parties(self.belief.player_count, size)
+        with_me = parties[:, self.index]
+        if self.is_spy and self._random.random() >= SPY_CLEAN_PROPOSAL_RATE:
+            # The others see the public belief; only parties able to fail the mission qualify
+            scores = self.belief.clean_probabilities(size)
+            spies = parties.astype(np.int8) @ self._spies.astype(np.int8)
+            eligible = with_me & (spies == min(winning_count, int(self._spies.sum()), size))
+        else:
+            scores = self.belief.clean_probabilities(size, self.index)
+            eligible = with_me
+
+        scores = np.where(eligible, scores, -1.0)
+        best = np.flatnonzero(scores >= scores.max() - TIE_TOLERANCE)
+        return np.flatnonzero(parties[self._random.choice(best)]).tolist()
+
+    def vote_party(self, party: Sequence[int], winning_count: int, last_vote: bool) -> bool:
+        # Everyone approves the last vote of a round: spies are too few to reject it on their own,
+        # and trying would only unmask them
+        if last_vote:
+            return True
+        if (self.is_spy and int(self._spies[list(party)].sum()) >= winning_count
+                and self._random.random() >= SPY_BLUFF_VOTE_RATE):
+            return True
+
+        size = len(party)
+        clean = self.belief.clean_probabilities(size, self.index)
+        best = clean[candidate_parties(self.belief.player_count, size)[:, self.index]].max()
+        return bool(clean[_party_row(self.belief.player_count, party)] >= APPROVE_RATIO * best)
+
+    def vote_mission(self, party: Sequence[int], winning_count: int) -> bool:
+        """Returns True for a red card."""
+        if not self.is_spy:
+            return True
+
+        # Just enough spies play black, the ones seated first, and they sometimes bluff
+        spies = [x for x in sorted(party) if self._spies[x]]
+        return spies.index(self.index) >= winning_count or self._random.random() >= SPY_BLACK_RATE
+
+
+def _party_row(player_count: int, party: Sequence[int]) -> int:
+    # Index of the party in candidate_parties(): combinations are enumerated in lexicographic order
+    members = sorted(party)
+    size = len(members)
+    row, previous = 0, -1
+    for i, member in enumerate(members):
+        for skipped in range(previous + 1, member):
+            row += math.comb(player_count - skipped - 1, size - i - 1)
+        previous = member
+    return row
@@ -1,41 +1,108 @@
-import random
+from enum import IntEnum
+from typing import Optional
 
-from telegram import InlineKeyboardMarkup, InlineKeyboardButton
+from telegram import InlineKeyboardMarkup, InlineKeyboardButton, User
 from telegram.ext import CommandHandler
 
-from core.api import TelegramUpdate, GlobalAPI, Party, PTBHandlerGame, ptb_handler_method
-from games.resistance.logic import GameInstance, GameState
+from core.api import TelegramUpdate, GlobalAPI, Party, Player, PTBHandlerGame, Timeout, ptb_handler_method
+from core.render import RenderCache
+from games.resistance.ai import AIPlayer, SpyBelief
+from games.resistance.logic import GameInstance, GameState, MIN_PLAYERS, VOTE_LIMIT
 from games.resistance.exceptions import GameError
 
 
+class CallbackAction(IntEnum):
+    # Codes are stored in the buttons sent to players; don't renumber them
+    GET_ROLE = 0
+    PARTY_VOTE = 1
+    MISSION_VOTE = 2
+
+
+# Time the leader has to propose a party and the players have to vote, in seconds. When it is up,
+# the leader is skipped (which counts as a failed vote), and the missing party votes count as negative
+# and mission votes as red
+PROPOSAL_TIMEOUT = 5 * 60
+PARTY_VOTE_TIMEOUT = 2 * 60
+MISSION_VOTE_TIMEOUT = 2 * 60
+
+PHASE_TIMEOUTS = {
+    GameState.PROPOSAL_PENDING: PROPOSAL_TIMEOUT,
+    GameState.PARTY_VOTE_IN_PROGRESS: PARTY_VOTE_TIMEOUT,
+    GameState.MISSION_VOTE_IN_PROGRESS: MISSION_VOTE_TIMEOUT,
+}
+
+
 class Resistance(PTBHandlerGame):
     # TODO: Get rid of raw API calls
-    # TODO: Refactor callbacks
 
-    def __init__(self, api: GlobalAPI, party: Party):
-        super().__init__(api, party)
+    def __init__(self, api: GlobalAPI, party: Party, game_id: Optional[int] = None, seed: Optional[int] = None):
+        super().__init__(api, party, game_id, seed)
 
         self.add_handler(CommandHandler('select', self.select))
-        # self.add_handler(CallbackQueryHandler(self._handle_callbacks))
+        self.add_callback_action(CallbackAction.GET_ROLE, self.get_role)
+        self.add_callback_action(CallbackAction.PARTY_VOTE, self.party_vote)
+        self.add_callback_action(CallbackAction.MISSION_VOTE, self.mission_vote)
+        self.add_timeout_handler('phase', self._handle_phase_timeout)
+
+        # Small groups get AI players seated at random among them, up to the minimum number of players
+        players = list(party.players)
+        if len(players) < MIN_PLAYERS:
+            players += [Player(User(-i, f"Bot {i}", True)) for i in range(1, MIN_PLAYERS - len(players) + 1)]
+            self.random.shuffle(players)
+
+        self.game = GameInstance(players, self.random)
+        self.renders = RenderCache()
+
+        # Set up once the spies are appointed
+        self.belief: Optional[SpyBelief] = None
+        self.bots: dict[Player, AIPlayer] = {}
+        self._seats = {player: i for i, player in enumerate(players)}
 
-        self.game = GameInstance(party.players)
         self.start_game()
 
+    @property
+    def is_finished(self) -> bool:
+        return self.game.state == GameState.GAME_OVER
+
+    def checksum(self) -> int:
+        return self.game.checksum()
+
+    def freeze(self) -> bytes:
+        # The AI players only keep the belief, which is rebuilt from the votes on thaw
+        return self.game.pack()
+
+    def thaw(self, data: bytes) -> None:
+        self.game = GameInstance.unpack(data, {x.id: x for x in self.game.players}, self.random)
+        self.renders = RenderCache()
+        self._seats = {player: i for i, player in enumerate(self.game.players)}
+
+        self.belief = None
+        self.bots = {}
+        if self.game.spies:
+            self._seat_bots()
+        if self.belief is not None:
+            self._observe_history()
+
     def start_game(self) -> None:
         self.game.next_state()
+        self._seat_bots()
 
         reply_markup = InlineKeyboardMarkup([
-            [InlineKeyboardButton("Tap here", callback_data='resistance_get_role')]
+            [InlineKeyboardButton("Tap here", callback_data=self.callback_data(CallbackAction.GET_ROLE))]
         ])
-        self.party.announce_raw(
-            "_The game has started!_ 😱\n"
-            "\n"
-            f"There are {len(self.game.spies)} spies. Tap the button below to find out your role.",
-            parse_mode='markdown',
-            reply_markup=reply_markup)
 
-        self._show_round_info()
-        self._show_proposal_prompt()
+        with self.party.batch():
+            self.party.announce_raw(
+                "_The game has started!_ 😱\n"
+                "\n"
+                f"There are {len(self.game.spies)} spies. Tap the button below to find out your role.",
+                parse_mode='markdown',
+                reply_markup=reply_markup)
+
+            self._show_round_info()
+            self._open_proposal()
+
+        self._arm_phase_deadline()
 
     @ptb_handler_method
     def select(self, update: TelegramUpdate) -> None:
@@ -62,11 +129,12 @@ class Resistance(PTBHandlerGame):
 
         self.game.propose_party(update.sender, party)
 
-        if self.game.state == GameState.PARTY_VOTE_IN_PROGRESS:
-            self._show_party_vote_prompt()
+        with self.party.batch():
+            self._open_party_vote()
+        self._arm_phase_deadline()
 
     def get_role(self, update: TelegramUpdate) -> None:
-        if update.sender in self.game.spies:
+        if self.game.is_spy(update.sender):
             response = "⚫️ Spy"
             if len(self.game.spies) > 1:
                 spy_list = ", ".join(spy.name for spy in self.game.spies if spy != update.sender)
@@ -74,68 +142,199 @@ class Resistance(PTBHandlerGame):
         else:
             response = "🔴 Resistance member"
 
-        update.raw_update.callback_query.answer(response)
+        self.party.answer_raw(update.raw_update.callback_query, response)
 
-    def party_vote(self, update: TelegramUpdate) -> None:
+    def party_vote(self, update: TelegramUpdate, affirmative: int) -> None:
         query = update.raw_update.callback_query
-        affirmative = query.data == 'resistance_party_vote_affirmative'
+        affirmative = bool(affirmative)
         self.game.vote_party(update.sender, affirmative)
 
         if affirmative:
-            query.answer("Voted 👍")
+            self.party.answer_raw(query, "Voted 👍")
         else:
-            query.answer("Voted 👎")
+            self.party.answer_raw(query, "Voted 👎")
 
-        query.message.edit_text(
+        # The final tally is flushed, so that it reaches the chat before the outcome announced next
+        self.party.edit_raw(
+            query.message,
             self._get_party_vote_message(),
+            flush=self.game.state != GameState.PARTY_VOTE_IN_PROGRESS,
             parse_mode='markdown',
             reply_markup=self._construct_party_vote_markup())
 
-        if self.game.state != GameState.PARTY_VOTE_RESULTS:
-            return
+        if self.game.state == GameState.PARTY_VOTE_RESULTS:
+            self._finish_party_vote()
 
-        self._report_party_vote_outcome()
-        prev_round_no = len(self.game.rounds)
-        self.game.next_state()
+    def _finish_party_vote(self) -> None:
+        if self.belief is not None:
+            vote = self.game.current_vote
+            self.belief.observe_vote([self._seats[x] for x in vote.party],
+                                     [vote.ballots[x] for x in self.game.players])
 
-        if len(self.game.rounds) != prev_round_no:
-            self.party.announce_raw(
-                "*Maximum number of failed votes reached. Spies win the round.*",
-                parse_mode='markdown')
-            self._show_round_info()
+        with self.party.batch():
+            self._report_party_vote_outcome()
+            prev_round_no = len(self.game.rounds)
+            self.game.next_state()
 
-        if self.game.state == GameState.PROPOSAL_PENDING:
-            self._show_proposal_prompt()
-        elif self.game.state == GameState.MISSION_VOTE_IN_PROGRESS:
-            self._show_mission_vote_prompt()
-        elif self.game.state == GameState.GAME_OVER:
-            self._report_game_outcome()
+            if len(self.game.rounds) != prev_round_no:
+                self.party.announce_raw(
+                    "*Maximum number of failed votes reached. Spies win the round.*",
+                    parse_mode='markdown')
+                self._show_round_info()
+
+            if self.game.state == GameState.PROPOSAL_PENDING:
+                self._open_proposal()
+            elif self.game.state == GameState.MISSION_VOTE_IN_PROGRESS:
+                self._open_mission_vote()
+            elif self.game.state == GameState.GAME_OVER:
+                self._report_game_outcome()
+
+        self._arm_phase_deadline()
 
-    def mission_vote(self, update: TelegramUpdate) -> None:
+    def mission_vote(self, update: TelegramUpdate, red: int) -> None:
         query = update.raw_update.callback_query
-        red = query.data == 'resistance_mission_vote_red'
+        red = bool(red)
         self.game.vote_mission(update.sender, red)
 
         if red:
-            query.answer("Voted 🔴")
+            self.party.answer_raw(query, "Voted 🔴")
         else:
-            query.answer("Voted ⚫️")
+            self.party.answer_raw(query, "Voted ⚫️")
 
-        query.message.edit_text(
+        self.party.edit_raw(
+            query.message,
             self._get_mission_vote_message(),
+            flush=self.game.state != GameState.MISSION_VOTE_IN_PROGRESS,
             parse_mode='markdown',
             reply_markup=self._construct_mission_vote_markup())
 
-        if self.game.state != GameState.MISSION_VOTE_RESULTS:
+        if self.game.state == GameState.MISSION_VOTE_RESULTS:
+            self._finish_mission_vote()
+
+    def _finish_mission_vote(self) -> None:
+        if self.belief is not None:
+            self.belief.observe_mission([self._seats[x] for x in self.game.current_party],
+                                        sum(not x for x in self.game.current_round.ballots.values()))
+
+        with self.party.batch():
+            self._report_mission_vote_outcome()
+            self.game.next_state()
+            if self.game.state == GameState.PROPOSAL_PENDING:
+                self._show_round_info()
+                self._open_proposal()
+            elif self.game.state == GameState.GAME_OVER:
+                self._report_game_outcome()
+
+        self._arm_phase_deadline()
+
+    def _handle_phase_timeout(self, timeout: Timeout) -> None:
+        state = self.game.state
+        if state == GameState.PROPOSAL_PENDING:
+            with self.party.batch():
+                self.party.announce_raw(
+                    f"*Time is up!* {self.game.leader.name} didn't propose a party.", parse_mode='markdown')
+                prev_round_no = len(self.game.rounds)
+                self.game.skip_leader()
+
+                if len(self.game.rounds) != prev_round_no:
+                    self.party.announce_raw(
+                        "*Maximum number of failed votes reached. Spies win the round.*",
+                        parse_mode='markdown')
+                    self._show_round_info()
+
+                if self.game.state == GameState.PROPOSAL_PENDING:
+                    self._open_proposal()
+                elif self.game.state == GameState.GAME_OVER:
+                    self._report_game_outcome()
+            self._arm_phase_deadline()
+
+        elif state == GameState.PARTY_VOTE_IN_PROGRESS:
+            # The batch of the outcome is nested in this one, so it all goes out as one message
+            with self.party.batch():
+                self.party.announce_raw("*Time is up!* Missing votes count as 👎.", parse_mode='markdown')
+                self.game.close_party_vote()
+                self._finish_party_vote()
+
+        elif state == GameState.MISSION_VOTE_IN_PROGRESS:
+            with self.party.batch():
+                self.party.announce_raw("*Time is up!* Missing votes count as 🔴.", parse_mode='markdown')
+                self.game.close_mission_vote()
+                self._finish_mission_vote()
+
+    def _seat_bots(self) -> None:
+        bots = [player for player in self.game.players if player not in self.party.players]
+        if not bots:
             return
 
-        self._report_mission_vote_outcome()
-        self.game.next_state()
-        if self.game.state == GameState.PROPOSAL_PENDING:
-            self._show_round_info()
+        spies = [self._seats[x] for x in self.game.spies]
+        self.belief = SpyBelief(len(self.game.players), len(spies))
+        for player in bots:
+            self.bots[player] = AIPlayer(self._seats[player], self.belief, self.random,
+                                         spies if self.game.is_spy(player) else None)
+
+    def _observe_history(self) -> None:
+        # Feeds the belief the finished votes and missions in the order they were observed in play
+        for i, r in enumerate(self.game.rounds):
+            current = i == len(self.game.rounds) - 1
+            for j, vote in enumerate(r.votes):
+                if current and j == len(r.votes) - 1 and self.game.state == GameState.PARTY_VOTE_IN_PROGRESS:
+                    break
+                # Skipped proposals (see GameInstance.skip_leader) have nothing to observe
+                if not vote.party:
+                    continue
+                self.belief.observe_vote([self._seats[x] for x in vote.party],
+                                         [vote.ballots[x] for x in self.game.players])
+
+            if r.ballots and not (current and self.game.state == GameState.MISSION_VOTE_IN_PROGRESS):
+                self.belief.observe_mission([self._seats[x] for x in r.votes[-1].party],
+                                            sum(not x for x in r.ballots.values()))
+
+    def _open_proposal(self) -> None:
+        # AI players act right away, so phases only wait for human players
+        leader = self.game.leader
+        bot = self.bots.get(leader)
+        if bot is None:
             self._show_proposal_prompt()
-        elif self.game.state == GameState.GAME_OVER:
-            self._report_game_outcome()
+            return
+
+        party = bot.propose(self.game.current_party_size, self.game.current_winning_count)
+        self.party.announce_raw(f"{leader.name}, the leader, proposes a party.", parse_mode='markdown')
+        self.game.propose_party(leader, [self.game.players[i] for i in party])
+        self._open_party_vote()
+
+    def _open_party_vote(self) -> None:
+        party = [self._seats[x] for x in self.game.current_party]
+        last_vote = len(self.game.current_round.votes) == VOTE_LIMIT
+        for player, bot in self.bots.items():
+            if self.game.state != GameState.PARTY_VOTE_IN_PROGRESS:
+                break
+            self.game.vote_party(player, bot.vote_party(party, self.game.current_winning_count, last_vote))
+
+        if self.game.state == GameState.PARTY_VOTE_IN_PROGRESS:
+            self._show_party_vote_prompt()
+        else:
+            self._finish_party_vote()
+
+    def _open_mission_vote(self) -> None:
+        party = [self._seats[x] for x in self.game.current_party]
+        for player in self.game.current_party:
+            bot = self.bots.get(player)
+            if bot is None or self.game.state != GameState.MISSION_VOTE_IN_PROGRESS:
+                continue
+            self.game.vote_mission(player, bot.vote_mission(party, self.game.current_winning_count))
+
+        if self.game.state == GameState.MISSION_VOTE_IN_PROGRESS:
+            self._show_mission_vote_prompt()
+        else:
+            self._finish_mission_vote()
+
+    def _arm_phase_deadline(self) -> None:
+        # Every phase waiting for players has a single deadline, restarted whenever the phase changes
+        timeout = PHASE_TIMEOUTS.get(self.game.state)
+        if timeout is not None:
+            self.set_deadline('phase', timeout)
+        else:
+            self.cancel_deadline('phase')
 
     def _show_round_info(self) -> None:
         self.party.announce_raw(
@@ -145,7 +344,9 @@ class Resistance(PTBHandlerGame):
             parse_mode='markdown')
 
     def _show_proposal_prompt(self) -> None:
-        player_list = "\n".join(f"{i}. {x.name}" for i, x in enumerate(self.game.players, 1))
+        # Players don't change during a game
+        player_list = self.renders.get('player_list', None, lambda: "\n".join(
+            f"{i}. {x.name}" for i, x in enumerate(self.game.players, 1)))
         self.party.announce_raw(
             f"{self.game.leader.name}, you are the leader now.\n"
             f"Please select *{self.game.current_party_size}* player(s) from the list:\n"
@@ -188,7 +389,7 @@ class Resistance(PTBHandlerGame):
         caption = f"{who_won} won the round."
 
         votes = list(self.game.current_round.ballots.values())
-        random.shuffle(votes)
+        self.random.shuffle(votes)
         vote_list = "".join("🔴" if x else "⚫️" for x in votes)
 
         self.party.announce_raw(f"*{caption}*\n{vote_list}", parse_mode='markdown')
@@ -201,6 +402,9 @@ class Resistance(PTBHandlerGame):
         self.party.announce_raw(f"*{message}*", parse_mode='markdown')
 
     def _get_party_vote_message(self) -> str:
+        return self.renders.get('party_vote_message', self.game.version, self._render_party_vote_message)
+
+    def _render_party_vote_message(self) -> str:
         party = ", ".join(x.name for x in self.game.current_party)
         return (
             "▪️ *VOTING* ▪️\n"
@@ -210,6 +414,9 @@ class Resistance(PTBHandlerGame):
         )
 
     def _get_mission_vote_message(self) -> str:
+        return self.renders.get('mission_vote_message', self.game.version, self._render_mission_vote_message)
+
+    def _render_mission_vote_message(self) -> str:
         return (
             "▪️ *MISSION* ▪️\n"
             "Party members, please vote.\n"
@@ -218,16 +425,15 @@ class Resistance(PTBHandlerGame):
             f"*{len(self.game.current_round.ballots)}* out of *{self.game.current_party_size}* player(s) voted."
         )
 
-    @staticmethod
-    def _construct_party_vote_markup() -> InlineKeyboardMarkup:
-        return InlineKeyboardMarkup([
-            [InlineKeyboardButton("👍", callback_data='party_vote_affirmative'),
-             InlineKeyboardButton("👎", callback_data='party_vote_negative')]
-        ])
-
-    @staticmethod
-    def _construct_mission_vote_markup() -> InlineKeyboardMarkup:
-        return InlineKeyboardMarkup([
-            [InlineKeyboardButton("🔴", callback_data='mission_vote_red'),
-             InlineKeyboardButton("⚫️", callback_data='mission_vote_black')]
-        ])
+    def _construct_party_vote_markup(self) -> InlineKeyboardMarkup:
+        # Keyboards only depend on the game id, so they are built once per game
+        return self.renders.get('party_vote_markup', None, lambda: InlineKeyboardMarkup([
+            [InlineKeyboardButton("👍", callback_data=self.callback_data(CallbackAction.PARTY_VOTE, True)),
+             InlineKeyboardButton("👎", callback_data=self.callback_data(CallbackAction.PARTY_VOTE, False))]
+        ]))
+
+    def _construct_mission_vote_markup(self) -> InlineKeyboardMarkup:
+        return self.renders.get('mission_vote_markup', None, lambda: InlineKeyboardMarkup([
+            [InlineKeyboardButton("🔴", callback_data=self.callback_data(CallbackAction.MISSION_VOTE, True)),
+             InlineKeyboardButton("⚫️", callback_data=self.callback_data(CallbackAction.MISSION_VOTE, False))]
+        ]))
@@ -1,5 +1,7 @@
 import logging
 import random
+import struct
+import zlib
 from enum import Enum
 from typing import Optional
 
@@ -28,6 +30,18 @@ VOTE_LIMIT = 5
 # at least 2 black cards in the 4th round to win it
 MIN_2IN4TH = 7
 
+# Version of the packed game state (see GameInstance.pack), to be bumped whenever the layout changes
+SNAPSHOT_VERSION = 1
+
+# Snapshot version, state, state version, leader, player count, spy mask and round outcomes
+SNAPSHOT_HEADER = struct.Struct('<BBIbBHBBB')
+
+# Winning count, vote count, and party members who cast a ballot and who played red in the mission
+ROUND_HEADER = struct.Struct('<BBHH')
+
+# Party size, and players who cast a ballot and who approved the party; party seats follow
+VOTE_HEADER = struct.Struct('<BHH')
+
 logger = logging.getLogger(__name__)
 
 
@@ -42,22 +56,36 @@ class GameState(Enum):
 
 
 class Vote:
+    __slots__ = ('party', 'members', 'ballots', '_affirmative')
+
     def __init__(self, party: list[Player]):
         self.party = party
+        self.members = frozenset(party)
         self.ballots: dict[Player, bool] = {}
+        self._affirmative = 0
+
+    def cast(self, player: Player, outcome: bool) -> None:
+        self.ballots[player] = outcome
+        self._affirmative += outcome
 
     @property
     def outcome(self) -> bool:
         # Party is appointed if the majority of players voted affirmative
-        values = list(self.ballots.values())
-        return values.count(True) > values.count(False)
+        return self._affirmative > len(self.ballots) - self._affirmative
 
 
 class Round:
+    __slots__ = ('winning_count', 'votes', 'ballots', '_black')
+
     def __init__(self, winning_count: int):
         self.winning_count = winning_count
         self.votes: list[Vote] = []
         self.ballots: dict[Player, bool] = {}
+        self._black = 0
+
+    def cast(self, player: Player, outcome: bool) -> None:
+        self.ballots[player] = outcome
+        self._black += not outcome
 
     @property
     def last_vote(self) -> Optional[Vote]:
@@ -71,22 +99,46 @@ class Round:
 
     @property
     def outcome(self) -> bool:
-        # Spies win if vote limit is exceeded
-        if not self.can_vote:
+        # Spies win if the last allowed vote fails
+        if not self.can_vote and not self.votes[-1].outcome:
             return False
 
         # Spies win if they deal a needed number of black cards
-        return list(self.ballots.values()).count(False) < self.winning_count
+        return self._black < self.winning_count
+
+
+# States in which a round is in progress, a party vote is in progress or finished and a party is appointed
+ROUND_STATES = frozenset(set(GameState) - {GameState.NOT_STARTED, GameState.GAME_OVER})
+VOTE_STATES = frozenset({GameState.PARTY_VOTE_IN_PROGRESS, GameState.PARTY_VOTE_RESULTS})
+PARTY_STATES = frozenset({GameState.PARTY_VOTE_IN_PROGRESS, GameState.PARTY_VOTE_RESULTS,
+                          GameState.MISSION_VOTE_IN_PROGRESS, GameState.MISSION_VOTE_RESULTS})
 
 
 class GameInstance:
-    def __init__(self, players: list[Player]):
+    __slots__ = ('_random', '_state', 'version', 'players', 'spies', 'rounds', '_leader_idx', '_player_set',
+                 '_spy_set', '_party_sizes', '_resistance_wins', '_spy_wins')
+
+    def __init__(self, players: list[Player], rng: Optional[random.Random] = None):
+        self._random = rng if rng is not None else random.Random()
+
+        # Incremented on every change of the game, so that renderings of the state can be reused
+        self.version = 0
+
         self.state = GameState.NOT_STARTED
         self.players: list[Player] = players
         self.spies: list[Player] = []
         self.rounds: list[Round] = []
         self._leader_idx = -1
 
+        # Sets for membership checks
+        self._player_set = frozenset(players)
+        self._spy_set: frozenset[Player] = frozenset()
+
+        # Outcomes of the finished rounds, updated when a round is over
+        self._party_sizes = PARTY_SIZES.get(len(players))
+        self._resistance_wins = 0
+        self._spy_wins = 0
+
     def next_state(self) -> None:
         if self.state == GameState.NOT_STARTED:
             if not MIN_PLAYERS <= len(self.players) <= MAX_PLAYERS:
@@ -95,11 +147,12 @@ class GameInstance:
             self._next_round_or_game_over()
 
         elif self.state == GameState.PARTY_VOTE_RESULTS:
-            if self.current_vote.outcome:
+            current_round = self.rounds[-1]
+            if current_round.votes[-1].outcome:
                 self.state = GameState.MISSION_VOTE_IN_PROGRESS
             else:
                 self._next_leader()
-                if self.current_round.can_vote:
+                if current_round.can_vote:
                     self.state = GameState.PROPOSAL_PENDING
                 else:
                     self._next_round_or_game_over()
@@ -116,47 +169,92 @@ class GameInstance:
             raise GameError("Party proposal not pending!")
         if player != self.leader:
             raise GameError("Only leader can propose a party!")
-        if len(players) != self.current_party_size:
+        if len(players) != self._party_sizes[len(self.rounds) - 1]:
             raise GameError(f"Party must have {self.current_party_size} members!")
 
         for player in players:
-            if player not in self.players:
+            if player not in self._player_set:
                 raise GameError(f"Can't propose non-registered player {player.name}!")
+        if len(set(players)) != len(players):
+            raise GameError("Can't propose the same player twice!")
 
-        self.current_round.votes.append(Vote(players))
+        self.rounds[-1].votes.append(Vote(players))
         self.state = GameState.PARTY_VOTE_IN_PROGRESS
 
     def vote_party(self, player: Player, outcome: bool) -> None:
         if self.state != GameState.PARTY_VOTE_IN_PROGRESS:
             raise GameError("Party vote not in progress!")
-        if player in self.current_vote.ballots:
+        if player not in self._player_set:
+            raise GameError("Only players can vote!")
+
+        vote = self.rounds[-1].votes[-1]
+        if player in vote.ballots:
             raise GameError("Can't vote twice!")
 
-        self.current_vote.ballots[player] = outcome
-        self._log("Player %s votes %s", player.name, "affirmative" if outcome else "negative")
+        vote.cast(player, outcome)
+        self.version += 1
+        self._log("Player %s votes %s", player.name, "affirmative" if outcome else "negative", level=logging.DEBUG)
 
         # Proceed to the next state when all players voted
-        if len(self.current_vote.ballots) >= len(self.players):
+        if len(vote.ballots) >= len(self.players):
             self.state = GameState.PARTY_VOTE_RESULTS
-            self._log("Vote over: party is %s", "appointed" if self.current_vote.outcome else "rejected")
+            self._log("Vote over: party is %s", "appointed" if vote.outcome else "rejected")
 
     def vote_mission(self, player: Player, outcome: bool) -> None:
         if self.state != GameState.MISSION_VOTE_IN_PROGRESS:
             raise GameError("Mission vote not in progress!")
-        if player in self.current_round.ballots:
+        current_round = self.rounds[-1]
+        if player in current_round.ballots:
             raise GameError("Can't vote twice!")
 
-        if player not in self.current_party:
+        if player not in current_round.votes[-1].members:
             raise GameError("Only party members can vote!")
-        if not outcome and player not in self.spies:
+        if not outcome and player not in self._spy_set:
             raise GameError("Only spies can vote black!")
 
-        self.current_round.ballots[player] = outcome
-        self._log("Player %s votes %s", player.name, "red" if outcome else "black")
+        current_round.cast(player, outcome)
+        self.version += 1
+        self._log("Player %s votes %s", player.name, "red" if outcome else "black", level=logging.DEBUG)
 
-        if len(self.current_round.ballots) >= self.current_party_size:
+        if len(current_round.ballots) >= self._party_sizes[len(self.rounds) - 1]:
             self.state = GameState.MISSION_VOTE_RESULTS
-            self._log("Round over: mission %s", "successful" if self.current_round.outcome else "failed")
+            self._log("Round over: mission %s", "successful" if current_round.outcome else "failed")
+
+    def skip_leader(self) -> None:
+        """
+        Passes the proposal to the next player. The skipped proposal counts as a failed vote (with
+        an empty party and no ballots), so that a game nobody plays runs out of rounds and ends.
+        """
+        if self.state != GameState.PROPOSAL_PENDING:
+            raise GameError("Party proposal not pending!")
+
+        self._log("Leader %s is skipped", self.leader.name)
+        self.rounds[-1].votes.append(Vote([]))
+        self.version += 1
+        self.state = GameState.PARTY_VOTE_RESULTS
+        self.next_state()
+
+    def close_party_vote(self) -> None:
+        """Counts the missing ballots of the party vote as negative."""
+        if self.state != GameState.PARTY_VOTE_IN_PROGRESS:
+            raise GameError("Party vote not in progress!")
+
+        for player in self.players:
+            if self.state != GameState.PARTY_VOTE_IN_PROGRESS:
+                break
+            if player not in self.current_vote.ballots:
+                self.vote_party(player, False)
+
+    def close_mission_vote(self) -> None:
+        """Counts the missing ballots of the mission as red."""
+        if self.state != GameState.MISSION_VOTE_IN_PROGRESS:
+            raise GameError("Mission vote not in progress!")
+
+        for player in self.current_party:
+            if self.state != GameState.MISSION_VOTE_IN_PROGRESS:
+                break
+            if player not in self.current_round.ballots:
+                self.vote_mission(player, True)
 
     @property
     def state(self) -> GameState:
@@ -165,69 +263,150 @@ class GameInstance:
     @state.setter
     def state(self, value: GameState) -> None:
         self._state = value
+        self.version += 1
         self._log("State is now %s", value)
 
     @property
     def current_round(self) -> Optional[Round]:
-        if self.state not in [GameState.NOT_STARTED, GameState.GAME_OVER]:
+        if self._state in ROUND_STATES:
             return self.rounds[-1]
         return None
 
     @property
     def current_vote(self) -> Optional[Vote]:
-        if self.state in [GameState.PARTY_VOTE_IN_PROGRESS, GameState.PARTY_VOTE_RESULTS]:
-            return self.current_round.last_vote
+        if self._state in VOTE_STATES:
+            return self.rounds[-1].votes[-1]
         return None
 
     @property
     def current_party(self) -> Optional[list[Player]]:
-        if self.state in [GameState.PARTY_VOTE_IN_PROGRESS, GameState.PARTY_VOTE_RESULTS,
-                          GameState.MISSION_VOTE_IN_PROGRESS, GameState.MISSION_VOTE_RESULTS]:
-            return self.current_round.last_vote.party
+        if self._state in PARTY_STATES:
+            return self.rounds[-1].votes[-1].party
         return None
 
     @property
     def current_party_size(self) -> Optional[int]:
-        if self.state not in [GameState.NOT_STARTED, GameState.GAME_OVER]:
-            round_idx = len(self.rounds) - 1
-            return PARTY_SIZES[len(self.players)][round_idx]
+        if self._state in ROUND_STATES:
+            return self._party_sizes[len(self.rounds) - 1]
         return None
 
     @property
     def current_winning_count(self) -> Optional[int]:
-        if self.state not in [GameState.NOT_STARTED, GameState.GAME_OVER]:
-            return self.current_round.winning_count
+        if self._state in ROUND_STATES:
+            return self.rounds[-1].winning_count
         return None
 
     @property
     def leader(self) -> Optional[Player]:
-        if self.state not in [GameState.NOT_STARTED, GameState.GAME_OVER]:
+        if self._state in ROUND_STATES:
             return self.players[self._leader_idx]
         return None
 
     @property
     def outcome(self) -> Optional[bool]:
-        outcomes = [x.outcome for x in self.rounds]
-        resistance_wins = outcomes.count(True)
-        spy_wins = outcomes.count(False)
-
-        if resistance_wins >= WIN_LIMIT:
+        # Only the finished rounds are taken into account
+        if self._resistance_wins >= WIN_LIMIT:
             return True
-        elif spy_wins >= WIN_LIMIT:
+        elif self._spy_wins >= WIN_LIMIT:
             return False
         return None
 
+    def is_spy(self, player: Player) -> bool:
+        return player in self._spy_set
+
+    def checksum(self) -> int:
+        """A checksum of the whole state, for replays to compare against (see Game.checksum)."""
+        # Ballots and spies are taken in seat order, which packing the state keeps (see pack())
+        rounds = [(r.winning_count, [([p.id for p in v.party], [v.ballots.get(p) for p in self.players])
+                                     for v in r.votes], [r.ballots.get(p) for p in self.players])
+                  for r in self.rounds]
+        state = (self.version, self.state.value, self._leader_idx, [p.id for p in self.players],
+                 [p in self._spy_set for p in self.players], rounds)
+        return zlib.crc32(repr(state).encode())
+
+    def pack(self) -> bytes:
+        """
+        Packs the state into a few bytes: players as user ids, the spies and ballots as masks of
+        seats and parties as seat numbers. The order in which ballots were cast isn't kept.
+        """
+        seats = {player: i for i, player in enumerate(self.players)}
+        chunks = [
+            SNAPSHOT_HEADER.pack(SNAPSHOT_VERSION, self._state.value, self.version, self._leader_idx,
+                                 len(self.players), _mask(seats, self.spies), self._resistance_wins,
+                                 self._spy_wins, len(self.rounds)),
+            struct.pack(f'<{len(self.players)}q', *(x.id for x in self.players)),
+        ]
+        for r in self.rounds:
+            chunks.append(ROUND_HEADER.pack(r.winning_count, len(r.votes), _mask(seats, r.ballots),
+                                            _mask(seats, [p for p, x in r.ballots.items() if x])))
+            for vote in r.votes:
+                chunks.append(VOTE_HEADER.pack(len(vote.party), _mask(seats, vote.ballots),
+                                               _mask(seats, [p for p, x in vote.ballots.items() if x])))
+                chunks.append(bytes(seats[x] for x in vote.party))
+        return b''.join(chunks)
+
+    @classmethod
+    def unpack(cls, data: bytes, players: dict[int, Player], rng: Optional[random.Random] = None) -> 'GameInstance':
+        """Restores a state packed by pack(), given the players by user id."""
+        (version, state, state_version, leader_idx, player_count, spy_mask, resistance_wins, spy_wins,
+         round_count) = SNAPSHOT_HEADER.unpack_from(data)
+        if version != SNAPSHOT_VERSION:
+            raise GameError(f"Unsupported snapshot version: {version}")
+        pos = SNAPSHOT_HEADER.size
+
+        ids = struct.unpack_from(f'<{player_count}q', data, pos)
+        pos += 8 * player_count
+
+        game = cls([players[x] for x in ids], rng)
+        seated = game.players
+        for _ in range(round_count):
+            winning_count, vote_count, cast_mask, red_mask = ROUND_HEADER.unpack_from(data, pos)
+            pos += ROUND_HEADER.size
+
+            r = Round(winning_count)
+            for _ in range(vote_count):
+                party_size, vote_mask, approve_mask = VOTE_HEADER.unpack_from(data, pos)
+                pos += VOTE_HEADER.size
+                vote = Vote([seated[i] for i in data[pos:pos + party_size]])
+                pos += party_size
+
+                for i, player in enumerate(seated):
+                    if vote_mask >> i & 1:
+                        vote.cast(player, bool(approve_mask >> i & 1))
+                r.votes.append(vote)
+
+            for i, player in enumerate(seated):
+                if cast_mask >> i & 1:
+                    r.cast(player, bool(red_mask >> i & 1))
+            game.rounds.append(r)
+
+        game.spies = [x for i, x in enumerate(seated) if spy_mask >> i & 1]
+        game._spy_set = frozenset(game.spies)
+        game._state = GameState(state)
+        game.version = state_version
+        game._leader_idx = leader_idx
+        game._resistance_wins = resistance_wins
+        game._spy_wins = spy_wins
+        return game
+
     def _assign_spies(self) -> None:
         # According to the official rules, one third of players (rounded up) are spies
         spy_count = (len(self.players) + 2) // 3
 
-        self.spies = random.sample(self.players, spy_count)
+        self.spies = self._random.sample(self.players, spy_count)
+        self._spy_set = frozenset(self.spies)
         self._log("Spies appointed: %s", list(x.name for x in self.spies))
 
     def _next_leader(self) -> None:
         self._leader_idx = (self._leader_idx + 1) % len(self.players)
 
     def _next_round_or_game_over(self) -> None:
+        if self.rounds:
+            if self.rounds[-1].outcome:
+                self._resistance_wins += 1
+            else:
+                self._spy_wins += 1
+
         if self.outcome is None:
             winning_count = 1
             if len(self.players) >= MIN_2IN4TH and len(self.rounds) == 3:
@@ -241,6 +420,13 @@ class GameInstance:
             self.state = GameState.GAME_OVER
             self._log("The game is over: %s", "resistance wins" if self.outcome else "spies win")
 
-    def _log(self, message: str, *args) -> None:
-        # TODO: Log game ID
-        logger.info(message, *args)
+    def _log(self, message: str, *args, level: int = logging.INFO) -> None:
+        # The game id and type are attached by the game manager through core.logs.log_context
+        logger.log(level, message, *args)
+
+
+def _mask(seats: dict[Player, int], players) -> int:
+    mask = 0
+    for player in players:
+        mask |= 1 << seats[player]
+    return mask
@@ -0,0 +1,352 @@
+"""
+Headless Resistance simulator for balance analysis.
+
+Games are played by simulated players following a policy. Every random decision is drawn from
+a counter-based generator keyed by (seed, game index, decision), so a game plays out the same
+way no matter which mode runs it or which worker process it lands in. The scalar mode drives
+GameInstance itself; the batch mode replays the same rules on NumPy arrays for many games at
+once and produces bit-identical results.
+
+Usage: python -m games.resistance.simulation [--players 5-10] [--games N] [--mode batch|scalar]
+                                             [--workers N] [--seed N] [--check N]
+"""
+
+import argparse
+import logging
+import math
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional, Sequence
+
+import numpy as np
+from telegram import User
+
+from core.api import Player
+from games.resistance.logic import GameInstance, GameState, MIN_PLAYERS, MAX_PLAYERS, PARTY_SIZES, \
+    VOTE_LIMIT, WIN_LIMIT, MIN_2IN4TH
+
+MASK = (1 << 64) - 1
+GOLDEN = 0x9e3779b97f4a7c15
+
+# Decision kinds used as the first field of every random key
+SPIES, PROPOSAL, PARTY_VOTE, MISSION_VOTE = range(4)
+
+
+def _mix(x: int) -> int:
+    # SplitMix64 finalizer
+    x = ((x ^ (x >> 30)) * 0xbf58476d1ce4e5b9) & MASK
+    x = ((x ^ (x >> 27)) * 0x94d049bb133111eb) & MASK
+    return x ^ (x >> 31)
+
+
+def _mix_np(x: np.ndarray) -> np.ndarray:
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+    return x ^ (x >> np.uint64(31))
+
+
+def _to_uniform(key):
+    # 53 random bits mapped to [0, 1), exactly the same for Python ints and NumPy arrays
+    return (key >> 11) * 2.0 ** -53
+
+
+class CounterRNG(random.Random):
+    """The random source of a single simulated game."""
+
+    def __init__(self, seed: int, game: int):
+        super().__init__(seed)
+        self.base = _mix((seed ^ _mix((game + GOLDEN) & MASK)) & MASK)
+
+    def key(self, kind: int, a: int = 0, b: int = 0, c: int = 0) -> int:
+        x = self.base
+        for field in (kind, a, b, c):
+            x = _mix(x ^ (((field + 1) * GOLDEN) & MASK))
+        return x
+
+    def uniform01(self, kind: int, a: int = 0, b: int = 0, c: int = 0) -> float:
+        return _to_uniform(self.key(kind, a, b, c))
+
+    def sample(self, population: Sequence, k: int, *, counts=None) -> list:
+        # Used by GameInstance to appoint spies: the k members with the smallest keys
+        order = sorted(range(len(population)), key=lambda i: (self.key(SPIES, i), i))
+        return [population[i] for i in order[:k]]
+
+
+class BatchRNG:
+    """The random sources of a batch of simulated games."""
+
+    def __init__(self, seed: int, games: np.ndarray):
+        seed = np.uint64(seed)
+        self.base = _mix_np(seed ^ _mix_np(games.astype(np.uint64) + np.uint64(GOLDEN)))
+
+    @staticmethod
+    def key(base: np.ndarray, kind: int, a, b, c) -> np.ndarray:
+        x = base
+        for field in (kind, a, b, c):
+            if isinstance(field, int):
+                salt = np.uint64(((field + 1) * GOLDEN) & MASK)
+            else:
+                salt = (field.astype(np.uint64) + np.uint64(1)) * np.uint64(GOLDEN)
+            x = _mix_np(x ^ salt)
+        return x
+
+    def uniform01(self, base: np.ndarray, kind: int, a, b, c) -> np.ndarray:
+        return _to_uniform(self.key(base, kind, a, b, c))
+
+
+class Policy:
+    """
+    Decides how simulated players act. Every decision has a scalar form, used with GameInstance,
+    and a batch form working on arrays of games; both must draw the same keys.
+    """
+
+    def propose(self, rng: CounterRNG, round_idx: int, vote_idx: int, leader: int, party_size: int,
+                player_count: int) -> list[int]:
+        raise NotImplementedError()
+
+    def vote_party(self, rng: CounterRNG, round_idx: int, vote_idx: int, player: int, is_spy: bool,
+                   in_party: bool, party_has_spy: bool) -> bool:
+        raise NotImplementedError()
+
+    def vote_mission(self, rng: CounterRNG, round_idx: int, player: int, is_spy: bool) -> bool:
+        raise NotImplementedError()
+
+    def propose_batch(self, rng: BatchRNG, base: np.ndarray, round_idx: np.ndarray, vote_idx: np.ndarray,
+                      leader: np.ndarray, party_size: np.ndarray, player_count: int) -> np.ndarray:
+        raise NotImplementedError()
+
+    def vote_party_batch(self, rng: BatchRNG, base: np.ndarray, round_idx: np.ndarray, vote_idx: np.ndarray,
+                         spies: np.ndarray, party: np.ndarray, party_has_spy: np.ndarray) -> np.ndarray:
+        raise NotImplementedError()
+
+    def vote_mission_batch(self, rng: BatchRNG, base: np.ndarray, round_idx: np.ndarray,
+                           spies: np.ndarray) -> np.ndarray:
+        raise NotImplementedError()
+
+
+class SimplePolicy(Policy):
+    """
+    The leader proposes themselves and random players. Resistance members approve parties
+    with a fixed probability (higher when they are in the party), spies approve parties with
+    spies in them more eagerly, and spies on a mission play black with a fixed probability.
+    """
+
+    def __init__(self, approve: float = 0.5, approve_in_party: float = 0.8, spy_approve_with_spy: float = 0.9,
+                 spy_approve_without_spy: float = 0.3, spy_black: float = 0.8):
+        self.approve = approve
+        self.approve_in_party = approve_in_party
+        self.spy_approve_with_spy = spy_approve_with_spy
+        self.spy_approve_without_spy = spy_approve_without_spy
+        self.spy_black = spy_black
+
+    def propose(self, rng, round_idx, vote_idx, leader, party_size, player_count):
+        keys = [rng.key(PROPOSAL, round_idx, vote_idx, i) for i in range(player_count)]
+        keys[leader] = 0
+        return sorted(range(player_count), key=lambda i: (keys[i], i))[:party_size]
+
+    def vote_party(self, rng, round_idx, vote_idx, player, is_spy, in_party, party_has_spy):
+        if is_spy:
+            probability = self.spy_approve_with_spy if party_has_spy else self.spy_approve_without_spy
+        else:
+            probability = self.approve_in_party if in_party else self.approve
+        return rng.uniform01(PARTY_VOTE, round_idx, vote_idx, player) < probability
+
+    def vote_mission(self, rng, round_idx, player, is_spy):
+        return not is_spy or not rng.uniform01(MISSION_VOTE, round_idx, 0, player) < self.spy_black
+
+    def propose_batch(self, rng, base, round_idx, vote_idx, leader, party_size, player_count):
+        players = np.arange(player_count)
+        keys = rng.key(base[:, None], PROPOSAL, round_idx[:, None], vote_idx[:, None], players[None, :])
+        keys[np.arange(len(base)), leader] = 0
+        return _rank(keys) < party_size[:, None]
+
+    def vote_party_batch(self, rng, base, round_idx, vote_idx, spies, party, party_has_spy):
+        probability = np.where(
+            spies,
+            np.where(party_has_spy[:, None], self.spy_approve_with_spy, self.spy_approve_without_spy),
+            np.where(party, self.approve_in_party, self.approve))
+        players = np.arange(spies.shape[1])
+        draws = rng.uniform01(base[:, None], PARTY_VOTE, round_idx[:, None], vote_idx[:, None], players[None, :])
+        return draws < probability
+
+    def vote_mission_batch(self, rng, base, round_idx, spies):
+        players = np.arange(spies.shape[1])
+        draws = rng.uniform01(base[:, None], MISSION_VOTE, round_idx[:, None], 0, players[None, :])
+        return ~spies | ~(draws < self.spy_black)
+
+
+class SimulationResult:
+    def __init__(self, player_count: int, winners: np.ndarray, rounds: np.ndarray):
+        self.player_count = player_count
+        self.winners = winners
+        self.rounds = rounds
+
+    @property
+    def games(self) -> int:
+        return len(self.winners)
+
+    @property
+    def resistance_win_rate(self) -> float:
+        return float(self.winners.mean())
+
+    @property
+    def confidence_interval(self) -> float:
+        # Half-width of the 95% confidence interval of the win rate
+        rate = self.resistance_win_rate
+        return 1.96 * math.sqrt(rate * (1 - rate) / self.games)
+
+
+def _rank(keys: np.ndarray) -> np.ndarray:
+    # Position of every element in its row when sorted, ties broken by index like sorted() does
+    order = np.argsort(keys, axis=1, kind='stable')
+    ranks = np.empty_like(order)
+    np.put_along_axis(ranks, order, np.arange(keys.shape[1])[None, :], axis=1)
+    return ranks
+
+
+def _make_players(player_count: int) -> list[Player]:
+    return [Player(User(i, f'Player {i}', False)) for i in range(player_count)]
+
+
+def play_scalar(player_count: int, seed: int, game_idx: int, policy: Policy,
+                players: Optional[list[Player]] = None) -> tuple[bool, int]:
+    """Plays a game on GameInstance and returns whether the resistance won and the number of rounds."""
+    players = players or _make_players(player_count)
+    index = {player: i for i, player in enumerate(players)}
+    rng = CounterRNG(seed, game_idx)
+
+    game = GameInstance(players, rng)
+    game.next_state()
+
+    while game.state != GameState.GAME_OVER:
+        round_idx = len(game.rounds) - 1
+        vote_idx = len(game.current_round.votes)
+
+        if game.state == GameState.PROPOSAL_PENDING:
+            party = policy.propose(rng, round_idx, vote_idx, index[game.leader], game.current_party_size,
+                                   player_count)
+            game.propose_party(game.leader, [players[i] for i in party])
+
+        elif game.state == GameState.PARTY_VOTE_IN_PROGRESS:
+            vote = game.current_vote
+            party_has_spy = any(game.is_spy(x) for x in vote.party)
+            for player in players:
+                game.vote_party(player, policy.vote_party(
+                    rng, round_idx, vote_idx - 1, index[player], game.is_spy(player), player in vote.members,
+                    party_has_spy))
+            game.next_state()
+
+        elif game.state == GameState.MISSION_VOTE_IN_PROGRESS:
+            for player in game.current_party:
+                game.vote_mission(player, policy.vote_mission(rng, round_idx, index[player], game.is_spy(player)))
+            game.next_state()
+
+    return game.outcome, len(game.rounds)
+
+
+def play_batch(player_count: int, seed: int, game_indices: np.ndarray, policy: Policy) -> tuple[np.ndarray, np.ndarray]:
+    """Plays a batch of games on arrays and returns the winners and round counts."""
+    count = len(game_indices)
+    rng = BatchRNG(seed, game_indices)
+    party_sizes = np.array(PARTY_SIZES[player_count])
+
+    spy_count = (player_count + 2) // 3
+    spy_keys = rng.key(rng.base[:, None], SPIES, np.arange(player_count)[None, :], 0, 0)
+    spies = _rank(spy_keys) < spy_count
+
+    # Leadership starts with the last player, as in GameInstance
+    leader = np.full(count, player_count - 1)
+    round_idx = np.zeros(count, dtype=np.int64)
+    vote_idx = np.zeros(count, dtype=np.int64)
+    resistance_wins = np.zeros(count, dtype=np.int64)
+    spy_wins = np.zeros(count, dtype=np.int64)
+
+    active = np.arange(count)
+    while len(active):
+        base = rng.base[active]
+        r, v, l, s = round_idx[active], vote_idx[active], leader[active], spies[active]
+
+        party = policy.propose_batch(rng, base, r, v, l, party_sizes[r], player_count)
+        party_has_spy = (party & s).any(axis=1)
+        ballots = policy.vote_party_batch(rng, base, r, v, s, party, party_has_spy)
+        appointed = 2 * ballots.sum(axis=1) > player_count
+
+        red = policy.vote_mission_batch(rng, base, r, s)
+        black = (party & ~red).sum(axis=1)
+        winning_count = np.where((player_count >= MIN_2IN4TH) & (r == 3), 2, 1)
+
+        rejected = ~appointed & (v + 1 >= VOTE_LIMIT)
+        round_over = appointed | rejected
+        resistance_won = appointed & (black < winning_count)
+
+        resistance_wins[active] += resistance_won
+        spy_wins[active] += round_over & ~resistance_won
+        leader[active] = (l + 1) % player_count
+        round_idx[active] = r + round_over
+        vote_idx[active] = np.where(round_over, 0, v + 1)
+
+        active = active[(resistance_wins[active] < WIN_LIMIT) & (spy_wins[active] < WIN_LIMIT)]
+
+    return resistance_wins >= WIN_LIMIT, round_idx
+
+
+def _run_chunk(player_count: int, seed: int, start: int, stop: int, policy: Policy,
+               mode: str) -> tuple[np.ndarray, np.ndarray]:
+    if mode == 'batch':
+        return play_batch(player_count, seed, np.arange(start, stop), policy)
+
+    players = _make_players(player_count)
+    results = [play_scalar(player_count, seed, i, policy, players) for i in range(start, stop)]
+    return np.array([x[0] for x in results], dtype=bool), np.array([x[1] for x in results], dtype=np.int64)
+
+
+def simulate(player_count: int, games: int, seed: int = 0, policy: Optional[Policy] = None, mode: str = 'batch',
+             workers: int = 1, chunk_size: int = 10000) -> SimulationResult:
+    policy = policy or SimplePolicy()
+    chunks = [(start, min(start + chunk_size, games)) for start in range(0, games, chunk_size)]
+
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(_run_chunk, player_count, seed, start, stop, policy, mode)
+                       for start, stop in chunks]
+            results = [future.result() for future in futures]
+    else:
+        results = [_run_chunk(player_count, seed, start, stop, policy, mode) for start, stop in chunks]
+
+    return SimulationResult(player_count, np.concatenate([x[0] for x in results]),
+                            np.concatenate([x[1] for x in results]))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--players', default=f'{MIN_PLAYERS}-{MAX_PLAYERS}', help="player count or range")
+    parser.add_argument('--games', type=int, default=100000, help="games per player count")
+    parser.add_argument('--mode', choices=['batch', 'scalar'], default='batch')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--check', type=int, default=0, help="verify the first N games against GameInstance")
+    args = parser.parse_args()
+
+    # GameInstance logs every transition
+    logging.disable(logging.INFO)
+
+    low, _, high = args.players.partition('-')
+    for player_count in range(int(low), int(high or low) + 1):
+        if args.check:
+            scalar = simulate(player_count, args.check, args.seed, mode='scalar')
+            batch = simulate(player_count, args.check, args.seed, mode='batch')
+            if not (np.array_equal(scalar.winners, batch.winners) and np.array_equal(scalar.rounds, batch.rounds)):
+                raise SystemExit(f"Batch mode diverges from GameInstance with {player_count} players")
+
+        start = time.perf_counter()
+        result = simulate(player_count, args.games, args.seed, mode=args.mode, workers=args.workers)
+        elapsed = time.perf_counter() - start
+
+        print(f"{player_count:2} players: resistance wins {result.resistance_win_rate:6.2%} "
+              f"± {result.confidence_interval:.2%}, {result.rounds.mean():.2f} rounds on average "
+              f"({result.games / elapsed:.0f} games/s)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,139 @@
+"""
+Replays traces written by the bot (see GAMEBOT_TRACE_PATH and core.trace) headlessly, as fast as
+the games can go, and checks that every action leaves its game in the state it was recorded in.
+
+Usage: python replay.py TRACE [TRACE ...] [--username BOT_USERNAME] [--game NAME=MODULE:ATTRIBUTE ...]
+"""
+
+import argparse
+import base64
+import logging
+import queue
+import sys
+import time
+
+from telegram import Bot as TelegramBot, Chat, User
+from telegram.ext import Dispatcher
+
+from core.api import Game, Party, player_registry
+from core.gamemanager import decode_action, replay_action
+from core.registry import GameRegistry
+from core.snapshot import GameSnapshot
+from core.trace import GAME, TraceRecord, read_trace
+from games import MANIFEST
+
+logger = logging.getLogger('replay')
+
+# Nothing is sent while replaying, the token only has to be well-formed
+STUB_TOKEN = '123456:REPLAY'
+
+# Username of the bot that wrote the trace, which commands may be addressed to (e.g. /move@gamebot)
+DEFAULT_USERNAME = 'gamebot'
+
+
+class Replay:
+    """Replays the records of traces into muted games."""
+
+    def __init__(self, games: GameRegistry, username: str = DEFAULT_USERNAME):
+        self.registry = games
+
+        # The identity of the bot is set up front, as it would otherwise be requested from Telegram
+        bot = TelegramBot(STUB_TOKEN)
+        bot._bot = User(int(STUB_TOKEN.partition(':')[0]), username, True, username=username)
+        self.dispatcher = Dispatcher(bot, queue.Queue())
+
+        self.games: dict[int, Game] = {}
+        self.game_names: dict[int, str] = {}
+        self.action_counts: dict[int, int] = {}
+        self.diverged: set[int] = set()
+
+        self.game_count = 0
+        self.action_count = 0
+        self.skipped_count = 0
+
+    def apply(self, record: TraceRecord) -> None:
+        if record.kind == GAME:
+            self._create_game(record)
+            return
+
+        game = self.games.get(record.game_id)
+        if game is None:
+            # Games that failed to be created, or were created before the trace started
+            self.skipped_count += 1
+            return
+
+        replay_action(game, decode_action(record.action, self.dispatcher))
+        self.action_count += 1
+        self.action_counts[record.game_id] += 1
+
+        if record.checksum is None or record.game_id in self.diverged:
+            return
+        checksum = game.checksum()
+        if checksum != record.checksum:
+            # Everything after the first difference differs as well
+            self.diverged.add(record.game_id)
+            logger.error("Game %s (%s) diverges at action %s (%.3f s into the trace): %s, recorded %s",
+                         record.game_id, self.game_names[record.game_id], self.action_counts[record.game_id],
+                         record.time, checksum, record.checksum)
+
+    def _create_game(self, record: TraceRecord) -> None:
+        # Restored games are recorded again with all of their actions, and replayed from scratch
+        self.games.pop(record.game_id, None)
+        self.diverged.discard(record.game_id)
+
+        data = record.game
+        bot = self.dispatcher.bot
+        users = [User.de_json(x, bot) for x in data['players']]
+        leader = User.de_json(data['leader'], bot)
+        chat = Chat.de_json(data['chat'], bot)
+
+        party = Party([player_registry.get(x) for x in users], player_registry.get(leader), chat)
+        party.muted = True
+        try:
+            game = self.registry.get(data['name'])(None, party, record.game_id, data['seed'])
+            # Games resumed from a snapshot (e.g. moved from another worker) start from it
+            if data.get('snapshot') is not None:
+                GameSnapshot.decode(base64.b64decode(data['snapshot']), bot).apply(game)
+        except Exception as e:
+            logger.warning("Failed to create game %s (%s)", record.game_id, data['name'], exc_info=e)
+            return
+
+        self.games[record.game_id] = game
+        self.game_names[record.game_id] = data['name']
+        self.action_counts[record.game_id] = 0
+        self.game_count += 1
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('traces', nargs='+')
+    parser.add_argument('--username', default=DEFAULT_USERNAME, help="username of the bot that wrote the traces")
+    parser.add_argument('--game', action='append', default=[], help="game to use instead of the manifest's")
+    args = parser.parse_args()
+
+    # Games log every step they take at the info level, which would only slow the replay down
+    logging.basicConfig(level=logging.WARNING, format='%(levelname)s %(message)s')
+
+    registry = GameRegistry()
+    registry.add_manifest(MANIFEST)
+    for game in args.game:
+        name, _, spec = game.partition('=')
+        registry.add(name, spec)
+
+    replay = Replay(registry, args.username)
+    start = time.perf_counter()
+    for path in args.traces:
+        for record in read_trace(path):
+            replay.apply(record)
+    elapsed = time.perf_counter() - start
+
+    print(f"Replayed {replay.action_count} action(s) of {replay.game_count} game(s) in {elapsed:.2f} s "
+          f"({replay.action_count / max(elapsed, 1e-9):.0f} actions/s), skipped {replay.skipped_count}")
+    if replay.diverged:
+        print(f"{len(replay.diverged)} game(s) diverged from the trace")
+        sys.exit(1)
+    print("Every game matches the trace")
+
+
+if __name__ == '__main__':
+    main()
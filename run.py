@@ -1,20 +1,69 @@
 import os
 import logging
+import threading
+from typing import Optional
 
 from core import Bot
-from games import Chess, Resistance
+from core.ingress import run_ingress
+from core.logs import setup_logging, LoggerPolicy
+from games import MANIFEST
 
-logging.basicConfig(
-    level=logging.DEBUG,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+setup_logging(
+    level=getattr(logging, os.environ.get('GAMEBOT_LOG_LEVEL', 'INFO').upper()),
+    policies={
+        # Game logs are the bulk of the output of a busy bot
+        'games': LoggerPolicy(max_per_second=100),
+        'telegram': LoggerPolicy(max_per_second=10),
+    })
+
+
+def create_bot(worker: Optional[int] = None) -> Bot:
+    max_live_games = os.environ.get('GAMEBOT_MAX_LIVE_GAMES')
+    metrics_port = os.environ.get('GAMEBOT_METRICS_PORT')
+    storage_path = os.environ.get('GAMEBOT_STORAGE_PATH')
+    trace_path = os.environ.get('GAMEBOT_TRACE_PATH')
+
+    # Ingress workers own separate games, so each of them gets its own storage and metrics port
+    if worker is not None:
+        if storage_path:
+            storage_path = os.path.join(storage_path, f'worker{worker}')
+        if metrics_port:
+            metrics_port = str(int(metrics_port) + worker)
+        if trace_path:
+            trace_path = f'{trace_path}.worker{worker}'
+
+    bot = Bot(
+        token=os.environ['GAMEBOT_TELEGRAM_TOKEN'],
+        storage_path=storage_path,
+        max_live_games=int(max_live_games) if max_live_games else None,
+        metrics_port=int(metrics_port) if metrics_port else None,
+        async_mode=os.environ.get('GAMEBOT_ASYNC') == '1',
+        trace_path=trace_path)
+
+    # Games are imported the first time they are played, unless they are preloaded
+    bot.game_manager.games.add_manifest(MANIFEST)
+    preload = os.environ.get('GAMEBOT_PRELOAD_GAMES')
+    if preload:
+        threading.Thread(target=bot.game_manager.games.preload, args=(preload.split(','),),
+                         name='preload', daemon=True).start()
+    return bot
 
 
 def main():
-    bot = Bot(token=os.environ['GAMEBOT_TELEGRAM_TOKEN'])
-    bot.game_manager.add_game('chess', Chess)
-    bot.game_manager.add_game('resistance', Resistance)
-    bot.run()
-    
-    
+    webhook_fqdn = os.environ.get('GAMEBOT_WEBHOOK_FQDN')
+    if webhook_fqdn is None:
+        create_bot().run()
+        return
+
+    workers = os.environ.get('GAMEBOT_INGRESS_WORKERS')
+    run_ingress(
+        create_bot,
+        token=os.environ['GAMEBOT_TELEGRAM_TOKEN'],
+        fqdn=webhook_fqdn,
+        ip=os.environ.get('GAMEBOT_WEBHOOK_IP', '0.0.0.0'),
+        port=int(os.environ.get('GAMEBOT_WEBHOOK_PORT', 80)),
+        workers=int(workers) if workers else None)
+
+
 if __name__ == '__main__':
     main()
@@ -0,0 +1,28 @@
+import re
+
+import pytest
+
+from core.api import _get_pattern_prefix
+
+PATTERN_PREFIXES = [
+    ('^resistance_vote_', 'resistance_vote'),
+    ('^vote_yes$', 'vote_yes'),
+    ('^vote_yes', 'vote'),
+    ('^vote_a+', 'vote'),
+    ('^vote_x?', 'vote'),
+    ('^vote_yes_*', 'vote'),
+    ('^vote_a{0,2}', 'vote'),
+    (re.compile('^vote_'), 'vote'),
+    # Patterns the routing can't narrow down, which are checked against every callback query
+    ('^ab_?cd', None),
+    ('^ab?', None),
+    ('^vote_yes|no', None),
+    ('vote_', None),
+    (re.compile('^vote_', re.IGNORECASE), None),
+    (None, None),
+]
+
+
+@pytest.mark.parametrize('pattern, prefix', PATTERN_PREFIXES)
+def test_pattern_prefix(pattern, prefix):
+    assert _get_pattern_prefix(pattern) == prefix
@@ -0,0 +1,20 @@
+import pytest
+
+from benchmarks.perft import POSITIONS
+from games.chess.board import Board, perft
+
+# Deeper counts are left to the benchmark, as they take seconds each
+MAX_NODES = 500000
+
+CASES = [(name, fen, depth, nodes)
+         for name, fen, counts in POSITIONS
+         for depth, nodes in enumerate(counts, 1) if nodes <= MAX_NODES]
+
+
+@pytest.mark.parametrize('name, fen, depth, nodes', CASES, ids=[f'{x[0]}-{x[2]}' for x in CASES])
+def test_perft(name, fen, depth, nodes):
+    board = Board(fen)
+    assert perft(board, depth) == nodes
+
+    # Unmaking the moves restores the position exactly
+    assert board.fen() == Board(fen).fen()
@@ -0,0 +1,32 @@
+import pytest
+
+from games.chess.board import Board
+from games.chess.engine import Searcher
+
+# Positions with the moves that solve them: mates, won material, promotions
+TACTICS = [
+    ('back rank mate', '6k1/5ppp/8/8/8/8/5PPP/3R2K1 w - - 0 1', {'Rd8#'}),
+    ("fool's mate", 'rnbqkbnr/pppp1ppp/8/4p3/6P1/5P2/PPPPP2P/RNBQKBNR b KQkq - 0 2', {'Qh4#'}),
+    ("scholar's mate", 'r1bqkbnr/pppp1ppp/2n5/4p3/2B1P3/5Q2/PPPP1PPP/RNB1K1NR w KQkq - 2 3', {'Qxf7#'}),
+    ('rook mate in 2', 'k7/8/2K5/8/8/8/8/7R w - - 0 1', {'Kb6', 'Kc7'}),
+    ('hanging queen', 'k7/8/8/3q4/8/8/8/K2R4 w - - 0 1', {'Rxd5'}),
+    ('knight fork', 'r3k3/8/8/3N4/8/8/8/4K3 w - - 0 1', {'Nc7+'}),
+    ('skewer', 'k7/8/8/8/4q3/8/8/K6B w - - 0 1', {'Bxe4+'}),
+    ('promotion', '8/P7/8/8/8/8/k7/7K w - - 0 1', {'a8=Q', 'a8=Q+'}),
+]
+
+# Searches stop at this depth, which every position needs at most, long before the time limit
+DEPTH = 5
+TIME_LIMIT = 30
+
+
+@pytest.mark.parametrize('name, fen, answers', TACTICS, ids=[x[0] for x in TACTICS])
+def test_tactics(name, fen, answers):
+    board = Board(fen)
+    result = Searcher().search(board, TIME_LIMIT, max_depth=DEPTH)
+    assert board.san(result.move) in answers
+
+
+def test_mate_in_two():
+    result = Searcher().search(Board('k7/8/2K5/8/8/8/8/7R w - - 0 1'), TIME_LIMIT, max_depth=DEPTH)
+    assert result.mate_in == 2
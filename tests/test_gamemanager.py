@@ -0,0 +1,145 @@
+import random
+import threading
+from queue import Queue
+
+from telegram import Chat, Update, User
+from telegram.ext import CallbackContext, Dispatcher
+
+from core.api import TelegramUpdate, player_registry
+from core.gamemanager import GameManager
+from games import MANIFEST
+from games.resistance.game import CallbackAction
+from games.resistance.logic import GameState
+
+PLAYERS = 10
+SEED = 1234
+
+
+class StubBot:
+    """Accepts every Bot API call and does nothing."""
+
+    username = 'gamebot'
+    defaults = None
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+
+
+class Client:
+    """Sends updates to a game on behalf of its players, the way Bot does."""
+
+    def __init__(self, manager: GameManager, dispatcher: Dispatcher, chat: Chat):
+        self.manager = manager
+        self.dispatcher = dispatcher
+        self.chat = chat
+        self.actions: list[TelegramUpdate] = []
+
+        # Actions in the order the game manager applied them, for the serial replay
+        record_action = manager.record_action
+
+        def record(game, action):
+            self.actions.append(action)
+            record_action(game, action)
+
+        manager.record_action = record
+
+        self._next_update_id = 0
+        self._lock = threading.Lock()
+
+    def command(self, user: User, text: str) -> TelegramUpdate:
+        command_length = len(text.split()[0])
+        return self._update(user, message={
+            'message_id': 1, 'date': 0, 'chat': self.chat.to_dict(), 'from': user.to_dict(), 'text': text,
+            'entities': [{'type': 'bot_command', 'offset': 0, 'length': command_length}]})
+
+    def tap(self, user: User, data: str) -> TelegramUpdate:
+        return self._update(user, callback_query={
+            'id': '1', 'from': user.to_dict(), 'chat_instance': 'chat', 'data': data,
+            'message': {'message_id': 1, 'date': 0, 'chat': self.chat.to_dict()}})
+
+    def send(self, action: TelegramUpdate) -> None:
+        for game in self.manager.find_games(action.raw_update):
+            handlers = game.handle(action)
+            if handlers:
+                self.manager.dispatch(game, action, handlers)
+
+    def settle(self, game) -> None:
+        self.manager.submit(game, lambda: None).result(timeout=10)
+
+    def _update(self, user: User, **fields) -> TelegramUpdate:
+        with self._lock:
+            self._next_update_id += 1
+            update_id = self._next_update_id
+        update = Update.de_json({'update_id': update_id, **fields}, self.dispatcher.bot)
+        return TelegramUpdate(update, CallbackContext.from_update(update, self.dispatcher), player_registry.get(user))
+
+
+def make_manager() -> tuple[GameManager, Client, list[User]]:
+    bot = StubBot()
+    chat = Chat(-100, Chat.GROUP, title='Group', bot=bot)
+    users = [User(i, f'Player {i}', False, bot=bot) for i in range(1, PLAYERS + 1)]
+
+    dispatcher = Dispatcher(bot, Queue())
+    manager = GameManager(dispatcher=dispatcher, workers=8)
+    manager.games.add_manifest(MANIFEST)
+    random.seed(SEED)
+    manager.new_game('resistance', users, users[0], chat)
+    return manager, Client(manager, dispatcher, chat), users
+
+
+def send_concurrently(client: Client, actions: list[TelegramUpdate]) -> None:
+    barrier = threading.Barrier(len(actions))
+
+    def send(action):
+        barrier.wait()
+        client.send(action)
+
+    threads = [threading.Thread(target=send, args=(x,)) for x in actions]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def test_concurrent_votes_match_serial_replay():
+    manager, client, users = make_manager()
+    game = manager.get_game(0)
+    instance = game.game
+    by_id = {x.id: x for x in users}
+    rng = random.Random(SEED)
+
+    for _ in range(8):
+        if instance.state != GameState.PROPOSAL_PENDING:
+            break
+        party = rng.sample(range(1, PLAYERS + 1), instance.current_party_size)
+        client.send(client.command(by_id[instance.leader.id], '/select ' + ' '.join(map(str, party))))
+        client.settle(game)
+        assert instance.state == GameState.PARTY_VOTE_IN_PROGRESS
+
+        # Every player votes at once, and some of them tap twice
+        voters = users + rng.sample(users, 3)
+        send_concurrently(client, [client.tap(x, game.callback_data(CallbackAction.PARTY_VOTE, rng.random() < 0.7))
+                                   for x in voters])
+        client.settle(game)
+        assert instance.state != GameState.PARTY_VOTE_IN_PROGRESS
+
+        if instance.state == GameState.MISSION_VOTE_IN_PROGRESS:
+            # Resistance members can only vote red
+            ballots = [(by_id[x.id], not instance.is_spy(x) or rng.random() < 0.5) for x in instance.current_party]
+            send_concurrently(client, [client.tap(x, game.callback_data(CallbackAction.MISSION_VOTE, red))
+                                       for x, red in ballots])
+            client.settle(game)
+            assert instance.state != GameState.MISSION_VOTE_IN_PROGRESS
+
+    assert len(instance.rounds) > 1
+
+    # The same actions, one at a time in the order they were applied, leave the same state
+    serial, serial_client, _ = make_manager()
+    serial_game = serial.get_game(0)
+    for action in client.actions:
+        serial_client.send(action)
+        serial_client.settle(serial_game)
+
+    assert serial_client.actions == client.actions
+    assert serial_game.game.state == instance.state
+    assert serial_game.checksum() == game.checksum()
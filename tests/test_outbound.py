@@ -0,0 +1,148 @@
+import asyncio
+import selectors
+from concurrent.futures import Executor, Future
+
+import pytest
+from telegram.error import RetryAfter
+
+from core.outbound import OutboundQueue, GROUP_CHAT_BURST, GROUP_CHAT_RATE, GLOBAL_BURST, GLOBAL_RATE
+
+GROUP_CHAT = -100
+
+# The virtual clock moves at least this much whenever the loop looks for events, as a real clock
+# would, so that timers due within the float resolution of the time don't keep it spinning
+TICK = 1e-9
+
+
+def at(seconds: float):
+    return pytest.approx(seconds, abs=1e-6)
+
+
+class VirtualSelector(selectors.DefaultSelector):
+    """Never blocks: the time the loop would wait for is skipped instead."""
+
+    def __init__(self):
+        super().__init__()
+        self.now = 0.0
+
+    def select(self, timeout=None):
+        events = super().select(0)
+        if not events:
+            self.now += max(timeout or 0, TICK)
+        return events
+
+
+class VirtualClockLoop(asyncio.SelectorEventLoop):
+    def __init__(self):
+        self._clock = VirtualSelector()
+        super().__init__(self._clock)
+
+    def time(self) -> float:
+        return self._clock.now
+
+
+class InlineExecutor(Executor):
+    """Runs the bot calls right away, so that they take no time on the virtual clock."""
+
+    def submit(self, fn, *args, **kwargs) -> Future:
+        future = Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except BaseException as e:
+            future.set_exception(e)
+        return future
+
+
+class StubBot:
+    """Records the time of every call, and raises the errors queued for a method instead of answering."""
+
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self.loop = loop
+        self.calls: list[tuple[float, str, tuple]] = []
+        self.errors: dict[str, list[Exception]] = {}
+
+    def send_message(self, *args, **kwargs):
+        return self._call('send_message', args)
+
+    def edit_message_text(self, *args, **kwargs):
+        return self._call('edit_message_text', args)
+
+    def answer_callback_query(self, *args, **kwargs):
+        return self._call('answer_callback_query', args)
+
+    def _call(self, method: str, args: tuple):
+        self.calls.append((self.loop.time(), method, args))
+        errors = self.errors.get(method)
+        if errors:
+            raise errors.pop(0)
+        return method
+
+
+@pytest.fixture
+def loop():
+    loop = VirtualClockLoop()
+    yield loop
+    loop.close()
+
+
+def run(loop: asyncio.AbstractEventLoop, queue: OutboundQueue, futures: list[Future]) -> None:
+    """Runs the queue until every future is done."""
+    async def main():
+        worker = asyncio.ensure_future(queue.run())
+        await asyncio.wait_for(asyncio.gather(*map(asyncio.wrap_future, futures)), 3600)
+        worker.cancel()
+        await asyncio.gather(worker, return_exceptions=True)
+
+    loop.run_until_complete(main())
+
+
+def make_queue(loop: asyncio.AbstractEventLoop, **kwargs) -> tuple[OutboundQueue, StubBot]:
+    bot = StubBot(loop)
+    return OutboundQueue(bot, loop, executor=InlineExecutor(), **kwargs), bot
+
+
+def test_chat_rate_limit(loop):
+    queue, bot = make_queue(loop)
+    count = GROUP_CHAT_BURST + 4
+    run(loop, queue, [queue.send_message(GROUP_CHAT, str(i)) for i in range(count)])
+
+    # A burst goes out at once, then messages are spaced by the rate of the chat, in order
+    assert [x[2][1] for x in bot.calls] == [str(i) for i in range(count)]
+    times = [x[0] for x in bot.calls]
+    assert times[:GROUP_CHAT_BURST] == [at(0)] * GROUP_CHAT_BURST
+    assert times[GROUP_CHAT_BURST:] == [at(i / GROUP_CHAT_RATE) for i in range(1, count - GROUP_CHAT_BURST + 1)]
+
+
+def test_global_rate_limit(loop):
+    queue, bot = make_queue(loop)
+    count = GLOBAL_BURST + 10
+    run(loop, queue, [queue.send_message(chat_id, 'Hello') for chat_id in range(1, count + 1)])
+
+    # Every chat has a token of its own, but they share the global budget
+    times = sorted(x[0] for x in bot.calls)
+    assert times[:GLOBAL_BURST] == [at(0)] * GLOBAL_BURST
+    assert times[GLOBAL_BURST:] == [at(i / GLOBAL_RATE) for i in range(1, count - GLOBAL_BURST + 1)]
+
+
+def test_retry_after(loop):
+    queue, bot = make_queue(loop)
+    bot.errors['send_message'] = [RetryAfter(7)]
+    first = queue.send_message(GROUP_CHAT, 'first')
+    second = queue.send_message(GROUP_CHAT, 'second')
+    run(loop, queue, [first, second])
+
+    # The request is sent again once the flood wait is over, and the chat waits behind it
+    assert first.result() == second.result() == 'send_message'
+    assert [(t, x[1]) for t, _, x in bot.calls] == [(at(0), 'first'), (at(7), 'first'), (at(7), 'second')]
+
+
+def test_lane_priority(loop):
+    queue, bot = make_queue(loop, workers=1, global_rate=1, global_burst=1)
+    futures = [queue.send_message(GROUP_CHAT, 'announcement'),
+               queue.edit_message_text(GROUP_CHAT + 1, 'reply', message_id=1),
+               queue.answer_callback_query('query')]
+    run(loop, queue, futures)
+
+    # Callback answers go first, then replies, then announcements, one per global token
+    assert [x[1] for x in bot.calls] == ['answer_callback_query', 'edit_message_text', 'send_message']
+    assert [x[0] for x in bot.calls] == [at(0), at(1), at(2)]